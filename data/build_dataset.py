@@ -1,25 +1,124 @@
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
 from PIL import Image
-from tflearn.data_utils import build_hdf5_image_dataset
 
 image_shape = (32, 32)
 dataset_file = "classes.txt"
 output_path = "dataset.h5"
+CHUNK_SIZE = 256  # images decoded and written per step
+ROWS_PER_CHUNK = 64  # rows per HDF5 chunk along axis 0, matching input_pipeline.BLOCK_SIZE
+
+
+def read_entries(path=dataset_file):
+    """Read the (image path, label) pairs listed in the dataset file.
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                image_path, label = line.rsplit(maxsplit=1)
+                entries.append((image_path, int(label)))
+    return entries
+
+
+def hash_file(path):
+    """Return the SHA-1 digest of a file's contents.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_image(path):
+    """Decode an image, resize it to image_shape and scale it to [0, 1].
+
+    The source file is left untouched.
+    """
+    with Image.open(path) as image:
+        image = image.convert("RGB").resize(image_shape)
+        return np.asarray(image, dtype=np.float32) / 255
+
+
+def _create(h5f, n_classes):
+    """Create the empty, resizable, chunked and compressed datasets.
+    """
+    h5f.create_dataset("X", shape=(0, *image_shape, 3), maxshape=(None, *image_shape, 3),
+                       dtype="f4", chunks=(ROWS_PER_CHUNK, *image_shape, 3), compression="gzip", shuffle=True)
+    h5f.create_dataset("Y", shape=(0, n_classes), maxshape=(None, n_classes), dtype="f4",
+                       chunks=(ROWS_PER_CHUNK, n_classes), compression="gzip")
+    h5f.create_dataset("paths", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(),
+                       chunks=(ROWS_PER_CHUNK,))
+    h5f.create_dataset("hashes", shape=(0,), maxshape=(None,), dtype="S40", chunks=(ROWS_PER_CHUNK,))
+
+
+def build(entries, pool, path=output_path):
+    """Bring the HDF5 dataset at path up to date with the given entries.
+
+    Images whose contents and label are unchanged since the last build are
+    skipped, changed ones are rewritten in place and new ones are appended.
+    Images are decoded in a process pool and written CHUNK_SIZE at a time, so
+    memory stays bounded. If images were removed from the list, or the number
+    of classes changed, the dataset is rebuilt from scratch.
+    Returns the number of images decoded.
+    """
+    n_classes = max(label for _, label in entries) + 1
+    hashes = list(pool.map(hash_file, [p for p, _ in entries], chunksize=CHUNK_SIZE))
+
+    with h5py.File(path, "a") as h5f:
+        rows = {}
+        if "paths" in h5f:
+            rows = {p.decode() if isinstance(p, bytes) else p: row
+                    for row, p in enumerate(h5f["paths"][()])}
+        listed = {p for p, _ in entries}
+        if "paths" not in h5f or h5f["Y"].shape[1] != n_classes or not set(rows) <= listed:
+            for name in ("X", "Y", "paths", "hashes"):
+                if name in h5f:
+                    del h5f[name]
+            _create(h5f, n_classes)
+            rows = {}
+
+        stored_hashes = h5f["hashes"][()]
+        stored_labels = np.argmax(h5f["Y"][()], axis=1) if len(rows) else np.zeros(0, int)
+        stale = [(i, rows.get(p, -1)) for i, (p, label) in enumerate(entries)
+                 if p not in rows or stored_hashes[rows[p]].decode() != hashes[i] or
+                 stored_labels[rows[p]] != label]
+
+        # Rows for new images go after every existing row, in list order
+        next_row = len(rows)
+        targets = []
+        for i, row in stale:
+            if row < 0:
+                row, next_row = next_row, next_row + 1
+            targets.append((i, row))
+        for name in ("X", "Y", "paths", "hashes"):
+            h5f[name].resize(next_row, axis=0)
+
+        for start in range(0, len(targets), CHUNK_SIZE):
+            chunk = targets[start:start + CHUNK_SIZE]
+            indices, chunk_rows = zip(*chunk)
+            values = {"X": np.stack(list(pool.map(load_image, [entries[i][0] for i in indices]))),
+                      "Y": np.eye(n_classes, dtype=np.float32)[[entries[i][1] for i in indices]],
+                      "paths": [entries[i][0] for i in indices],
+                      "hashes": [hashes[i].encode() for i in indices]}
+
+            # Appended rows are contiguous and written as one slice; rewritten
+            # rows are scattered and written one at a time
+            first = chunk_rows[0]
+            if list(chunk_rows) == list(range(first, first + len(chunk))):
+                for name, value in values.items():
+                    h5f[name][first:first + len(chunk)] = value
+            else:
+                for j, row in enumerate(chunk_rows):
+                    for name, value in values.items():
+                        h5f[name][row] = value[j]
+
+    return len(targets)
+
 
-for file_name in os.listdir("."):
-    if os.path.isdir(file_name):
-        for image_name in os.listdir(file_name):
-            image_path = "{}/{}".format(file_name, image_name)
-            image = Image.open(image_path)
-            image = image.resize(image_shape)
-            image.save(image_path)
-
-build_hdf5_image_dataset(
-    dataset_file,
-    image_shape=image_shape,
-    output_path=output_path,
-    mode="file",
-    categorical_labels=True,
-    normalize=True,
-    grayscale=False
-)
+if __name__ == "__main__":
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        n_decoded = build(read_entries(), executor)
+    print(f"{n_decoded} images decoded into {output_path}")
@@ -1,59 +1,77 @@
-import h5py
-import tflearn.data_preprocessing
-import tflearn.data_augmentation
-from tflearn.layers import core, conv, estimator
-from tflearn.models import dnn
-
+import numpy as np
+from inference import save
 
 dataset_filepath = "dataset.h5"
 model_filepath = "classifier.tfl"
+weights_filepath = "classifier.npz"
+VALIDATION_SPLIT = 0.2  # fraction of every label held out for validation
 
-data_preprocessing = tflearn.data_preprocessing.DataPreprocessing()
-data_preprocessing.add_featurewise_stdnorm()
-data_preprocessing.add_featurewise_zero_center()
+model = None
+data_preprocessing = None
 
-data_augmentation = tflearn.data_augmentation.ImageAugmentation()
-data_augmentation.add_random_flip_leftright()
-data_augmentation.add_random_flip_updown()
-data_augmentation.add_random_rotation(max_angle=180)
 
-network = core.input_data(shape=(None, 32, 32, 3), data_preprocessing=data_preprocessing, data_augmentation=data_augmentation)
-network = conv.conv_2d(network, nb_filter=32, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.conv_2d(network, nb_filter=32, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+def build_model(mean=None, std=None, augmentation=True):
+    """Build the classifier network and return the untrained model together
+    with its preprocessing. The featurewise mean and std are computed by
+    tflearn from the data given to fit() unless they are passed explicitly,
+    which is required when training batch by batch. The built-in
+    augmentation can be turned off when batches are augmented beforehand.
 
-network = conv.conv_2d(network, nb_filter=64, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.conv_2d(network, nb_filter=64, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+    TensorFlow is only imported here, so importing this module is cheap.
+    """
+    import tflearn.data_preprocessing
+    import tflearn.data_augmentation
+    from tflearn.layers import core, conv, estimator
+    from tflearn.models import dnn
 
-network = conv.conv_2d(network, nb_filter=128, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.conv_2d(network, nb_filter=128, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+    data_preprocessing = tflearn.data_preprocessing.DataPreprocessing()
+    data_preprocessing.add_featurewise_stdnorm(std=std)
+    data_preprocessing.add_featurewise_zero_center(mean=mean)
 
-network = conv.conv_2d(network, nb_filter=256, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.conv_2d(network, nb_filter=256, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+    data_augmentation = None
+    if augmentation:
+        data_augmentation = tflearn.data_augmentation.ImageAugmentation()
+        data_augmentation.add_random_flip_leftright()
+        data_augmentation.add_random_flip_updown()
+        data_augmentation.add_random_rotation(max_angle=180)
 
-network = conv.conv_2d(network, nb_filter=512, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.conv_2d(network, nb_filter=512, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
-network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+    network = core.input_data(shape=(None, 32, 32, 3), data_preprocessing=data_preprocessing, data_augmentation=data_augmentation)
+    for nb_filter in (32, 64, 128, 256, 512):
+        network = conv.conv_2d(network, nb_filter=nb_filter, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
+        network = conv.conv_2d(network, nb_filter=nb_filter, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
+        network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
 
-network = core.fully_connected(network, n_units=1024, activation="relu", regularizer="L2")
-network = core.fully_connected(network, n_units=1024, activation="relu", regularizer="L2")
-network = core.fully_connected(network, n_units=6, activation="linear", regularizer="L2")
-network = estimator.regression(network, optimizer="adam", loss="softmax_categorical_crossentropy", learning_rate=0.001)
+    network = core.fully_connected(network, n_units=1024, activation="relu", regularizer="L2")
+    network = core.fully_connected(network, n_units=1024, activation="relu", regularizer="L2")
+    network = core.fully_connected(network, n_units=6, activation="linear", regularizer="L2")
+    network = estimator.regression(network, optimizer="adam", loss="softmax_categorical_crossentropy", learning_rate=0.001)
 
-model = dnn.DNN(network)
+    return dnn.DNN(network), data_preprocessing
 
 
-def train():
+def train(n_epoch=200, batch_size=64, n_workers=2):
     """Train and save the classifier.
+
+    Shuffled batches are streamed from the dataset and augmented in worker
+    processes by input_pipeline, so the dataset is never loaded whole.
     """
-    h5f = h5py.File(dataset_filepath, "r")
-    X = h5f["X"]
-    Y = h5f["Y"]
+    from input_pipeline import BatchStream, get_statistics, split
+
+    global model, data_preprocessing
+    train_rows, validation_rows = split(dataset_filepath, VALIDATION_SPLIT)
+    mean, std = get_statistics(dataset_filepath, train_rows)
+    model, data_preprocessing = build_model(mean, std, augmentation=False)
+
+    validation = BatchStream(dataset_filepath, validation_rows, batch_size, augmentation=False)
+    with BatchStream(dataset_filepath, train_rows, batch_size, n_workers=n_workers) as stream:
+        for epoch in range(n_epoch):
+            for X, Y in stream.epoch():
+                model.fit_batch(X, Y)
+
+            correct = sum(np.sum(np.argmax(model.predict(X), axis=1) == np.argmax(Y, axis=1))
+                          for X, Y in validation.epoch(shuffle=False))
+            print(f"epoch {epoch + 1}: validation accuracy {correct / len(validation_rows):.3f}")
 
-    model.fit(X, Y, n_epoch=200, validation_set=0.2, show_metric=True)
     model.save(model_filepath)
 
 
@@ -61,6 +79,9 @@ def predict_init():
     """Load the trained classifier.
     Must be called before the first call to predict().
     """
+    global model, data_preprocessing
+    if model is None:
+        model, data_preprocessing = build_model()
     model.load(model_filepath)
 
 
@@ -68,5 +89,34 @@ def predict(X):
     """Use the classifier to predict probabilities for each image in X.
     predict_init() must be called prior to the first invocation.
     """
-    # model.load(model_filepath)
     return model.predict(X)
+
+
+def export(path=weights_filepath):
+    """Write the trained weights and preprocessing statistics to a .npz file
+    that inference.Classifier can run without TensorFlow.
+    predict_init() must be called prior to the first invocation.
+
+    Layers are recorded in network order; every second convolution is
+    followed by a max pool, as in build_model().
+    """
+    import tflearn
+
+    variables = tflearn.get_all_trainable_variable()
+    layers, params = [], []
+    for W, b in zip(variables[::2], variables[1::2]):
+        params.append((model.get_weights(W), model.get_weights(b)))
+        if params[-1][0].ndim == 2:
+            layers.append("dense")
+            continue
+        layers.append("conv")
+        if layers.count("conv") % 2 == 0:
+            layers.append("pool")
+
+    save(path, layers, params, data_preprocessing.global_mean.value,
+         data_preprocessing.global_std.value)
+
+
+if __name__ == "__main__":
+    predict_init()
+    export()
@@ -1,26 +1,327 @@
+import threading
+from concurrent.futures import Future
+from queue import Queue
+
 import numpy as np
-from PIL import Image
 from selective_search import selective_search
-from classifier import predict, predict_init
+from inference import Classifier, weights_filepath
+from tracker import Tracker
 
-predict_init()
 image_shape = (32, 32)
 CONFIDENCE_THRESHOLD = 0.8  # minimum probability of predicted label
+IOU_THRESHOLD = 0.3  # maximum overlap between two kept detections of a class
+BOX_VOTING = True  # replace kept boxes by the score-weighted mean of their cluster
+PYRAMID_SCALES = (0.5, 0.25)  # image scales of dense detection, a window spans 32 / scale pixels
+DENSE_SHIFTS = 4  # shifted poolings per axis, dividing the stride of the heatmaps
+KEYFRAME_INTERVAL = 1  # frames per full detection, the frames in between are tracked
 
+_local = threading.local()  # holds the crop and pyramid buffers of each thread
 
-def detect_objects(image):
-    """Determine the label and location of objects in an image.
 
-    Returns a list of tuples (label, x, y, w, h) corresponding to all object
-    labels and locations with probability above the confidence threshold.
+def _sample_grid(starts, sizes, n_samples, limit):
+    """Return the two neighbouring pixel indices and the weight of the second
+    one for n_samples evenly spaced sample centers across each box side.
+    """
+    centers = starts[:, None] + (np.arange(n_samples) + 0.5) * (sizes[:, None] / n_samples) - 0.5
+    centers = np.clip(centers, 0, limit - 1)
+    low = np.floor(centers).astype(np.intp)
+    high = np.minimum(low + 1, limit - 1)
+    return low, high, (centers - low).astype(np.float32)
+
+
+def crop_and_resize(image, boxes, shape=image_shape):
+    """Crop every (x, y, w, h) box out of an HxWx3 uint8 image and resize it to
+    shape with bilinear sampling, scaled to [0, 1].
+
+    Boxes may extend past the image, whose border pixels are then repeated.
+    Returns an (N, *shape, 3) float32 view of a per-thread buffer: the result
+    aliases the results of every other call from the same thread, and is
+    overwritten by the next one, so it must be consumed or copied before then.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    buffer = getattr(_local, "crop_buffer", np.empty((0, *shape, 3), dtype=np.float32))
+    if len(boxes) > len(buffer) or buffer.shape[1:3] != shape:
+        buffer = np.empty((max(len(boxes), 2 * len(buffer)), *shape, 3), dtype=np.float32)
+        _local.crop_buffer = buffer
+    out = buffer[:len(boxes)]
+
+    x0, x1, wx = _sample_grid(boxes[:, 0], boxes[:, 2], shape[1], image.shape[1])
+    y0, y1, wy = _sample_grid(boxes[:, 1], boxes[:, 3], shape[0], image.shape[0])
+    y0, y1, wy = y0[:, :, None], y1[:, :, None], wy[:, :, None, None]
+    x0, x1, wx = x0[:, None, :], x1[:, None, :], wx[:, None, :, None]
+
+    top = image[y0, x0] * (1 - wx) + image[y0, x1] * wx
+    bottom = image[y1, x0] * (1 - wx) + image[y1, x1] * wx
+    np.multiply(top * (1 - wy) + bottom * wy, 1 / 255, out=out)
+    return out
+
+
+def resize(image, shape):
+    """Resize a whole HxWx3 uint8 image to shape with bilinear sampling, scaled
+    to [0, 1], sampling exactly as crop_and_resize does for the full image.
+
+    Returns a float32 view of a per-thread buffer kept for each shape, apart
+    from the crop buffer, so that the levels of an image pyramid neither
+    evict the 32x32 crops nor reallocate on every frame. It is reused by the
+    next call from the same thread with the same shape.
+    """
+    buffers = getattr(_local, "pyramid_buffers", None)
+    if buffers is None:
+        buffers = _local.pyramid_buffers = {}
+    out = buffers.get(shape)
+    if out is None:
+        out = buffers[shape] = np.empty((*shape, 3), dtype=np.float32)
+
+    x0, x1, wx = _sample_grid(np.zeros(1), np.array([image.shape[1]]), shape[1], image.shape[1])
+    y0, y1, wy = _sample_grid(np.zeros(1), np.array([image.shape[0]]), shape[0], image.shape[0])
+    rows_0, rows_1 = image[y0[0]], image[y1[0]]
+    wx, wy = wx[0][:, None], wy[0][:, None, None]
+
+    top = rows_0[:, x0[0]] * (1 - wx) + rows_0[:, x1[0]] * wx
+    bottom = rows_1[:, x0[0]] * (1 - wx) + rows_1[:, x1[0]] * wx
+    np.multiply(top * (1 - wy) + bottom * wy, 1 / 255, out=out)
+    return out
+
+
+def box_iou(boxes, others):
+    """Return the (N, M) matrix of intersection over union between two arrays
+    of (x, y, w, h) rows.
+    """
+    boxes, others = boxes[:, None, :], others[None, :, :]
+    w = np.minimum(boxes[..., 0] + boxes[..., 2], others[..., 0] + others[..., 2]) - \
+        np.maximum(boxes[..., 0], others[..., 0])
+    h = np.minimum(boxes[..., 1] + boxes[..., 3], others[..., 1] + others[..., 3]) - \
+        np.maximum(boxes[..., 1], others[..., 1])
+    intersection = np.clip(w, 0, None) * np.clip(h, 0, None)
+    union = boxes[..., 2] * boxes[..., 3] + others[..., 2] * others[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def non_max_suppression(boxes, scores, labels, iou_threshold=IOU_THRESHOLD, vote=BOX_VOTING):
+    """Greedy per-class non-maximum suppression.
+
+    Boxes are visited from the highest score down, and every box of the same
+    label that overlaps a kept box by more than iou_threshold is suppressed.
+    With voting, each kept box is replaced by the score-weighted mean of every
+    box of its label that overlaps it by more than iou_threshold.
+    A kept box whose cluster scores sum to zero is left as it is.
+    Returns the indices of the kept boxes, highest score first, as an intp
+    array, and the kept boxes themselves.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels)
+    clusters = (box_iou(boxes, boxes) > iou_threshold) & (labels[:, None] == labels[None, :])
+
+    order = np.argsort(-scores, kind="stable")
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= clusters[i]
+    keep = np.array(keep, dtype=np.intp)
+
+    if not vote or keep.size == 0:
+        return keep, boxes[keep]
+    weights = clusters[keep] * scores[None, :]
+    totals = weights.sum(axis=1, keepdims=True)
+    voted = weights @ boxes / np.where(totals > 0, totals, 1)
+    return keep, np.where(totals > 0, voted, boxes[keep])
+
+
+class Detector:
+    """Object detector that loads its classifier on first use.
+
+    Frames can be classified synchronously with detect(), or queued with
+    submit() for a pool of worker threads that share the read-only weights
+    of a single classifier; NumPy releases the GIL during inference, so
+    several frames are classified concurrently.
+
+    With dense=True, detect() uses detect_dense() instead of classifying
+    selective search candidates, over the image pyramid given by scales and
+    with windows stride / shifts pixels apart. Its cost is dominated by the
+    convolutions over the largest scale: at 640x480 the default settings take
+    well under half the time of classifying 300 crops, while adding scale 1.0
+    makes it slower than the crops.
+
+    With keyframe_interval > 1, detect() treats its images as consecutive
+    frames of a video: full detection only runs on keyframes, once every
+    keyframe_interval frames, and the boxes are followed in between by a
+    Tracker. Since frames must then arrive in order, at most one worker can
+    run.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, weights_path=weights_filepath, n_workers=0, warm_up=False, dense=False,
+                 scales=PYRAMID_SCALES, shifts=DENSE_SHIFTS, keyframe_interval=KEYFRAME_INTERVAL):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.weights_path = weights_path
+        self.dense = dense
+        self.scales = scales
+        self.shifts = shifts
+        self._classifier = None
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._workers = []
+        self._tracker = None
+        self._tracker_lock = threading.Lock()
+        if keyframe_interval > 1:
+            self._tracker = Tracker(self.__detect_frame, keyframe_interval)
+        if warm_up:
+            self.warm_up()
+        self.start(n_workers)
+
+    @property
+    def classifier(self):
+        """The classifier, loaded on first access.
+        """
+        if self._classifier is None:
+            with self._lock:
+                if self._classifier is None:
+                    self._classifier = Classifier(self.weights_path)
+        return self._classifier
+
+    def warm_up(self, batch_size=64):
+        """Load the classifier and run it once on a dummy batch, so that the
+        first real frame does not pay for loading or for allocating buffers.
+        """
+        self.classifier.predict(np.zeros((batch_size, *image_shape, 3), dtype=np.float32))
+
+    def start(self, n_workers):
+        """Start n_workers more threads that classify submitted frames.
+        """
+        if self._tracker is not None and len(self._workers) + n_workers > 1:
+            raise ValueError("a tracking Detector needs its frames in order, so at most one worker")
+        for _ in range(n_workers):
+            worker = threading.Thread(target=self.__work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self):
+        """Stop every worker once the frames already submitted are done.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def submit(self, image):
+        """Queue an image for the workers.
+
+        Returns a Future that resolves to the result of detect(image).
+        """
+        if not self._workers:
+            raise RuntimeError("Detector has no workers; call start() first")
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def __work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            image, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.detect(image))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+
+    def detect(self, image):
+        """Determine the label and location of objects in an image.
+
+        Returns a list of tuples (label, x, y, w, h) corresponding to all object
+        labels and locations with probability above the confidence threshold,
+        after overlapping detections of the same label have been merged by
+        non-maximum suppression. Between keyframes, they are the tracked boxes
+        of the last keyframe instead.
+        """
+        if self._tracker is None:
+            return self.__detect_frame(image)
+        with self._tracker_lock:
+            return self._tracker.update(image)
+
+    def __detect_frame(self, image):
+        if self.dense:
+            return self.detect_dense(image)
+
+        candidates = selective_search(image)
+        sub_images = crop_and_resize(image, candidates)
+        predict_probabilities = self.classifier.predict(sub_images)
+        predict_labels = np.argmax(predict_probabilities, axis=1)
+        confidences = predict_probabilities[np.arange(len(candidates)), predict_labels]
+        confident = confidences > CONFIDENCE_THRESHOLD
+
+        keep, boxes = non_max_suppression(candidates[confident], confidences[confident],
+                                          predict_labels[confident])
+        labels = predict_labels[confident][keep]
+        return [(labels[i], *np.rint(boxes[i]).astype(int)) for i in range(len(keep))]
+
+    def detect_dense(self, image):
+        """Determine the label and location of objects in an image by sliding
+        the classifier over an image pyramid, in the same format as detect().
+
+        The classifier runs fully convolutionally, once per scale, so
+        overlapping windows share their convolutions instead of being
+        classified crop by crop. Every cell of the resulting heatmaps is a
+        square window of 32 / scale pixels. The last pooling layers pool from
+        every offset (shift-and-stitch), so that windows are stride / shifts
+        pixels apart at every scale while only the layers after those
+        poolings, such as the dense head, run once per offset. Windows near
+        the borders of the scaled image see the same zero padding as a crop,
+        but interior windows see their real surroundings, so scores are close
+        to, not identical with, those of classifying the crop on its own.
+        """
+        stride = self.classifier.stride
+        height, width = image.shape[:2]
+        boxes, confidences, predict_labels = [], [], []
+        for scale in self.scales:
+            shape = (int(round(height * scale)), int(round(width * scale)))
+            if shape[0] < image_shape[0] or shape[1] < image_shape[1]:
+                continue
+            scaled = resize(image, shape)
+
+            for (offset_y, offset_x), heatmap in self.classifier.predict_dense(scaled, self.shifts):
+                labels = np.argmax(heatmap, axis=2)
+                scores = np.take_along_axis(heatmap, labels[..., None], axis=2)[..., 0]
+                i, j = np.nonzero(scores > CONFIDENCE_THRESHOLD)
+                boxes.append(np.stack([(offset_x + j * stride) / scale,
+                                       (offset_y + i * stride) / scale,
+                                       np.full(len(i), image_shape[1] / scale),
+                                       np.full(len(i), image_shape[0] / scale)], axis=1))
+                confidences.append(scores[i, j])
+                predict_labels.append(labels[i, j])
+
+        if not boxes:
+            return []
+        predict_labels = np.concatenate(predict_labels)
+        keep, boxes = non_max_suppression(np.concatenate(boxes), np.concatenate(confidences),
+                                          predict_labels)
+        labels = predict_labels[keep]
+        return [(labels[i], *np.rint(boxes[i]).astype(int)) for i in range(len(keep))]
+
+
+_default_detector = None
+
+
+def detect_objects(image):
+    """Determine the label and location of objects in an image with a shared
+    Detector, created on the first call. See Detector.detect.
     """
-    candidates = list(selective_search(image))
-    sub_images = np.array([*map(lambda i: np.array(Image.fromarray(image[i[1]:i[1] + i[3], i[0]:i[0] + i[2], :]).resize(image_shape), dtype=np.uint8)/255, candidates)])
-    predict_probabilities = predict(sub_images)
-    predict_labels = np.argmax(predict_probabilities, axis=1)
-    return [(predict_labels[i], *candidates[i]) for i in range(len(candidates)) if predict_probabilities[i][predict_labels[i]] > CONFIDENCE_THRESHOLD]
-    
-    
+    global _default_detector
+    if _default_detector is None:
+        _default_detector = Detector()
+    return _default_detector.detect(image)
+
+
 if __name__ == "__main__":
+    from PIL import Image
+
     objects = detect_objects(np.array(Image.open("test.png"))[:, :, :3])
     print(objects)
@@ -0,0 +1,130 @@
+import os
+import time
+
+import numpy as np
+import tflearn
+import tflearn.data_preprocessing
+import tflearn.data_augmentation
+from tflearn.layers import core, conv, estimator
+from tflearn.models import dnn
+from inference import Classifier, quantize, save, weights_filepath
+from input_pipeline import BatchStream, split
+
+dataset_filepath = "dataset.h5"
+student_filepath = "classifier_student.npz"
+quantized_filepath = "classifier_student_int8.npz"
+
+TEMPERATURE = 4.0  # softens the teacher probabilities used as targets
+ALPHA = 0.7  # weight of the teacher targets against the true labels
+VALIDATION_SPLIT = 0.2  # fraction of every label held out, as in classifier.train()
+STUDENT_LAYERS = ("conv", "pool", "conv", "pool", "conv", "pool", "dense", "dense")
+
+
+def softmax(logits, temperature=1.0):
+    """Row-wise softmax of logits / temperature.
+    """
+    z = logits / temperature
+    z = np.exp(z - z.max(axis=1, keepdims=True))
+    return z / z.sum(axis=1, keepdims=True)
+
+
+def load_dataset():
+    """Return the training and validation rows of the dataset, split as in
+    classifier.train() so the student is scored on the same held-out images.
+    """
+    return split(dataset_filepath, VALIDATION_SPLIT)
+
+
+def build_student(mean, std):
+    """Build a compact student network, with three narrow convolutions and a
+    single small hidden dense layer, that uses the preprocessing statistics of
+    the teacher so the two see identical inputs.
+    """
+    data_preprocessing = tflearn.data_preprocessing.DataPreprocessing()
+    data_preprocessing.add_featurewise_stdnorm(std=std)
+    data_preprocessing.add_featurewise_zero_center(mean=mean)
+
+    data_augmentation = tflearn.data_augmentation.ImageAugmentation()
+    data_augmentation.add_random_flip_leftright()
+    data_augmentation.add_random_flip_updown()
+
+    network = core.input_data(shape=(None, 32, 32, 3), data_preprocessing=data_preprocessing, data_augmentation=data_augmentation)
+    for nb_filter in (16, 32, 64):
+        network = conv.conv_2d(network, nb_filter=nb_filter, filter_size=3, strides=1, padding="same", activation="relu", regularizer="L2")
+        network = conv.max_pool_2d(network, kernel_size=2, strides=2, padding="same")
+    network = core.fully_connected(network, n_units=128, activation="relu", regularizer="L2")
+    network = core.fully_connected(network, n_units=6, activation="linear", regularizer="L2")
+    network = estimator.regression(network, optimizer="adam", loss="softmax_categorical_crossentropy", learning_rate=0.001)
+    return dnn.DNN(network)
+
+
+def distill(n_epoch=100, batch_size=64):
+    """Train the student on a blend of the softened outputs of the exported
+    teacher and the true labels, then export it like classifier.export().
+
+    Batches are streamed from the dataset by input_pipeline and the teacher
+    targets computed per batch, so the dataset is never loaded whole.
+    """
+    teacher = Classifier(weights_filepath)
+    train_rows, validation_rows = load_dataset()
+
+    model = build_student(float(teacher.mean), float(teacher.std))
+    stream = BatchStream(dataset_filepath, train_rows, batch_size, augmentation=False)
+    validation = BatchStream(dataset_filepath, validation_rows, batch_size, augmentation=False)
+    for epoch in range(n_epoch):
+        for X, Y in stream.epoch():
+            model.fit_batch(X, ALPHA * softmax(teacher.predict(X), TEMPERATURE) + (1 - ALPHA) * Y)
+
+        correct = sum(np.sum(np.argmax(model.predict(X), axis=1) == np.argmax(Y, axis=1))
+                      for X, Y in validation.epoch(shuffle=False))
+        print(f"epoch {epoch + 1}: validation accuracy {correct / len(validation_rows):.3f}")
+
+    variables = tflearn.get_all_trainable_variable()
+    params = [(model.get_weights(W), model.get_weights(b))
+              for W, b in zip(variables[::2], variables[1::2])]
+    save(student_filepath, STUDENT_LAYERS, params, teacher.mean, teacher.std)
+
+
+def evaluate(path, rows, batch_size=256, repeats=3):
+    """Return the accuracy over rows, crops per second, weight memory once
+    loaded and file size of a model. The rows are streamed from the dataset
+    one batch at a time.
+    """
+    classifier = Classifier(path)
+    correct, batch = 0, None
+    for X, Y in BatchStream(dataset_filepath, rows, batch_size, augmentation=False).epoch(shuffle=False):
+        correct += np.sum(np.argmax(classifier.predict(X, batch_size), axis=1) == np.argmax(Y, axis=1))
+        batch = X if batch is None else batch
+    accuracy = correct / len(rows)
+
+    batch = np.resize(batch, (batch_size, *batch.shape[1:]))
+    classifier.predict(batch, batch_size)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        classifier.predict(batch, batch_size)
+    throughput = repeats * batch_size / (time.perf_counter() - start)
+    return accuracy, throughput, classifier.nbytes, os.path.getsize(path)
+
+
+def report():
+    """Print the validation accuracy, throughput, weight memory and file size
+    of the teacher, the student and the quantized student, relative to the
+    teacher. The quantized student is dequantized on loading, so only its file
+    is smaller than the student's.
+    """
+    _, rows = load_dataset()
+    results = [(name, *evaluate(path, rows)) for name, path in (("teacher", weights_filepath),
+                                                                 ("student", student_filepath),
+                                                                 ("student int8", quantized_filepath))]
+    base_accuracy, base_throughput = results[0][1], results[0][2]
+    print(f"{'model':<14}{'accuracy':>10}{'delta':>9}{'crops/s':>11}{'speedup':>9}{'weights':>12}{'file':>12}")
+    for name, accuracy, throughput, nbytes, file_size in results:
+        print(f"{name:<14}{accuracy:>10.3f}{accuracy - base_accuracy:>+9.3f}"
+              f"{throughput:>11.0f}{throughput / base_throughput:>8.1f}x{nbytes / 2 ** 20:>9.2f} MB"
+              f"{file_size / 2 ** 20:>9.2f} MB")
+
+
+if __name__ == "__main__":
+    distill()
+    quantize(student_filepath, quantized_filepath)
+    report()
@@ -0,0 +1,218 @@
+from itertools import product
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+weights_filepath = "classifier.npz"
+EPSILON = 1e-8  # added to the standard deviation, as in tflearn preprocessing
+INT8_MAX = 127  # symmetric int8 range used for quantized weights
+
+
+def _linear(X, W, b):
+    """Return X @ W + b, where X is (M, K) and W is (K, F).
+    """
+    out = X @ W
+    out += b
+    return out
+
+
+def conv_2d(X, W, b):
+    """3x3 (or any odd size) convolution with stride 1 and "same" padding,
+    followed by ReLU, computed as a single matrix product over im2col patches.
+
+    X is an (N, H, W, C) batch and W a (kh, kw, C, F) kernel in tflearn layout.
+    """
+    kh, kw, channels, filters = W.shape
+    padded = np.pad(X, ((0, 0), (kh // 2, kh // 2), (kw // 2, kw // 2), (0, 0)))
+    patches = sliding_window_view(padded, (kh, kw), axis=(1, 2))
+    patches = patches.transpose(0, 1, 2, 4, 5, 3).reshape(-1, kh * kw * channels)
+    out = _linear(patches, W.reshape(-1, filters), b)
+    np.maximum(out, 0, out=out)
+    return out.reshape(X.shape[0], X.shape[1], X.shape[2], filters)
+
+
+def max_pool_2d(X):
+    """2x2 max pooling with stride 2 and "same" padding.
+    """
+    n, h, w, c = X.shape
+    if h % 2 or w % 2:
+        X = np.pad(X, ((0, 0), (0, h % 2), (0, w % 2), (0, 0)), constant_values=-np.inf)
+    return X.reshape(n, (h + 1) // 2, 2, (w + 1) // 2, 2, c).max(axis=(2, 4))
+
+
+def shifted_max_pool_2d(X, cell):
+    """2x2 max pooling of X started at each of the four offsets of a 2x2 block,
+    pooling only complete blocks. X is (N, H, W, C) and its cells are cell
+    input pixels wide.
+
+    Returns a list of ((offset_y, offset_x), pooled) pairs, with the offsets of
+    the first pooled cell in input pixels.
+    """
+    n, h, w, c = X.shape
+    pooled = []
+    for dy, dx in product((0, 1), repeat=2):
+        rows, cols = (h - dy) // 2, (w - dx) // 2
+        blocks = X[:, dy:dy + 2 * rows, dx:dx + 2 * cols].reshape(n, rows, 2, cols, 2, c)
+        pooled.append(((dy * cell, dx * cell), blocks.max(axis=(2, 4))))
+    return pooled
+
+
+def fully_connected(X, W, b, relu=True):
+    """Dense layer over the flattened features of X, optionally followed by ReLU.
+    """
+    out = _linear(X.reshape(X.shape[0], W.shape[0]), W, b)
+    if relu:
+        np.maximum(out, 0, out=out)
+    return out
+
+
+def dense_as_conv(X, W, b, relu=True):
+    """Apply a dense layer at every position of the (N, H, W, C) feature map X,
+    as a "valid" convolution whose window is the k x k x C input the layer
+    was trained on. A map smaller than the window gives an empty output.
+    """
+    n, h, w, channels = X.shape
+    k = int(round(np.sqrt(W.shape[0] // channels)))
+    if h < k or w < k:
+        return np.empty((n, max(h - k + 1, 0), max(w - k + 1, 0), W.shape[1]), dtype=np.float32)
+    patches = sliding_window_view(X, (k, k), axis=(1, 2))
+    patches = patches.transpose(0, 1, 2, 4, 5, 3).reshape(-1, k * k * channels)
+    out = _linear(patches, W, b)
+    if relu:
+        np.maximum(out, 0, out=out)
+    return out.reshape(n, h - k + 1, w - k + 1, W.shape[1])
+
+
+def save(path, layers, params, mean, std):
+    """Write a network to a .npz file that Classifier can load.
+
+    layers is the sequence of "conv", "pool" and "dense" layers in network
+    order, and params the list of (W, b) tuples of the conv and dense layers.
+    """
+    arrays = {}
+    for i, (W, b) in enumerate(params):
+        arrays[f"W{i}"], arrays[f"b{i}"] = W, b
+    np.savez(path, layers=np.array(layers), mean=mean, std=std, **arrays)
+
+
+class Classifier:
+    """CPU inference engine for the classifier exported by classifier.export().
+
+    Loading only reads a small .npz file, and inference is a chain of float32
+    matrix products, which NumPy runs without holding the GIL, so batches can
+    be evaluated concurrently from several threads. Files written by
+    quantize() hold int8 weights, which are dequantized to float32 once on
+    loading: they are four times smaller on disk, but run at the speed and
+    take the memory of the float network, since NumPy has no fast int8 matrix
+    product.
+    """
+
+    def __init__(self, path=weights_filepath):
+        with np.load(path) as weights:
+            self.layers = [str(kind) for kind in weights["layers"]]
+            self.mean = np.float32(weights["mean"])
+            self.std = np.float32(weights["std"])
+            self.quantized = "w_scale0" in weights
+            self.params = []
+            for i in range(sum(kind != "pool" for kind in self.layers)):
+                W = weights[f"W{i}"].astype(np.float32)
+                if self.quantized:
+                    W *= weights[f"w_scale{i}"].astype(np.float32)
+                self.params.append((W, weights[f"b{i}"].astype(np.float32)))
+
+    @property
+    def nbytes(self):
+        """Memory held by the weights once loaded, in bytes.
+        """
+        return sum(array.nbytes for params in self.params for array in params)
+
+    def predict(self, X, batch_size=128):
+        """Return the raw outputs (logits) of the final layer for every image
+        in the (N, 32, 32, 3) batch X, matching tflearn's model.predict.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        return np.concatenate([self.__forward(X[i:i + batch_size])
+                               for i in range(0, max(len(X), 1), batch_size)])
+
+    @property
+    def stride(self):
+        """Input pixels between neighbouring outputs of predict_dense.
+        """
+        return 2 ** self.layers.count("pool")
+
+    def predict_dense(self, image, shifts=1):
+        """Run the classifier fully convolutionally over a whole (H, W, 3) image
+        scaled to [0, 1], with every dense layer applied at every position.
+
+        The image is cropped to a multiple of stride. With shifts > 1, the last
+        log2(shifts) pooling layers pool from every offset of their 2x2 blocks
+        (shift-and-stitch), so that windows are stride / shifts pixels apart
+        while the layers before them run once.
+
+        Returns a list of ((offset_y, offset_x), heatmap) pairs, where heatmap
+        is an (H', W', n_classes) map of logits whose entry at (i, j)
+        classifies the 32x32 window with its top left corner at
+        (offset_y + i * stride, offset_x + j * stride). Convolutions see the
+        real neighbouring pixels instead of the zero padding of an isolated
+        crop, so the logits approximate predict on the same windows rather
+        than matching it exactly.
+        """
+        n_shifted = int(np.log2(shifts))
+        if 2 ** n_shifted != shifts or shifts > self.stride:
+            raise ValueError(f"shifts must be a power of two up to {self.stride}, got {shifts}")
+        h, w = image.shape[0] - image.shape[0] % self.stride, \
+            image.shape[1] - image.shape[1] % self.stride
+        X = np.asarray(image[None, :h, :w], dtype=np.float32)
+        return [(offset, heatmap[0]) for offset, heatmap in
+                self.__forward(X, dense=True, n_shifted=n_shifted)]
+
+    def __forward(self, X, dense=False, n_shifted=0):
+        """Return the logits of X or, when dense, a list of ((offset_y,
+        offset_x), logits) pairs with one entry per offset of the last
+        n_shifted pooling layers.
+        """
+        X = X / (self.std + EPSILON) - self.mean
+        n_dense = self.layers.count("dense")
+        n_pools = self.layers.count("pool")
+        outputs = [((0, 0), X)]
+        cell = 1
+        i = 0
+        for kind in self.layers:
+            if kind == "pool":
+                if n_pools <= n_shifted:
+                    outputs = [((y + dy, x + dx), pooled) for (y, x), X in outputs
+                               for (dy, dx), pooled in shifted_max_pool_2d(X, cell)]
+                else:
+                    outputs = [(offset, max_pool_2d(X)) for offset, X in outputs]
+                n_pools -= 1
+                cell *= 2
+                continue
+
+            if kind == "conv":
+                outputs = [(offset, conv_2d(X, *self.params[i])) for offset, X in outputs]
+            else:
+                n_dense -= 1
+                layer = dense_as_conv if dense else fully_connected
+                outputs = [(offset, layer(X, *self.params[i], relu=n_dense > 0))
+                           for offset, X in outputs]
+            i += 1
+        return outputs if dense else outputs[0][1]
+
+
+def quantize(path, output_path):
+    """Post-training int8 quantization of the weights of the float network
+    stored at path, with a symmetric per-output-channel scale. Biases stay in
+    float32. Activations are not quantized, since Classifier computes in
+    float32 anyway.
+    """
+    classifier = Classifier(path)
+
+    arrays = {}
+    for i, (W, b) in enumerate(classifier.params):
+        flat = W.reshape(-1, W.shape[-1])
+        w_scale = np.maximum(np.abs(flat).max(axis=0), EPSILON) / INT8_MAX
+        arrays[f"W{i}"] = np.rint(W / w_scale).astype(np.int8)
+        arrays[f"b{i}"] = b
+        arrays[f"w_scale{i}"] = w_scale
+    np.savez(output_path, layers=np.array(classifier.layers), mean=classifier.mean,
+             std=classifier.std, **arrays)
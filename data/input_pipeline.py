@@ -0,0 +1,154 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+
+import numpy as np
+
+BLOCK_SIZE = 64  # rows read at once, matching the HDF5 chunk size of build_dataset
+SHUFFLE_BLOCKS = 16  # blocks mixed together when shuffling, which bounds memory
+PREFETCH = 4  # batches prepared ahead of the training loop
+MAX_ANGLE = 180  # largest random rotation in degrees, as in the old tflearn augmentation
+
+
+def open_dataset(path):
+    """Return array-like X and Y without loading them into memory.
+
+    path is either an HDF5 file with X and Y datasets, or the common prefix of
+    prefix_X.npy and prefix_Y.npy, which are memory-mapped.
+    """
+    if path.endswith(".h5"):
+        import h5py
+
+        h5f = h5py.File(path, "r")
+        return h5f["X"], h5f["Y"]
+    return np.load(f"{path}_X.npy", mmap_mode="r"), np.load(f"{path}_Y.npy", mmap_mode="r")
+
+
+def split(path, validation_split, seed=0):
+    """Return the sorted training and validation row indices, holding out a
+    seeded random validation_split of the rows of every label.
+
+    The split is stratified because build_dataset writes the rows grouped by
+    label, so any contiguous tail would leave whole classes out of training.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.argmax(np.asarray(open_dataset(path)[1]), axis=1)
+    validation = []
+    for label in np.unique(labels):
+        rows = rng.permutation(np.flatnonzero(labels == label))
+        validation.append(rows[:int(round(len(rows) * validation_split))])
+    validation = np.sort(np.concatenate(validation))
+    return np.setdiff1d(np.arange(len(labels)), validation), validation
+
+
+def read_rows(array, rows):
+    """Return the given sorted rows of an array-like as a numpy array.
+
+    The span from the first to the last row is read as one slice and the rows
+    picked from it, which keeps HDF5 reads to whole chunks.
+    """
+    return np.asarray(array[rows[0]:rows[-1] + 1])[rows - rows[0]]
+
+
+def get_statistics(path, rows):
+    """Return the mean and standard deviation over every value of X in rows,
+    accumulated one block at a time so that memory stays bounded.
+    """
+    X = open_dataset(path)[0]
+    count, total, total_squares = 0, 0.0, 0.0
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = read_rows(X, rows[start:start + BLOCK_SIZE]).astype(np.float64)
+        count += block.size
+        total += block.sum()
+        total_squares += np.square(block).sum()
+    mean = total / count
+    return mean, np.sqrt(max(total_squares / count - mean ** 2, 0.0))
+
+
+def augment(X, seed):
+    """Randomly flip every image left-right and up-down, and rotate it about
+    its center by up to MAX_ANGLE degrees with nearest-neighbour sampling.
+    """
+    rng = np.random.default_rng(seed)
+    n, h, w = X.shape[:3]
+    X = np.where(rng.random(n)[:, None, None, None] < 0.5, X[:, :, ::-1], X)
+    X = np.where(rng.random(n)[:, None, None, None] < 0.5, X[:, ::-1], X)
+
+    angles = np.deg2rad(rng.uniform(-MAX_ANGLE, MAX_ANGLE, n))[:, None, None]
+    ys, xs = np.mgrid[0:h, 0:w] - np.array([(h - 1) / 2, (w - 1) / 2])[:, None, None]
+    sources_x = np.cos(angles) * xs + np.sin(angles) * ys + (w - 1) / 2
+    sources_y = -np.sin(angles) * xs + np.cos(angles) * ys + (h - 1) / 2
+    sources_x = np.clip(np.rint(sources_x), 0, w - 1).astype(np.intp)
+    sources_y = np.clip(np.rint(sources_y), 0, h - 1).astype(np.intp)
+    return X[np.arange(n)[:, None, None], sources_y, sources_x]
+
+
+class BatchStream:
+    """Shuffled mini-batches streamed from a dataset on disk.
+
+    Each epoch visits the blocks of rows in random order, SHUFFLE_BLOCKS at a
+    time, and shuffles the rows within them, so only a bounded window of the
+    dataset is in memory. A background thread reads the batches and hands
+    them to a pool of worker processes for augmentation, keeping PREFETCH
+    batches ahead of the consumer.
+    """
+
+    def __init__(self, path, rows, batch_size, augmentation=True, n_workers=2, seed=0):
+        self.path = path
+        self.rows = rows
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+        self.pool = ProcessPoolExecutor(max_workers=n_workers) if augmentation else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def __read(self, queue, shuffle):
+        X, Y = open_dataset(self.path)
+        starts = np.arange(0, len(self.rows), BLOCK_SIZE)
+        if shuffle:
+            self.rng.shuffle(starts)
+
+        for group in range(0, len(starts), SHUFFLE_BLOCKS):
+            blocks = [self.rows[start:start + BLOCK_SIZE]
+                      for start in sorted(starts[group:group + SHUFFLE_BLOCKS])]
+            window_X = np.concatenate([read_rows(X, block).astype(np.float32) for block in blocks])
+            window_Y = np.concatenate([read_rows(Y, block).astype(np.float32) for block in blocks])
+            order = self.rng.permutation(len(window_X)) if shuffle else np.arange(len(window_X))
+
+            for i in range(0, len(order), self.batch_size):
+                batch = order[i:i + self.batch_size]
+                seed = int(self.rng.integers(2 ** 32))
+                if self.pool is None:
+                    queue.put((window_X[batch], window_Y[batch]))
+                else:
+                    queue.put((self.pool.submit(augment, window_X[batch], seed),
+                               window_Y[batch]))
+        queue.put(None)
+
+    def epoch(self, shuffle=True):
+        """Yield (X, Y) batches covering every row once.
+
+        Blocks are not padded, so a batch may hold fewer than batch_size rows
+        when it ends a shuffle window.
+        """
+        queue = Queue(maxsize=PREFETCH)
+        reader = threading.Thread(target=self.__read, args=(queue, shuffle), daemon=True)
+        reader.start()
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            X, Y = item
+            yield (X if isinstance(X, np.ndarray) else X.result()), Y
+        reader.join()
@@ -1,24 +1,105 @@
-from selectivesearch import selective_search as ss
+import atexit
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
+import numpy as np
 
-def selective_search(image):
-    """A wrapper for the selective_search function in the selectivesearch
-    library with fixed parameters.
+SCALES = (200, 400, 800)  # segmentation scales, each run in its own process
+SIGMA = 0.5
+MIN_SIZE = 256  # minimum region size in pixels of the full resolution image
+DOWNSAMPLE = 2  # factor by which the image is shrunk before segmentation
+MAX_ASPECT_RATIO = 1.2  # ignore elongated areas
+MIN_AREA = 16 * 16  # minimum candidate area in pixels of the full resolution image
+MAX_AREA = 320 * 240  # maximum candidate area in pixels of the full resolution image
+TIME_BUDGET = 0.5  # seconds to wait for the scales to finish
 
-    Returns a set of tuples (x, y, w, h) corresponding to candidate
-    locations of objects in the input image.
+_pool = None
+_overrun = {}  # scale -> future of a run that outlived the time budget of its frame
+_overrun_lock = threading.Lock()
+
+
+def _get_pool():
+    """Return the process pool shared by every call, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=len(SCALES))
+        atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+    return _pool
+
+
+def _segment(image, scale, sigma, min_size):
+    """Run selective search at a single scale.
+
+    Returns an (N, 4) array of rows (x, y, w, h).
+    """
+    from selectivesearch import selective_search as ss
+
+    regions = ss(image, scale=scale, sigma=sigma, min_size=min_size)[1]
+    return np.array([region["rect"] for region in regions], dtype=np.int64).reshape(-1, 4)
+
+
+def downsample(image, factor=DOWNSAMPLE):
+    """Shrink an image by an integer factor, averaging each factor x factor block.
+
+    Rows and columns that do not fill a whole block are dropped.
+    """
+    if factor == 1:
+        return image
+    h, w = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:h * factor, :w * factor].reshape(h, factor, w, factor, -1)
+    return blocks.mean(axis=(1, 3)).astype(image.dtype)
+
+
+def filter_candidates(rects):
+    """Drop duplicate, elongated, tiny and huge rects in a single vectorized pass.
+
+    Takes and returns an (N, 4) array of rows (x, y, w, h).
+    """
+    rects = np.unique(rects.reshape(-1, 4), axis=0)
+    w, h = rects[:, 2], rects[:, 3]
+    area = w * h
+    keep = (w > 0) & (h > 0)
+    keep &= np.maximum(w, h) <= MAX_ASPECT_RATIO * np.minimum(w, h)
+    keep &= (area >= MIN_AREA) & (area <= MAX_AREA)
+    return rects[keep]
+
+
+def selective_search(image, scales=SCALES, time_budget=TIME_BUDGET, factor=DOWNSAMPLE,
+                     segment=_segment):
+    """Propose candidate object locations by running selective search at several
+    scales in parallel on a downsampled copy of the image.
+
+    Scales that have not finished when the time budget runs out are skipped,
+    unless none have finished, in which case the first one to finish is used.
+    A running process cannot be cancelled, so a scale that overran keeps its
+    worker busy, and is not submitted again until that run ends; its late
+    result is discarded, since it describes an older frame. This keeps stale
+    work from queueing in front of the next frame.
+    Returns an (N, 4) array of unique rows (x, y, w, h) in full resolution
+    pixel coordinates, which is empty if every scale is still busy.
     """
-    regions = ss(image, scale=400, sigma=0.5, min_size=256)[1]
-    candidates = set()
-    for region in regions:
-        if region["rect"] in candidates:
-            continue
+    deadline = time.monotonic() + time_budget
+    small = downsample(image, factor)
+    min_size = max(1, MIN_SIZE // factor ** 2)
 
-        # ignore elongated areas
-        x, y, w, h = region["rect"]
-        if w/h > 1.2 or h/w > 1.2:
-            continue
+    pool = _get_pool()
+    with _overrun_lock:
+        for scale in [scale for scale, future in _overrun.items() if future.done()]:
+            del _overrun[scale]
+        submitted = {pool.submit(segment, small, scale, SIGMA, min_size): scale
+                     for scale in scales if scale not in _overrun}
+    if not submitted:
+        return np.zeros((0, 4), dtype=np.int64)
 
-        candidates.add(region["rect"])
+    done, pending = wait(submitted, timeout=max(0.0, deadline - time.monotonic()))
+    if not done:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    with _overrun_lock:
+        for future in pending:
+            if not future.cancel():
+                _overrun[submitted[future]] = future
 
-    return candidates
+    rects = [future.result() for future in done]
+    return filter_candidates(np.concatenate(rects) * factor)
@@ -0,0 +1,493 @@
+"""
+File containing tests for the detection and dataset modules
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import h5py
+import numpy as np
+from PIL import Image
+
+import build_dataset
+import selective_search
+from detector import Detector, crop_and_resize, non_max_suppression, resize
+from inference import EPSILON, Classifier, quantize, save
+from input_pipeline import BatchStream, get_statistics, split
+from tracker import Tracker
+
+
+SLOW_SCALE = 800  # scale whose segmentation in slow_segment overruns every time budget
+
+
+def slow_segment(image, scale, sigma, min_size):
+    """
+    Stand-in for selective_search._segment that takes far longer than the
+        time budget at SLOW_SCALE and returns a single rect
+    """
+    time.sleep(3 if scale == SLOW_SCALE else 0.01)
+    return np.array([[0, 0, 10 + scale // 100, 10 + scale // 100]], dtype=np.int64)
+
+
+def write_network(path, kernel_size=3, seed=0):
+    """
+    Write a small random network with two conv and pool stages and two dense
+        layers, in the format of inference.save, and return its layers and
+        parameters
+    """
+    rng = np.random.default_rng(seed)
+    layers = ("conv", "pool", "conv", "pool", "dense", "dense")
+    shapes = ((kernel_size, kernel_size, 3, 4), (kernel_size, kernel_size, 4, 8),
+              (8 * 8 * 8, 16), (16, 6))
+    params = [(rng.normal(0, 1 / np.sqrt(np.prod(shape[:-1])), shape).astype(np.float32),
+               rng.normal(0, 0.1, shape[-1]).astype(np.float32)) for shape in shapes]
+    save(path, layers, params, np.float32(0.5), np.float32(0.25))
+    return layers, params
+
+
+def reference_predict(X, layers, params, mean, std):
+    """
+    Reference for Classifier.predict: run a network layer by layer with
+        explicit loops over pixels, as the tflearn model does, with
+        featurewise std normalization followed by zero centering, "same"
+        zero padding, ReLU after every layer but the last and "same" 2x2
+        max pooling
+    """
+    # pylint: disable=too-many-locals
+    X = X / (std + EPSILON) - mean
+    params = iter(params)
+    for n_left, kind in reversed(list(enumerate(reversed(layers)))):
+        if kind == "pool":
+            n, h, w, c = X.shape
+            out = np.full((n, (h + 1) // 2, (w + 1) // 2, c), -np.inf)
+            for i, j in np.ndindex(h, w):
+                out[:, i // 2, j // 2] = np.maximum(out[:, i // 2, j // 2], X[:, i, j])
+            X = out
+            continue
+        W, b = next(params)
+        if kind == "conv":
+            k = W.shape[0] // 2
+            padded = np.pad(X, ((0, 0), (k, k), (k, k), (0, 0)))
+            X = np.stack([np.stack([np.einsum("nijc,ijcf->nf", padded[:, i:i + W.shape[0],
+                                                                      j:j + W.shape[1]], W)
+                                    for j in range(X.shape[2])], axis=1)
+                          for i in range(X.shape[1])], axis=1) + b
+        else:
+            X = X.reshape(len(X), -1) @ W + b
+        if n_left:
+            X = np.maximum(X, 0)
+    return X
+
+
+def bilinear_crop(image, box, shape):
+    """
+    Reference for crop_and_resize: resize one (x, y, w, h) box of an image
+        to shape pixel by pixel, sampling at the centers of the output pixels
+        and repeating the border pixels of the image
+    """
+    # pylint: disable=too-many-locals
+    x, y, w, h = box
+    out = np.empty((*shape, 3))
+    for i, j in np.ndindex(*shape):
+        center_y = min(max(y + (i + 0.5) * h / shape[0] - 0.5, 0), image.shape[0] - 1)
+        center_x = min(max(x + (j + 0.5) * w / shape[1] - 0.5, 0), image.shape[1] - 1)
+        y0, x0 = int(center_y), int(center_x)
+        y1, x1 = min(y0 + 1, image.shape[0] - 1), min(x0 + 1, image.shape[1] - 1)
+        fy, fx = center_y - y0, center_x - x0
+        out[i, j] = (1 - fy) * ((1 - fx) * image[y0, x0] + fx * image[y0, x1]) + \
+            fy * ((1 - fx) * image[y1, x0] + fx * image[y1, x1])
+    return out / 255
+
+
+def texture(shape, seed=0):
+    """
+    Return a uint8 image of smoothed noise, which has a single clear peak
+        of normalized cross-correlation with any of its patches
+    """
+    noise = np.random.default_rng(seed).normal(size=(shape[0] + 8, shape[1] + 8, 3))
+    for axis in (0, 1):
+        noise = np.apply_along_axis(np.convolve, axis, noise, np.ones(9) / 9, mode="valid")
+    return np.clip(128 + 200 * noise, 0, 255).astype(np.uint8)
+
+
+class TestSelectiveSearch(unittest.TestCase):
+    """
+    Test the selective_search module
+    """
+
+    def test_overrun_does_not_delay_next_frame(self):
+        """
+        Test that a scale that overran its time budget neither delays the
+            following calls nor gets queued again while it is still running
+        """
+        image = np.zeros((64, 64, 3), dtype=np.uint8)
+        selective_search.selective_search(image, time_budget=2, segment=slow_segment)
+
+        for _ in range(5):
+            start = time.monotonic()
+            rects = selective_search.selective_search(image, time_budget=0.5,
+                                                      segment=slow_segment)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(len(rects), 2)
+
+
+class TestDetector(unittest.TestCase):
+    """
+    Test the detector module
+    """
+
+    def test_pyramid_keeps_crop_buffer(self):
+        """
+        Test that resizing pyramid levels matches cropping the whole image and
+            leaves the buffer of the 32x32 crops in place
+        """
+        image = np.random.default_rng(0).integers(0, 256, (96, 128, 3), dtype=np.uint8)
+        for scale in (1.0, 0.5, 0.25):
+            shape = (int(96 * scale), int(128 * scale))
+            expected = crop_and_resize(image, [(0, 0, 128, 96)], shape)[0].copy()
+            crops = crop_and_resize(image, [(0, 0, 32, 32)] * 4)
+            self.assertTrue(np.allclose(resize(image, shape), expected))
+            self.assertIs(crop_and_resize(image, [(0, 0, 32, 32)] * 4).base, crops.base)
+
+
+    def test_crop_matches_reference(self):
+        """
+        Test that crops, including fractional ones and ones past the border
+            of the image, match a reference bilinear resize, and that a crop
+            past the border equals the same crop of the image padded with its
+            border pixels
+        """
+        image = np.random.default_rng(2).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+        boxes = [(0, 0, 50, 40), (5, 3, 16, 16), (10.5, 7.25, 9, 21), (2, 4, 5, 3),
+                 (-6, -4, 20, 16), (40, 30, 20, 24)]
+        crops = crop_and_resize(image, boxes, (12, 12)).copy()
+        for box, crop in zip(boxes, crops):
+            self.assertTrue(np.allclose(crop, bilinear_crop(image, box, (12, 12)), atol=1e-5))
+
+        padded = np.pad(image, ((10, 10), (10, 10), (0, 0)), mode="edge")
+        shifted = [(x + 10, y + 10, w, h) for x, y, w, h in boxes[-2:]]
+        self.assertTrue(np.allclose(crops[-2:], crop_and_resize(padded, shifted, (12, 12))))
+
+        ramp = np.broadcast_to(np.arange(50, dtype=np.uint8)[None, :, None], (40, 50, 3))
+        crop = crop_and_resize(ramp, [(10, 5, 20, 10)], (4, 8))[0]
+        self.assertTrue(np.allclose(crop * 255, (10 + np.arange(8) * 2.5 + 0.75)[None, :, None]))
+
+    def test_nms_suppresses_per_class(self):
+        """
+        Test that boxes only suppress overlapping boxes of their own label,
+            and that voting moves a kept box to the score-weighted mean of
+            its cluster
+        """
+        boxes = [(0, 0, 10, 10), (2, 0, 10, 10), (40, 40, 10, 10)]
+        keep, kept = non_max_suppression(boxes, [0.75, 0.25, 0.5], [1, 1, 1], vote=False)
+        self.assertTrue(np.array_equal(keep, [0, 2]))
+        self.assertTrue(np.array_equal(kept, [boxes[0], boxes[2]]))
+
+        keep, kept = non_max_suppression(boxes, [0.75, 0.25, 0.5], [1, 1, 1])
+        self.assertTrue(np.allclose(kept, [(0.5, 0, 10, 10), boxes[2]]))
+
+        keep, kept = non_max_suppression(boxes, [0.75, 0.25, 0.5], [1, 2, 1])
+        self.assertTrue(np.array_equal(keep, [0, 2, 1]))
+        self.assertTrue(np.array_equal(kept, [boxes[0], boxes[2], boxes[1]]))
+
+    def test_nms_threshold_and_edge_cases(self):
+        """
+        Test that only an overlap above the IoU threshold suppresses a box,
+            that empty input gives an empty intp array of indices and that
+            a cluster of zero scores keeps its box
+        """
+        boxes = [(0, 0, 4, 1), (2, 0, 4, 1)]  # IoU of 2 / 6
+        for threshold, n_kept in ((1 / 3, 2), (0.33, 1)):
+            keep, _ = non_max_suppression(boxes, [0.9, 0.8], [0, 0], iou_threshold=threshold)
+            self.assertEqual(len(keep), n_kept)
+
+        with np.errstate(all="raise"):
+            for vote in (False, True):
+                keep, kept = non_max_suppression(np.zeros((0, 4)), [], [], vote=vote)
+                self.assertEqual(keep.dtype, np.intp)
+                self.assertEqual(keep.shape, (0,))
+                self.assertEqual(kept.shape, (0, 4))
+
+            _, kept = non_max_suppression(boxes, [0.0, 0.0], [0, 0], iou_threshold=0.1)
+            self.assertTrue(np.array_equal(kept, [boxes[0]]))
+
+    def test_dense_matches_crops(self):
+        """
+        Test that every window of predict_dense, shifted or not and up to the
+            borders of the image, scores as predict does on its crop, for a
+            network of 1x1 convolutions whose windows see no neighbouring pixels
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "network.npz")
+            write_network(path, kernel_size=1)
+            classifier = Classifier(path)
+
+        image = np.random.default_rng(1).integers(0, 256, (50, 70, 3), dtype=np.uint8)
+        stride = classifier.stride
+        heatmaps = classifier.predict_dense(image / 255, shifts=2)
+        self.assertEqual(sorted(offset for offset, _ in heatmaps),
+                         [(0, 0), (0, 2), (2, 0), (2, 2)])
+        for (offset_y, offset_x), heatmap in heatmaps:
+            i, j = np.meshgrid(np.arange(heatmap.shape[0]), np.arange(heatmap.shape[1]),
+                               indexing="ij")
+            boxes = np.stack([offset_x + j.ravel() * stride, offset_y + i.ravel() * stride,
+                              np.full(i.size, 32), np.full(i.size, 32)], axis=1)
+            # The last windows end within a stride of the cropped 48x68 image
+            self.assertTrue(68 - stride < boxes[:, 0].max() + 32 <= 68)
+            self.assertTrue(48 - stride < boxes[:, 1].max() + 32 <= 48)
+            expected = classifier.predict(crop_and_resize(image, boxes))
+            self.assertTrue(np.allclose(heatmap.reshape(-1, 6), expected, atol=1e-4))
+
+        # Offsets of shifted poolings whose windows do not fit get empty maps
+        for (offset_y, offset_x), heatmap in classifier.predict_dense(image[:32, :40] / 255, 4):
+            self.assertEqual(heatmap.shape[:2], (max(0, (32 - offset_y - 32) // stride + 1),
+                                                 max(0, (40 - offset_x - 32) // stride + 1)))
+
+        with self.assertRaises(ValueError):
+            classifier.predict_dense(image / 255, shifts=3)
+
+
+class TestInference(unittest.TestCase):
+    """
+    Test the inference module and the Detector built on it
+    """
+
+    def setUp(self):
+        """
+        Write a small random network and a fixed batch of images
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "network.npz")
+        self.layers, self.params = write_network(self.path)
+        self.X = np.random.default_rng(3).random((5, 32, 32, 3), dtype=np.float32)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_export_round_trip(self):
+        """
+        Test that a saved network loads with the same layers, statistics and
+            weights, and that its quantized copy keeps every weight within
+            half a quantization step of the original
+        """
+        classifier = Classifier(self.path)
+        self.assertEqual(classifier.layers, list(self.layers))
+        self.assertEqual((classifier.mean, classifier.std), (0.5, 0.25))
+        self.assertFalse(classifier.quantized)
+        for (W, b), (W_loaded, b_loaded) in zip(self.params, classifier.params):
+            self.assertTrue(np.array_equal(W, W_loaded) and np.array_equal(b, b_loaded))
+            self.assertEqual((W_loaded.dtype, b_loaded.dtype), (np.float32, np.float32))
+
+        quantized_path = os.path.join(self.directory.name, "network_int8.npz")
+        quantize(self.path, quantized_path)
+        quantized = Classifier(quantized_path)
+        self.assertTrue(quantized.quantized)
+        self.assertEqual(quantized.layers, classifier.layers)
+        for (W, b), (W_loaded, b_loaded) in zip(self.params, quantized.params):
+            step = np.abs(W).reshape(-1, W.shape[-1]).max(axis=0) / 127
+            self.assertTrue(np.all(np.abs(W - W_loaded) <= step / 2 + 1e-7))
+            self.assertTrue(np.array_equal(b, b_loaded))
+
+    def test_predict_matches_reference(self):
+        """
+        Test that predict gives the logits of a layer by layer reference
+            implementation on a fixed batch, whatever the batch size
+        """
+        expected = reference_predict(self.X.astype(np.float64), self.layers, self.params,
+                                     0.5, 0.25)
+        classifier = Classifier(self.path)
+        for batch_size in (128, 2):
+            self.assertTrue(np.allclose(classifier.predict(self.X, batch_size), expected,
+                                        atol=1e-4))
+        self.assertEqual(classifier.predict(self.X[:0]).shape, (0, 6))
+
+    def test_detector_workers(self):
+        """
+        Test that a Detector loads its classifier once, on first use, that
+            its workers resolve submitted frames to the results of detect,
+            errors included, and that close stops them
+        """
+        images = [texture((64, 96), seed) for seed in range(4)]
+        with mock.patch("detector.Classifier", wraps=Classifier) as loader:
+            detector = Detector(self.path, n_workers=2, dense=True)
+            self.assertEqual(loader.call_count, 0)
+            futures = [detector.submit(image) for image in images]
+            failed = detector.submit(np.zeros((64, 96)))
+            results = [future.result(timeout=10) for future in futures]
+            with self.assertRaises(ValueError):
+                failed.result(timeout=10)
+            detector.close()
+            self.assertEqual(loader.call_count, 1)
+
+        self.assertEqual(results, [detector.detect(image) for image in images])
+        with self.assertRaises(RuntimeError):
+            detector.submit(images[0])
+
+
+class TestTracker(unittest.TestCase):
+    """
+    Test the tracker module
+    """
+
+    def setUp(self):
+        """
+        Count the calls of a stand-in full detection that finds one box on
+            the first call and another one on every later call
+        """
+        self.n_detections = 0
+
+    def detect(self, image):
+        """
+        Stand-in for Detector.detect
+        """
+        self.n_detections += 1
+        return [(2, 40, 30, 32, 32)] if self.n_detections == 1 else [(1, 0, 0, 10, 10)]
+
+    def test_follows_translation(self):
+        """
+        Test that between keyframes a box follows its content as the image
+            is translated, without running the full detection
+        """
+        image = texture((120, 160))
+        tracker = Tracker(self.detect, detection_interval=5)
+        self.assertEqual(tracker.update(image), [(2, 40, 30, 32, 32)])
+        for dy, dx in ((5, 7), (-3, 12), (20, -10)):
+            shifted = np.roll(image, (dy, dx), axis=(0, 1))
+            self.assertEqual(tracker.update(shifted), [(2, 40 + dx, 30 + dy, 32, 32)])
+        self.assertEqual(tracker.update(image), [(2, 40, 30, 32, 32)])
+        self.assertEqual(self.n_detections, 1)
+
+        self.assertEqual(tracker.update(image), [(1, 0, 0, 10, 10)])
+        self.assertEqual(self.n_detections, 2)
+
+    def test_drops_lost_track(self):
+        """
+        Test that a box whose content disappears matches below the minimum
+            confidence and triggers a full detection before the keyframe
+        """
+        tracker = Tracker(self.detect, detection_interval=5)
+        tracker.update(texture((120, 160)))
+        self.assertEqual(tracker.update(texture((120, 160), seed=1)), [(1, 0, 0, 10, 10)])
+        self.assertEqual(self.n_detections, 2)
+        self.assertEqual(tracker.frames_tracked, 0)
+
+    def test_detector_keyframes(self):
+        """
+        Test that a Detector with a keyframe interval only runs full
+            detection on keyframes, and refuses workers that could reorder
+            its frames
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "network.npz")
+            write_network(path)
+            detector = Detector(path, dense=True, keyframe_interval=3, warm_up=True)
+            with self.assertRaises(ValueError):
+                detector.start(2)
+
+        image = texture((96, 128))
+        expected = detector.detect_dense(image)
+        for _ in range(6):
+            self.assertEqual(detector.detect(image), expected)
+        self.assertEqual(detector._tracker.frames_detected, 2)  # pylint: disable=protected-access
+
+
+class TestInputPipeline(unittest.TestCase):
+    """
+    Test the input_pipeline module
+    """
+
+    def setUp(self):
+        """
+        Write a small dataset with its rows grouped by label, as
+            build_dataset writes them
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "dataset")
+        labels = np.repeat(np.arange(6), [50, 40, 30, 20, 10, 5])
+        X = np.arange(len(labels), dtype=np.float32)[:, None, None, None] * np.ones((1, 4, 4, 3))
+        np.save(f"{self.path}_X.npy", X.astype(np.float32))
+        np.save(f"{self.path}_Y.npy", np.eye(6, dtype=np.float32)[labels])
+        self.labels = labels
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_split_covers_every_label(self):
+        """
+        Test that the split partitions the rows and that every label appears
+            in both the training and the validation rows
+        """
+        train, validation = split(self.path, 0.2)
+        self.assertEqual(len(np.intersect1d(train, validation)), 0)
+        self.assertEqual(len(train) + len(validation), len(self.labels))
+        for rows in (train, validation):
+            self.assertTrue(np.all(np.diff(rows) > 0))
+            self.assertEqual(set(self.labels[rows]), set(self.labels))
+        self.assertTrue(np.array_equal(validation, split(self.path, 0.2)[1]))
+
+    def test_stream_reads_split_rows(self):
+        """
+        Test that an epoch and the statistics cover exactly the given rows
+        """
+        train, _ = split(self.path, 0.2)
+        mean, _ = get_statistics(self.path, train)
+        self.assertAlmostEqual(mean, train.mean(), places=4)
+
+        with BatchStream(self.path, train, 16, augmentation=False) as stream:
+            batches = list(stream.epoch())
+        values = np.concatenate([X[:, 0, 0, 0] for X, _ in batches])
+        labels = np.concatenate([np.argmax(Y, axis=1) for _, Y in batches])
+        self.assertTrue(np.array_equal(np.sort(values), train))
+        self.assertTrue(np.array_equal(labels, self.labels[values.astype(int)]))
+
+
+class TestBuildDataset(unittest.TestCase):
+    """
+    Test the build_dataset module
+    """
+
+    def setUp(self):
+        """
+        Write three small source images in a temporary directory
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "dataset.h5")
+        self.entries = []
+        for label in range(3):
+            image_path = os.path.join(self.directory.name, f"{label}.png")
+            self.write_image(image_path, 50 * label)
+            self.entries.append((image_path, label))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def write_image(path, value):
+        """
+        Write a uniform 40x40 image of the given value to path
+        """
+        Image.fromarray(np.full((40, 40, 3), value, dtype=np.uint8)).save(path)
+
+    def test_skips_unchanged_sources(self):
+        """
+        Test that a rebuild decodes only the sources whose contents changed,
+            rewriting their rows in place and leaving the others as they were
+        """
+        with ThreadPoolExecutor(2) as pool:
+            self.assertEqual(build_dataset.build(self.entries, pool, self.path), 3)
+            self.assertEqual(build_dataset.build(self.entries, pool, self.path), 0)
+
+            self.write_image(self.entries[1][0], 200)
+            self.assertEqual(build_dataset.build(self.entries, pool, self.path), 1)
+
+        with h5py.File(self.path, "r") as h5f:
+            self.assertEqual([p.decode() for p in h5f["paths"][()]], [p for p, _ in self.entries])
+            self.assertTrue(np.allclose(h5f["X"][:, 0, 0, 0], np.array([0, 200, 100]) / 255))
+            self.assertTrue(np.array_equal(np.argmax(h5f["Y"][()], axis=1), [0, 1, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
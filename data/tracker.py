@@ -0,0 +1,105 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+DETECTION_INTERVAL = 5  # run full detection at least once every this many frames
+MIN_TRACK_CONFIDENCE = 0.6  # minimum normalized cross-correlation of a tracked box
+SEARCH_MARGIN = 24  # pixels a box may move between consecutive frames
+TEMPLATE_SIZE = 16  # templates are subsampled to about this many pixels per side
+
+
+def _to_gray(image):
+    """Convert an HxWx3 image to a float32 HxW luminance image.
+    """
+    return image[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _normalize(template):
+    """Shift a template to zero mean and scale it to unit norm.
+    """
+    template = template - template.mean()
+    return template / max(np.linalg.norm(template), 1e-6)
+
+
+def _match(gray, template, box, step, margin=SEARCH_MARGIN):
+    """Find the template in a window around box by normalized cross-correlation,
+    sampling the image every step pixels.
+
+    Returns the new (x, y) of the box and the correlation of the best match.
+    """
+    x, y, w, h = box
+    height, width = gray.shape
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+    region = gray[y0:y1:step, x0:x1:step]
+    if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+        return (x, y), 0.0
+
+    windows = sliding_window_view(region, template.shape)
+    n = template.size
+    sums = windows.sum(axis=(2, 3))
+    energies = np.einsum("abij,abij->ab", windows, windows) - sums ** 2 / n
+    correlations = np.einsum("abij,ij->ab", windows, template) / \
+        np.sqrt(np.maximum(energies, 1e-6))
+
+    i, j = np.unravel_index(np.argmax(correlations), correlations.shape)
+    return (int(x0 + j * step), int(y0 + i * step)), float(correlations[i, j])
+
+
+class Tracker:
+    """Propagate detections between frames by template matching.
+
+    Full detection runs on the first frame, then once every detection_interval
+    frames, and whenever a tracked box matches worse than min_confidence.
+    Other frames only pay for matching the template of each detection in a
+    small window around its last location. detect is the full detection, a
+    function that returns the (label, x, y, w, h) tuples of an image, such
+    as Detector.detect without tracking.
+    """
+
+    def __init__(self, detect, detection_interval=DETECTION_INTERVAL,
+                 min_confidence=MIN_TRACK_CONFIDENCE):
+        self.detect = detect
+        self.detection_interval = detection_interval
+        self.min_confidence = min_confidence
+        self.detections = []
+        self.templates = []
+        self.frames_since_detection = 0
+        self.frames_detected = 0
+        self.frames_tracked = 0
+
+    def __reset(self, image, gray):
+        self.detections = [tuple(int(v) for v in detection) for detection in self.detect(image)]
+        self.templates = []
+        for label, x, y, w, h in self.detections:
+            step = max(1, min(w, h) // TEMPLATE_SIZE)
+            self.templates.append((step, _normalize(gray[y:y + h:step, x:x + w:step]),
+                                   _normalize(gray[y:y + h, x:x + w])))
+        self.frames_since_detection = 0
+        self.frames_detected += 1
+
+    def update(self, image):
+        """Return the detections in the next frame, in the same format as
+        detect_objects: a list of tuples (label, x, y, w, h).
+        """
+        gray = _to_gray(image)
+        if not self.frames_detected or \
+                self.frames_since_detection + 1 >= self.detection_interval:
+            self.__reset(image, gray)
+            return self.detections
+
+        tracked = []
+        for (label, x, y, w, h), (step, coarse, fine) in zip(self.detections, self.templates):
+            # Search the whole window on a coarse grid, then refine around
+            # the best coarse match at full resolution
+            (x, y), confidence = _match(gray, coarse, (x, y, w, h), step)
+            if step > 1 and confidence >= self.min_confidence:
+                (x, y), confidence = _match(gray, fine, (x, y, w, h), 1, step)
+            if confidence < self.min_confidence:
+                self.__reset(image, gray)
+                return self.detections
+            tracked.append((label, x, y, w, h))
+
+        self.detections = tracked
+        self.frames_since_detection += 1
+        self.frames_tracked += 1
+        return self.detections
@@ -2,23 +2,265 @@
 Utility module for getting Portal 2 output
 """
 
+import threading
 import time
+from collections import namedtuple
+
 import numpy as np
 import mss
 
 
-SCT = mss.mss()
+# Size of the game window, matching the launch options in graphics.cfg
+GAME_WIDTH = 640  # pixels
+GAME_HEIGHT = 480  # pixels
+N_BUFFERS = 4  # frames held by a capture ring
+
+# Index in mss.mss().monitors of the monitor that the game window is centered
+# on when no region is given. 1 is the primary monitor; 0 would be the
+# bounding box of all monitors, on which the window is not centered
+GAME_MONITOR = 1
+
+Frame = namedtuple('Frame', ['index', 'timestamp', 'image'])
+Frame.__doc__ = """
+                Data class that represents a single captured frame
+                :param index: int, number of frames captured before this one
+                :param timestamp: float, time.perf_counter() when the frame was
+                    grabbed
+                :param image: m x n x 4 uint8 numpy array of BGRA values, a view
+                    of a ring buffer that is overwritten once the ring wraps
+                """
+
+
+def get_game_region(monitor, width=GAME_WIDTH, height=GAME_HEIGHT):
+    """
+    Get the region of the screen covered by the game window, assuming the
+        game runs windowed and centered on the given monitor, as it does by
+        default. Pass the region explicitly to ScreenSource or get_screenshot
+        when the window has been moved
+    :param monitor: dict with keys left, top, width and height, as in
+        mss.mss().monitors
+    :param width: int, width of the game window
+    :param height: int, height of the game window
+    :return: dict with keys left, top, width and height
+    """
+    return {
+        'left': monitor['left'] + (monitor['width'] - width) // 2,
+        'top': monitor['top'] + (monitor['height'] - height) // 2,
+        'width': width,
+        'height': height
+    }
+
+
+def to_rgb(image):
+    """
+    Get the RGB channels of a BGRA image without copying
+    :param image: m x n x 4 numpy array of BGRA values
+    :return: m x n x 3 numpy array, a view of image with the channels reversed
+    """
+    return image[:, :, 2::-1]
+
+
+class ScreenSource:
+    """
+    Grabs a region of the screen
+    """
+
+    def __init__(self, region=None, monitor=GAME_MONITOR):
+        """
+        Initialize a ScreenSource
+        :param region: dict with keys left, top, width and height, or None to
+            use the game window, assumed to be centered on the given monitor
+        :param monitor: int, index in mss.mss().monitors of the monitor the
+            game window is centered on, used only when region is None
+        """
+        self.__local = threading.local()
+        if region is None:
+            region = get_game_region(self.__sct.monitors[monitor])
+        self.region = region
+        self.shape = (region['height'], region['width'], 4)
+
+    @property
+    def __sct(self):
+        # mss handles are tied to the thread that created them
+        if not hasattr(self.__local, 'sct'):
+            self.__local.sct = mss.mss()
+        return self.__local.sct
+
+    def grab(self, out):
+        """
+        Grab the region into a buffer
+        :param out: numpy array of shape self.shape and dtype uint8
+        :return: True, since the screen always has another frame
+        """
+        shot = self.__sct.grab(self.region)
+        out[...] = np.frombuffer(shot.raw, dtype=np.uint8).reshape(self.shape)
+        return True
+
+
+class FileSource:
+    """
+    Replays frames from a .npy file, standing in for the screen when there
+        is no display, such as in tests
+    """
+
+    def __init__(self, path, fps=None, loop=True):
+        """
+        Initialize a FileSource. The file is memory-mapped, so only the frames
+            that are replayed are read from disk.
+        :param path: path of a .npy file holding a k x m x n x 3 array of RGB
+            frames or a k x m x n x 4 array of BGRA frames, in uint8
+        :param fps: float, rate at which frames are released, or None to
+            release them as fast as they are requested
+        :param loop: bool, whether to restart from the first frame after the
+            last one
+        """
+        self.frames = np.load(path, mmap_mode='r')
+        self.shape = (*self.frames.shape[1:3], 4)
+        self.interval = 1 / fps if fps else 0
+        self.loop = loop
+        self.position = 0
+        self.next_time = time.perf_counter()
+
+    def grab(self, out):
+        """
+        Copy the next frame into a buffer, waiting until it is due
+        :param out: numpy array of shape self.shape and dtype uint8
+        :return: False if the file has no more frames, otherwise True
+        """
+        if self.position == len(self.frames):
+            if not self.loop or not len(self.frames):
+                return False
+            self.position = 0
 
+        delay = self.next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time + self.interval, time.perf_counter())
 
-def get_screenshot():
+        frame = self.frames[self.position]
+        self.position += 1
+        if frame.shape[2] == 4:
+            out[...] = frame
+        else:
+            out[:, :, 2::-1] = frame
+            out[:, :, 3] = 255
+        return True
+
+
+class Capture:
+    """
+    Captures frames from a source on a dedicated thread into a ring of
+        preallocated buffers, so grabbing never allocates and consumers
+        always get the most recent frame without waiting for a grab
+    """
+
+    def __init__(self, source, n_buffers=N_BUFFERS):
+        """
+        Initialize a Capture. Frames are not grabbed until start() is called.
+        :param source: ScreenSource or FileSource
+        :param n_buffers: int, number of frames in the ring. A frame returned
+            by latest() or wait() stays valid until n_buffers - 1 more frames
+            have been captured.
+        """
+        self.source = source
+        self.buffers = np.empty((n_buffers, *source.shape), dtype=np.uint8)
+        self.frame = None
+        self.running = False
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start the capture thread
+        :return: None
+        """
+        if self.__thread is not None:
+            return
+        self.running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the capture thread and wait for it to finish its current grab
+        :return: None
+        """
+        with self.__condition:
+            self.running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        index = 0
+        while self.running:
+            buffer = self.buffers[index % len(self.buffers)]
+            if not self.source.grab(buffer):
+                break
+            frame = Frame(index, time.perf_counter(), buffer)
+            with self.__condition:
+                self.frame = frame
+                self.__condition.notify_all()
+            index += 1
+
+        with self.__condition:
+            self.running = False
+            self.__condition.notify_all()
+
+    def latest(self):
+        """
+        Get the most recently captured frame
+        :return: Frame, or None if no frame has been captured yet
+        """
+        return self.frame
+
+    def wait(self, after=-1, timeout=None):
+        """
+        Wait for a frame newer than the given one
+        :param after: int, index of the last frame seen by the caller
+        :param timeout: float, seconds to wait, or None to wait indefinitely
+        :return: the most recent Frame, or None if no newer frame arrived
+            before the timeout or the capture stopped
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: not self.running or (
+                self.frame is not None and self.frame.index > after), timeout)
+            if self.frame is None or self.frame.index <= after:
+                return None
+            return self.frame
+
+
+_screenshot_sources = {}  # ScreenSource and grab buffer of get_screenshot, keyed by region
+_screenshot_lock = threading.Lock()
+
+
+def get_screenshot(region=None):
     """
     Get a numpy array representing the RGB values of every pixel
-        currently displaying in the window
-    :return: m x n x 3 numpy array, where m is the screen height and
-        n is the screen width
+        currently displaying in the game window. The screen is grabbed by a
+        ScreenSource and into a buffer that are created on the first call
+        for a region and reused by later calls
+    :param region: dict with keys left, top, width and height, or None for
+        the game window centered on monitor GAME_MONITOR
+    :return: m x n x 3 numpy array, where m is the window height and
+        n is the window width. It is a new array owned by the caller
     """
-    img = np.array(SCT.grab(SCT.monitors[0]), dtype=np.uint8)
-    return np.flip(img[:, :, :3], axis=2)
+    key = None if region is None else tuple(sorted(region.items()))
+    with _screenshot_lock:
+        if key not in _screenshot_sources:
+            source = ScreenSource(region)
+            _screenshot_sources[key] = (source, np.empty(source.shape, dtype=np.uint8))
+        source, buffer = _screenshot_sources[key]
+        source.grab(buffer)
+        return np.ascontiguousarray(to_rgb(buffer))
 
 
 def main():
@@ -27,8 +269,17 @@ def main():
     :return: None
     """
     time.sleep(5)
-    img = get_screenshot()
-    print("Game resolution is {}x{}".format(len(img[0]), len(img)))
+    with Capture(ScreenSource()) as capture:
+        first = capture.wait(timeout=1)
+        last = first
+        while last is not None and last.timestamp - first.timestamp < 1:
+            last = capture.wait(last.index, timeout=1)
+
+    if first is None or last is None:
+        print("No frames captured")
+        return
+    print("Game resolution is {}x{}".format(first.image.shape[1], first.image.shape[0]))
+    print("Captured {} frames per second".format(last.index - first.index))
 
 
 if __name__ == "__main__":
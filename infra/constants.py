@@ -3,3 +3,9 @@ Contains constants relevant to Portal 2
 """
 
 JUMP_HEIGHT = 20
+
+# Maximum height the player can walk up without jumping
+STEP_HEIGHT = 18
+
+# Height of the player's eyes above the floor
+EYE_HEIGHT = 64
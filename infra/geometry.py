@@ -0,0 +1,154 @@
+"""
+Batched geometry kernels over convex surfaces, used for planning and
+    portal target selection
+"""
+
+import numpy as np
+
+
+# Maximum number of (query, surface, corner) triples evaluated at once,
+# which bounds the size of the intermediate arrays
+MAX_BATCH_SIZE = 2 ** 20
+
+
+def pack_surfaces(corners, corner_starts, corner_counts):
+    """
+    Returns the given surfaces as a single padded array. Surfaces with
+        fewer corners than the largest one repeat their last corner, which
+        adds only degenerate edges
+    :param corners: 3xn numpy array, where the corners of each surface are
+        consecutive columns ordered by following its perimeter
+    :param corner_starts: m iterable of ints, the first column of each surface
+    :param corner_counts: m iterable of ints, the number of corners of each
+        surface. Requires every count >= 3
+    :return: m x k x 3 numpy array, where k is the largest count
+    """
+    corner_starts = np.asarray(corner_starts, dtype=int).ravel()
+    corner_counts = np.asarray(corner_counts, dtype=int).ravel()
+    if corner_counts.size == 0:
+        return np.zeros((0, 3, 3))
+
+    offsets = np.minimum(np.arange(corner_counts.max()), (corner_counts - 1)[:, np.newaxis])
+    return corners.T[corner_starts[:, np.newaxis] + offsets]
+
+
+def get_normals(surfaces):
+    """
+    Returns the unit normal of every packed surface, computed with Newell's
+        method so that every corner contributes and near-collinear corners
+        do not matter
+    :param surfaces: m x k x 3 numpy array, as returned by pack_surfaces
+    :return: m x 3 numpy array
+    """
+    normals = np.cross(surfaces, np.roll(surfaces, -1, axis=1)).sum(axis=1)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals / np.where(lengths > 0, lengths, 1)
+
+
+def _get_edge_distances(points, surfaces, normals):
+    """
+    Returns the signed distance, within the plane of each surface, from
+        every point to the line through every edge of every surface
+    :param points: n x m x 3 numpy array, one point per query and surface
+    :param surfaces: m x k x 3 numpy array
+    :param normals: m x 3 numpy array
+    :return: n x m x k numpy array
+    """
+    edges = np.roll(surfaces, -1, axis=1) - surfaces
+    lengths = np.linalg.norm(edges, axis=2, keepdims=True)
+    edges = edges / np.where(lengths > 0, lengths, 1)
+    inward = np.cross(normals[:, np.newaxis], edges)
+
+    return np.einsum('mkc,nmkc->nmk', inward, points[:, :, np.newaxis] - surfaces)
+
+
+def _is_inside(edge_distances, tolerance):
+    return np.all(edge_distances >= -tolerance, axis=2) | \
+        np.all(edge_distances <= tolerance, axis=2)
+
+
+def _batches(n_queries, surfaces):
+    batch_size = max(1, MAX_BATCH_SIZE // max(1, surfaces.shape[0] * surfaces.shape[1]))
+    for start in range(0, n_queries, batch_size):
+        yield slice(start, min(start + batch_size, n_queries))
+
+
+def points_on_surfaces(points, surfaces, tolerance=1e-6):
+    """
+    Returns for every point and every surface whether the point lies on the
+        surface, that is within tolerance of its plane and of its interior
+    :param points: 3xn numpy array
+    :param surfaces: m x k x 3 numpy array of convex surfaces, as returned
+        by pack_surfaces
+    :param tolerance: float, in units of distance
+    :return: n x m numpy array of booleans
+    """
+    points = np.asarray(points, dtype=float).T
+    surfaces = np.asarray(surfaces, dtype=float)
+    normals = get_normals(surfaces)
+    on_surfaces = np.zeros((points.shape[0], surfaces.shape[0]), dtype=bool)
+
+    for batch in _batches(points.shape[0], surfaces):
+        batch_points = np.broadcast_to(points[batch, np.newaxis],
+                                       (points[batch].shape[0],) + normals.shape)
+        plane_distances = np.einsum('mc,nmc->nm', normals, batch_points - surfaces[:, 0])
+        on_surfaces[batch] = (np.abs(plane_distances) <= tolerance) & \
+            _is_inside(_get_edge_distances(batch_points, surfaces, normals), tolerance)
+
+    return on_surfaces
+
+
+def intersect_rays(origins, directions, surfaces, tolerance=1e-6):
+    """
+    Returns for every ray and every surface the ray parameter t at which
+        origin + t * direction meets the surface, or infinity if it does
+        not. Rays parallel to a surface never meet it
+    :param origins: 3xn numpy array
+    :param directions: 3xn numpy array, not necessarily normalized
+    :param surfaces: m x k x 3 numpy array of convex surfaces, as returned
+        by pack_surfaces
+    :param tolerance: float, in units of distance, by which a hit may miss
+        the edges of a surface
+    :return: n x m numpy array, with every finite entry >= 0
+    """
+    origins = np.asarray(origins, dtype=float).T
+    directions = np.asarray(directions, dtype=float).T
+    surfaces = np.asarray(surfaces, dtype=float)
+    normals = get_normals(surfaces)
+    parameters = np.full((origins.shape[0], surfaces.shape[0]), np.inf)
+
+    for batch in _batches(origins.shape[0], surfaces):
+        denominators = directions[batch] @ normals.T
+        numerators = np.einsum('mc,nmc->nm', normals,
+                               surfaces[:, 0] - origins[batch, np.newaxis])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = numerators / denominators
+        hits = (np.abs(denominators) > 1e-12) & (t >= 0)
+
+        points = origins[batch, np.newaxis] + np.where(hits, t, 0)[:, :, np.newaxis] * \
+            directions[batch, np.newaxis]
+        hits &= _is_inside(_get_edge_distances(points, surfaces, normals), tolerance)
+        parameters[batch] = np.where(hits, t, np.inf)
+
+    return parameters
+
+
+def cast_rays(origins, directions, surfaces, tolerance=1e-6):
+    """
+    Returns the first surface hit by every ray, and the ray parameter at
+        which it is hit
+    :param origins: 3xn numpy array
+    :param directions: 3xn numpy array
+    :param surfaces: m x k x 3 numpy array, as returned by pack_surfaces
+    :param tolerance: float, see intersect_rays
+    :return: (n numpy array, n numpy array) tuple of surface indices, which
+        are -1 for rays that hit nothing, and ray parameters, which are
+        infinity for rays that hit nothing
+    """
+    parameters = intersect_rays(origins, directions, surfaces, tolerance)
+    if parameters.shape[1] == 0:
+        return np.full(parameters.shape[0], -1), np.full(parameters.shape[0], np.inf)
+
+    first = np.argmin(parameters, axis=1)
+    distances = parameters[np.arange(parameters.shape[0]), first]
+    return np.where(np.isfinite(distances), first, -1), distances
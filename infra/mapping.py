@@ -6,6 +6,10 @@ Implementation of a SLAM algorithm in the context of Portal 2,
 import numpy as np
 
 import utils
+import geometry
+from navigation import NavigationGrid, RoutePlanner
+from mapping_utils import ColumnStore, SpatialHash, SurfaceIndex, linear_sum_assignment
+from state_estimation import PoseFilter
 from abstract_view_observer import ViewObserver
 from abstract_pathfinder import Pathfinder
 
@@ -19,37 +23,225 @@ class Map(ViewObserver, Pathfinder):
 
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self):
+    def __init__(self, anchored=False):
         """
         Initialize an empty Map object
+        :param anchored: boolean. If True, stored observations are kept only
+            in the fixed absolute frame and only the player pose is updated
+            every frame, so that the cost of a frame does not depend on the
+            size of the map. Player-relative positions and orientations are
+            then computed when they are first requested in a frame
         """
         super().__init__()
 
+        self.anchored = anchored
         self.frames_observed = 0
+        self.frames_dropped = 0
         self.time = 0
+        self.residual = 0
+        self.rng = np.random.default_rng(0)
 
-        self.entities = []
-        self.entity_positions = None
-        self.entity_orientations = None
-        self.entity_positions_absolute = None
-        self.entity_orientations_absolute = None
+        self.entity_store = ColumnStore((('position', 3),
+                                         ('orientation', 3),
+                                         ('position_absolute', 3),
+                                         ('orientation_absolute', 3),
+                                         ('type', 1)))
 
-        self.surfaces = []
-        self.surface_positions = None
-        self.surface_orientations = None
-        self.surface_positions_absolute = None
-        self.surface_orientations_absolute = None
+        # Surfaces are only kept in the absolute frame, merged by plane
+        self.surface_index = SurfaceIndex(Map.max_pos_diff, Map.min_or_cos_diff)
 
-        self.references = []
-        self.reference_positions = None
-        self.reference_positions_absolute = None
+        self.reference_store = ColumnStore((('position', 3),
+                                            ('position_absolute', 3),
+                                            ('id', 1)))
+
+        # Spatial hashes over the absolute positions of stored entities and
+        # references, bucketed so that a deduplication query only needs to
+        # visit the neighbouring voxels
+        self.entity_index = SpatialHash(Map.max_pos_diff)
+        self.reference_index = SpatialHash(Map.max_pos_diff)
 
         self.player_position = None
         self.player_orientation = None
         self.player_orientation_update = None
+        self.pose_filter = PoseFilter()
+
+        # Stored absolute positions of the entities and references matched in
+        # the current frame, and the absolute positions at which they were
+        # just observed, as pairs of 3xk arrays
+        self.landmark_matches = []
 
         self.last_observation = None
 
+        self.route_planner = RoutePlanner()
+
+        # Player-relative views computed from absolute values, keyed by
+        # field, along with the frame and store version they are valid for
+        self.__relative_views = {}
+
+    def __relative_view(self, store, name, is_position):
+        """
+        Returns the player-relative values of a field of the given store.
+            When the map is not anchored, these are kept up to date in the
+            store itself. Otherwise they are computed from the absolute
+            values of the field on first use in a frame
+        :param store: ColumnStore
+        :param name: str, name of the relative field in the store; the
+            absolute field is expected to be named name + '_absolute'
+        :param is_position: boolean, True if the field holds positions and
+            False if it holds orientations
+        :return: 3xn numpy array
+        """
+        if not self.anchored:
+            return store[name]
+
+        return self.__to_relative((id(store), name), store[name + '_absolute'], is_position,
+                                  store.version)
+
+    def __to_relative(self, key, values, is_position, version):
+        """
+        Returns the given absolute values relative to the player, computing
+            them only once per frame and version of the values
+        :param key: hashable, identifying the values
+        :param values: 3xn numpy array
+        :param is_position: boolean, True if the values are positions and
+            False if they are orientations
+        :param version: int, changed whenever the values change
+        :return: 3xn numpy array
+        """
+        stamp = (self.frames_observed, version)
+        if key not in self.__relative_views or self.__relative_views[key][0] != stamp:
+            if is_position:
+                values = values - self.player_position.reshape((3, 1))
+            self.__relative_views[key] = (stamp, self.player_orientation_update.T @ values)
+
+        return self.__relative_views[key][1]
+
+    @property
+    def entities(self):
+        """
+        Returns the types of all observed entities, in storage order
+        :return: list of Entity
+        """
+        return [utils.Entity(int(code)) for code in self.entity_store['type'][0]]
+
+    @property
+    def entity_positions(self):
+        """
+        Returns the positions of all observed entities relative to the player
+        :return: 3xn numpy array
+        """
+        return self.__relative_view(self.entity_store, 'position', True)
+
+    @property
+    def entity_orientations(self):
+        """
+        Returns the orientations of all observed entities relative to the player
+        :return: 3xn numpy array
+        """
+        return self.__relative_view(self.entity_store, 'orientation', False)
+
+    @property
+    def entity_positions_absolute(self):
+        """
+        Returns the absolute positions of all observed entities
+        :return: 3xn numpy array
+        """
+        return self.entity_store['position_absolute']
+
+    @property
+    def entity_orientations_absolute(self):
+        """
+        Returns the absolute orientations of all observed entities
+        :return: 3xn numpy array
+        """
+        return self.entity_store['orientation_absolute']
+
+    @property
+    def surfaces(self):
+        """
+        Returns the types of all observed surfaces, after merging, in
+            storage order
+        :return: list of Surface
+        """
+        return [utils.Surface(int(code)) for code in self.surface_index.get_arrays()[2]]
+
+    @property
+    def surface_positions(self):
+        """
+        Returns the corners of all observed surfaces relative to the player,
+            with the corners of each surface in consecutive columns
+        :return: 3xn numpy array
+        """
+        return self.__to_relative('surface_positions', self.surface_positions_absolute, True,
+                                  self.surface_index.version)
+
+    @property
+    def surface_orientations(self):
+        """
+        Returns the orientations of all observed surfaces relative to the player
+        :return: 3xn numpy array
+        """
+        return self.__to_relative('surface_orientations', self.surface_orientations_absolute,
+                                  False, self.surface_index.version)
+
+    @property
+    def surface_positions_absolute(self):
+        """
+        Returns the absolute corners of all observed surfaces, with the
+            corners of each surface in consecutive columns
+        :return: 3xn numpy array
+        """
+        return self.surface_index.get_arrays()[0]
+
+    @property
+    def surface_orientations_absolute(self):
+        """
+        Returns the absolute orientations of all observed surfaces
+        :return: 3xn numpy array
+        """
+        return self.surface_index.get_arrays()[1]
+
+    @property
+    def surface_corner_starts(self):
+        """
+        Returns the index of the first corner of every observed surface in
+            surface_positions and surface_positions_absolute
+        :return: numpy array of ints
+        """
+        return self.surface_index.get_arrays()[3]
+
+    @property
+    def surface_corner_counts(self):
+        """
+        Returns the number of corners of every observed surface
+        :return: numpy array of ints
+        """
+        return self.surface_index.get_arrays()[4]
+
+    @property
+    def references(self):
+        """
+        Returns the ids of all observed references, in storage order
+        :return: list of int
+        """
+        return [int(_id) for _id in self.reference_store['id'][0]]
+
+    @property
+    def reference_positions(self):
+        """
+        Returns the positions of all observed references relative to the player
+        :return: 3xn numpy array
+        """
+        return self.__relative_view(self.reference_store, 'position', True)
+
+    @property
+    def reference_positions_absolute(self):
+        """
+        Returns the absolute positions of all observed references
+        :return: 3xn numpy array
+        """
+        return self.reference_store['position_absolute']
+
     # ------------------- BEGIN VIEWOBSERVER IMPLEMENTATION -------------------
 
     # Maximum magnitude of the difference between two position vectors
@@ -72,6 +264,21 @@ class Map(ViewObserver, Pathfinder):
     # the same object
     min_or_cos_offset = 0.97
 
+    # Weight of an orientation pair relative to a position pair when
+    # fitting a pose, in units of distance
+    orientation_weight = 100
+
+    # Number of random minimal samples tried when fitting a pose
+    ransac_iterations = 50
+
+    # Cost given to pairs of observations that cannot refer to the same
+    # object, large enough that an assignment never prefers them
+    gated_cost = 1e6
+
+    # Maximum distance of a point from a surface for it to be considered
+    # on the surface, to compensate for floating point error
+    surface_tolerance = 1e-3
+
     @staticmethod
     def normalize(arr):
         """
@@ -86,6 +293,20 @@ class Map(ViewObserver, Pathfinder):
 
         return arr / norm
 
+    @staticmethod
+    def normalize_rows(arr):
+        """
+        Returns the given matrix with every row normalized to have magnitude 1
+        :param arr: nx3 numpy array
+        :return: nx3 numpy array
+        """
+        norms = np.linalg.norm(arr, axis=1, keepdims=True)
+
+        if np.any(norms == 0):
+            raise ValueError("Rows cannot be the zero vector")
+
+        return arr / norms
+
     @staticmethod
     def are_positions_close(pos1, pos2, epsilon=max_pos_diff):
         """
@@ -109,100 +330,121 @@ class Map(ViewObserver, Pathfinder):
         return np.dot(Map.normalize(or1), Map.normalize(or2)) >= epsilon
 
     @staticmethod
-    def is_point_on_surface(point, surface):
+    def is_point_on_surface(point, surface, tolerance=surface_tolerance):
         """
-        Returns True if the point is on the surface, otherwise False
+        Returns True if the point is on the surface, otherwise False. To
+            test many points against many surfaces at once, use
+            geometry.points_on_surfaces directly
         :param point: 3D numpy array
         :param surface: 3xn numpy matrix, where the n columns are the corner
             coordinates ordered by following the perimeter in either direction.
             Requires n >= 3 and surface is convex
+        :param tolerance: float, the greatest distance from the surface at
+            which the point is still on it
         :return: boolean
         """
-        surface_plane = surface[:, :3]
-        normal = np.cross(surface_plane[:, 1] - surface_plane[:, 0],
-                          surface_plane[:, 2] - surface_plane[:, 0])
-        is_on_plane = np.dot(point - surface_plane[:, 0], normal) == 0
-
-        if not is_on_plane:
-            return False
-
-        corner_1 = surface[:, 0]
-        corner_2 = surface[:, 1]
-        direction = np.cross(point - corner_1, corner_2 - corner_1)
-
-        for i in range(1, surface.shape[1]):
-            corner_1 = surface[:, i]
-            corner_2 = surface[:, (i + 1) % surface.shape[1]]
-            if np.dot(direction, np.cross(point - corner_1, corner_2 - corner_1)) < 0:
-                return False
-
-        return True
+        surfaces = geometry.pack_surfaces(surface, [0], [surface.shape[1]])
+        return bool(geometry.points_on_surfaces(np.reshape(point, (3, 1)), surfaces,
+                                                tolerance)[0, 0])
 
     @staticmethod
-    def get_single_positional_update_matrices(old, new):
-        """
-        Returns a tuple of two matrices, the first of which
-            is a 3x4 matrix used for updating position, and the
-            second of which is a 3x3 matrix used for updating
-            orientation.
-        :param old: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            where the first entry is a position vector and the second and
-            third entries are orientation vectors
-        :param new: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            with the same specifications
-        :return: (3x4 numpy array, 3x3 numpy array) tuple
-        """
-        old_or_1 = Map.normalize(old[1])
-        old_or_2 = Map.normalize(old[2])
-        new_or_1 = Map.normalize(new[1])
-        new_or_2 = Map.normalize(new[2])
-
-        gamma = np.linalg.inv(np.array([[new_or_1[0], -new_or_1[1]],
-                                        [new_or_2[0], -new_or_2[1]]])) @ \
-                np.array([old_or_1[0], old_or_2[0]])
-        alpha = np.linalg.inv(np.array([[old_or_1[2], -old_or_1[1]],
-                                        [old_or_2[2], -old_or_2[1]]])) @ \
-                np.array([new_or_1[2], new_or_2[2]])
-
-        rotation = np.array([[gamma[0], gamma[1] * alpha[0], gamma[1] * alpha[1]],
-                             [-gamma[1], gamma[0] * alpha[0], gamma[0] * alpha[1]],
-                             [0, -alpha[1], alpha[0]]])
-        translation = np.append(np.identity(3), rotation.transpose() @ new[0] - old[0], axis=1)
-
-        return rotation @ translation, rotation
+    def get_least_squares_update_matrices(old_positions, new_positions,
+                                          old_orientations=None, new_orientations=None):
+        """
+        Returns a tuple of two matrices and a residual, the first of which
+            is a 3x4 matrix used for updating position, the second of which
+            is a 3x3 matrix used for updating orientation, and the third of
+            which is the root mean square position error of the fit.
+        The rotation is the Kabsch/Umeyama least-squares fit over every
+            position pair (about their centroids) and every orientation pair
+        :param old_positions: 3xn numpy array, where the columns are position
+            vectors in the last frame
+        :param new_positions: 3xn numpy array, where the columns are the
+            corresponding position vectors in the current frame
+        :param old_orientations: 3xk numpy array or None, where the columns are
+            orientation vectors in the last frame
+        :param new_orientations: 3xk numpy array or None, where the columns are
+            the corresponding orientation vectors in the current frame
+        :return: (3x4 numpy array, 3x3 numpy array, float) tuple
+        """
+        old_center = old_positions.mean(axis=1, keepdims=True)
+        new_center = new_positions.mean(axis=1, keepdims=True)
+        covariance = (old_positions - old_center) @ (new_positions - new_center).T
+
+        if old_orientations is not None and old_orientations.size:
+            covariance += Map.orientation_weight ** 2 * \
+                          Map.normalize_rows(old_orientations.T).T @ \
+                          Map.normalize_rows(new_orientations.T)
+
+        _u, singular_values, _vt = np.linalg.svd(covariance)
+        if singular_values[1] <= 1e-9 * max(singular_values[0], 1e-9):
+            raise ValueError("Correspondences are degenerate and do not determine a rotation")
+
+        correction = np.diag([1, 1, np.sign(np.linalg.det(_vt.T @ _u.T))])
+        rotation = _vt.T @ correction @ _u.T
+        translation = new_center - rotation @ old_center
+
+        errors = rotation @ old_positions + translation - new_positions
+        residual = np.sqrt(np.mean(np.sum(errors ** 2, axis=0)))
+
+        return np.append(rotation, translation, axis=1), rotation, residual
 
     @staticmethod
-    def get_double_positional_update_matrices(old, new):
-        """
-        Returns a tuple of two matrices, the first of which
-            is a 3x4 matrix used for updating position, and the
-            second of which is a 3x3 matrix used for updating
-            orientation.
-        :param old: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            where the first and second entries are position vectors and the
-            third entry is an orientation vector
-        :param new: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            with the same specifications
-        :return: (3x4 numpy array, 3x3 numpy array) tuple
-        """
-        return Map.get_single_positional_update_matrices((old[0], old[2], old[0] - old[1]),
-                                                         (new[0], new[2], new[0] - new[1]))
+    def get_ransac_update_matrices(old_positions, new_positions,
+                                   old_orientations, new_orientations, rng=None):
+        """
+        Returns the same tuple as get_least_squares_update_matrices, fitted
+            only to the correspondences that agree with the best hypothesis
+            out of ransac_iterations fits on random minimal samples. This
+            discards pairs caused by misclassified or mismatched observations.
+        Correspondences without an orientation (references) have NaN
+            orientation columns
+        :param old_positions: 3xn numpy array
+        :param new_positions: 3xn numpy array
+        :param old_orientations: 3xn numpy array
+        :param new_orientations: 3xn numpy array
+        :param rng: numpy Generator or None
+        :return: (3x4 numpy array, 3x3 numpy array, float) tuple
+        """
+        def fit(indices):
+            oriented = indices[has_orientation[indices]]
+            return Map.get_least_squares_update_matrices(old_positions[:, indices],
+                                                         new_positions[:, indices],
+                                                         old_orientations[:, oriented],
+                                                         new_orientations[:, oriented])
+
+        n_pairs = old_positions.shape[1]
+        has_orientation = ~np.isnan(old_orientations[0])
+        if n_pairs <= 3:
+            return fit(np.arange(n_pairs))
+
+        rng = np.random.default_rng() if rng is None else rng
+        unit_old_orientations = old_orientations / np.linalg.norm(old_orientations, axis=0)
+        unit_new_orientations = new_orientations / np.linalg.norm(new_orientations, axis=0)
+
+        best_inliers = None
+        for _ in range(Map.ransac_iterations):
+            try:
+                position_update, orientation_update, _ = fit(rng.choice(n_pairs, 3, replace=False))
+            except ValueError:
+                continue
+
+            errors = position_update[:, :3] @ old_positions + position_update[:, 3:] - \
+                     new_positions
+            cosines = np.sum((orientation_update @ unit_old_orientations) * unit_new_orientations,
+                             axis=0)
+            inliers = np.nonzero((np.linalg.norm(errors, axis=0) <= Map.max_pos_diff) &
+                                 (~has_orientation | (cosines >= Map.min_or_cos_diff)))[0]
+
+            if best_inliers is None or inliers.size > best_inliers.size:
+                best_inliers = inliers
+                if inliers.size == n_pairs:
+                    break
 
-    @staticmethod
-    def get_triple_positional_update_matrices(old, new):
-        """
-        Returns a tuple of two matrices, the first of which
-            is a 3x4 matrix used for updating position, and the
-            second of which is a 3x3 matrix used for updating
-            orientation.
-        :param old: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            where all entries are position vectors
-        :param new: (3D numpy array, 3D numpy array, 3D numpy array) tuple,
-            with the same specifications
-        :return: (3x4 numpy array, 3x3 numpy array) tuple
-        """
-        return Map.get_single_positional_update_matrices((old[0], old[0] - old[1], old[1] - old[2]),
-                                                         (new[0], new[0] - new[1], new[1] - new[2]))
+        if best_inliers is None or best_inliers.size < 2:
+            raise ValueError("No pose hypothesis is supported by the correspondences")
+
+        return fit(best_inliers)
 
     @staticmethod
     def are_same_entity(entity1, entity2):
@@ -238,41 +480,88 @@ class Map(ViewObserver, Pathfinder):
                                        reference2.position,
                                        epsilon=Map.max_pos_offset)
 
-    def __filter_entities(self, entities):
+    def __filter_entities(self, types, positions, orientations):
+        """
+        Given the types and absolute positions and orientations of observed
+            entities, return the index of the stored entity that each of them
+            matches, or -1 for every entity that is not already in the map.
+            Stored entities are looked up through a spatial hash, so the cost
+            does not grow with the size of the map
+        :param types: n numpy array of Entity values
+        :param positions: 3xn numpy array
+        :param orientations: 3xn numpy array
+        :return: n numpy array of ints
+        """
+        stored_types = self.entity_store['type'][0]
+        stored_positions = self.entity_positions_absolute
+        stored_orientations = self.entity_orientations_absolute
+
+        matches = np.full(len(types), -1)
+        for i in range(len(types)):
+            candidates = self.entity_index.query(positions[:, i], Map.max_pos_diff)
+            if not candidates:
+                continue
+
+            candidates = np.array(candidates)
+            candidates = candidates[stored_types[candidates] == types[i]]
+            offsets = stored_positions[:, candidates] - positions[:, i:i + 1]
+            candidates = candidates[np.linalg.norm(offsets, axis=0) <= Map.max_pos_diff]
+            if candidates.size == 0:
+                continue
+
+            candidate_orientations = stored_orientations[:, candidates]
+            cosines = Map.normalize(orientations[:, i]) @ candidate_orientations / \
+                np.linalg.norm(candidate_orientations, axis=0)
+            if np.max(cosines) >= Map.min_or_cos_diff:
+                matches[i] = candidates[np.argmax(cosines)]
+
+        return matches
+
+    def __filter_references(self, positions):
+        """
+        Given the absolute positions of observed references, return the
+            index of the closest stored reference that each of them matches,
+            or -1 for every reference that is not already in the map
+        :param positions: 3xn numpy array
+        :return: n numpy array of ints
+        """
+        stored_positions = self.reference_positions_absolute
+
+        matches = np.full(positions.shape[1], -1)
+        for i in range(positions.shape[1]):
+            candidates = self.reference_index.query(positions[:, i], Map.max_pos_diff)
+            if candidates:
+                distances = np.linalg.norm(stored_positions[:, candidates] -
+                                           positions[:, i:i + 1], axis=0)
+                if np.min(distances) <= Map.max_pos_diff:
+                    matches[i] = candidates[np.argmin(distances)]
+
+        return matches
+
+    @staticmethod
+    def transform_positions(position_update, positions):
         """
-        Given a list of EntityObservations, return a new list containing
-            all elements of the list that are not already in the map
-        :param entities: list of EntityObservations
-        :return: list of EntityObservation
+        Apply the given position update to every column of positions, in place
+        :param position_update: 3x4 numpy array
+        :param positions: 3xn numpy array
+        :return: None
         """
-        filtered_entities = []
-        for _e in entities:
-            for j in range(len(self.entities)):
-                if _e.entity == self.entities[j] and \
-                        Map.are_positions_close(_e.position, self.entity_positions[:, j]) and \
-                        Map.are_orientations_close(_e.orientation, self.entity_orientations[:, j]):
-                    break
-            else:
-                filtered_entities.append(_e)
+        positions[:] = position_update[:, :3] @ positions + position_update[:, 3:]
 
-        return filtered_entities
-
-    def __filter_references(self, references):
+    def __to_absolute(self, positions, orientations=None):
         """
-        Given a list of ReferenceObservations, return a new list containing
-            all elements of the list that are not already in the map
-        :param references: list of ReferenceObservations
-        :return: list of ReferenceObservations
+        Convert the given player-relative positions, and optionally
+            orientations, to absolute coordinates
+        :param positions: 3xn numpy array
+        :param orientations: 3xn numpy array or None
+        :return: (3xn numpy array, 3xn numpy array or None) tuple
         """
-        filtered_references = []
-        for _r in references:
-            for j in range(len(self.references)):
-                if Map.are_positions_close(_r.position, self.reference_positions[:, j]):
-                    break
-            else:
-                filtered_references.append(_r)
+        absolute_positions = self.player_orientation_update @ positions + \
+                             self.player_position.reshape((3, 1))
+        if orientations is None:
+            return absolute_positions, None
 
-        return filtered_references
+        return absolute_positions, self.player_orientation_update @ orientations
 
     def __update_entities(self, position_update, orientation_update, new_entities):
         """
@@ -283,65 +572,57 @@ class Map(ViewObserver, Pathfinder):
         :param new_entities: iterable of EntityObservations
         :return: None
         """
-        if self.entities:
-            self.entity_positions = \
-                position_update @ \
-                np.vstack([self.entity_positions, np.ones(self.entity_positions.shape[1])])
-            self.entity_orientations = orientation_update @ self.entity_orientations
-
-        new_entities = self.__filter_entities(new_entities)
-
-        for entity in new_entities:
-            entity_absolute_position = (self.player_orientation_update @ entity.position +
-                                        self.player_position).reshape((3, 1))
-            entity_absolute_orientation = (self.player_orientation_update @
-                                           entity.orientation).reshape((3, 1))
-            if self.entities:
-                np.append(self.entity_positions, entity.position.reshape((3, 1)), axis=1)
-                np.append(self.entity_orientations, entity.orientation.reshape((3, 1)), axis=1)
-                np.append(self.entity_positions_absolute, entity_absolute_position, axis=1)
-                np.append(self.entity_orientations_absolute, entity_absolute_orientation, axis=1)
-            else:
-                self.entity_positions = entity.position.reshape((3, 1))
-                self.entity_orientations = entity.orientation.reshape((3, 1))
-                self.entity_positions_absolute = entity_absolute_position
-                self.entity_orientations_absolute = entity_absolute_orientation
-            self.entities.append(entity.entity)
-
-    def __update_surfaces(self, position_update, orientation_update, new_surfaces):
-        """
-        Update the positions and orientations of all observed surfaces, and
-            append the given new surfaces to them
-        TODO: figure out embedded surfaces
-        :param position_update: 3x4 numpy array
-        :param orientation_update: 3x3 numpy array
+        if self.entity_store and not self.anchored:
+            Map.transform_positions(position_update, self.entity_positions)
+            self.entity_orientations[:] = orientation_update @ self.entity_orientations
+
+        new_entities = list(new_entities)
+        if not new_entities:
+            return
+
+        types = np.array([entity.entity.value for entity in new_entities])
+        positions = np.array([entity.position for entity in new_entities], dtype=float).T
+        orientations = np.array([entity.orientation for entity in new_entities], dtype=float).T
+        absolute_positions, absolute_orientations = self.__to_absolute(positions, orientations)
+
+        matches = self.__filter_entities(types, absolute_positions, absolute_orientations)
+        self.landmark_matches.append((self.entity_positions_absolute[:, matches[matches >= 0]],
+                                      absolute_positions[:, matches >= 0]))
+
+        is_new = matches < 0
+        if not np.any(is_new):
+            return
+
+        indices = self.entity_store.extend(position=positions[:, is_new],
+                                           orientation=orientations[:, is_new],
+                                           position_absolute=absolute_positions[:, is_new],
+                                           orientation_absolute=absolute_orientations[:, is_new],
+                                           type=types[is_new])
+        self.entity_index.extend(indices, absolute_positions[:, is_new])
+
+    def __update_surfaces(self, new_surfaces):
+        """
+        Insert the given new surfaces into the surface index, where they are
+            merged with the stored surfaces they overlap in the same plane.
+            Surfaces are kept only in the absolute frame, so this must be
+            called after the player pose of the frame is final
         :param new_surfaces: iterable of SurfaceObservations
         :return: None
         """
-        if self.surfaces:
-            self.surface_positions = \
-                position_update @ \
-                np.vstack([self.surface_positions, np.ones(self.surface_positions.shape[1])])
-            self.surface_orientations = orientation_update @ self.surface_orientations
-
-        for surface in new_surfaces:
-            surface_absolute_position = np.append(np.identity(3),
-                                                  self.player_position.reshape(3, 1), axis=1) @ \
-                                        np.vstack([self.player_orientation_update @ surface.corners,
-                                                   np.ones(surface.corners.shape[1])])
-            surface_absolute_orientation = (self.player_orientation_update @
-                                            surface.orientation).reshape((3, 1))
-            if self.surfaces:
-                np.append(self.surface_positions, surface.corners, axis=1)
-                np.append(self.surface_orientations, surface.orientation.reshape((3, 1)), axis=1)
-                np.append(self.surface_positions_absolute, surface_absolute_position, axis=1)
-                np.append(self.surface_orientations_absolute, surface_absolute_orientation, axis=1)
-            else:
-                self.surface_positions = surface.corners
-                self.surface_orientations = surface.orientation.reshape((3, 1))
-                self.surface_positions_absolute = surface_absolute_position
-                self.surface_orientations_absolute = surface_absolute_orientation
-            self.surfaces.append(surface.surface)
+        new_surfaces = list(new_surfaces)
+        if not new_surfaces:
+            return
+
+        corners = np.hstack([surface.corners for surface in new_surfaces]).astype(float)
+        orientations = np.array([surface.orientation for surface in new_surfaces], dtype=float).T
+        absolute_corners, absolute_orientations = self.__to_absolute(corners, orientations)
+
+        start = 0
+        for i, surface in enumerate(new_surfaces):
+            end = start + surface.corners.shape[1]
+            self.surface_index.insert(absolute_corners[:, start:end], absolute_orientations[:, i],
+                                      surface.surface.value)
+            start = end
 
     def __update_references(self, position_update, new_references):
         """
@@ -351,23 +632,30 @@ class Map(ViewObserver, Pathfinder):
         :param new_references: iterable of ReferenceObservations
         :return: None
         """
-        if self.references:
-            self.reference_positions = \
-                position_update @ \
-                np.vstack([self.reference_positions, np.ones(self.reference_positions.shape[1])])
+        if self.reference_store and not self.anchored:
+            Map.transform_positions(position_update, self.reference_positions)
+
+        new_references = list(new_references)
+        if not new_references:
+            return
+
+        positions = np.array([reference.position for reference in new_references], dtype=float).T
+        absolute_positions = self.__to_absolute(positions)[0]
 
-        new_references = self.__filter_references(new_references)
+        matches = self.__filter_references(absolute_positions)
+        self.landmark_matches.append((self.reference_positions_absolute[:, matches[matches >= 0]],
+                                      absolute_positions[:, matches >= 0]))
 
-        for reference in new_references:
-            reference_absolute_position = (self.player_orientation_update @ reference.position +
-                                           self.player_position).reshape((3, 1))
-            if self.references:
-                np.append(self.reference_positions, reference.position.reshape((3, 1)), axis=1)
-                np.append(self.reference_positions_absolute, reference_absolute_position, axis=1)
-            else:
-                self.reference_positions = reference.position.reshape((3, 1))
-                self.reference_positions_absolute = reference_absolute_position
-            self.references.append(reference.id)
+        is_new = matches < 0
+        if not np.any(is_new):
+            return
+
+        indices = self.reference_store.extend(
+            position=positions[:, is_new],
+            position_absolute=absolute_positions[:, is_new],
+            id=[reference.id for reference, new in zip(new_references, is_new) if new]
+        )
+        self.reference_index.extend(indices, absolute_positions[:, is_new])
 
     def __update_player(self, position_update, orientation_update):
         """
@@ -379,65 +667,138 @@ class Map(ViewObserver, Pathfinder):
         :param orientation_update: 3x3 numpy array
         :return: None
         """
-        if not self.player_position:
-            self.player_position = np.array([0, 0, 0])
-            self.player_orientation = np.array([0, 1, 0])
+        if self.player_position is None:
+            self.player_position = np.array([0., 0., 0.])
+            self.player_orientation = np.array([0., 1., 0.])
             self.player_orientation_update = np.identity(3)
         else:
-            self.player_position -= (orientation_update.transpose() @ position_update)[:, 3]
-            self.player_orientation = orientation_update.transpose() @ self.player_orientation
-            self.player_orientation_update = orientation_update.transpose() @ \
-                                             self.player_orientation_update
+            # A point p in the last frame is at orientation_update @ p + t in
+            # the current frame, so the current frame is mapped to absolute
+            # coordinates by composing the inverse update with the last pose
+            self.player_orientation_update = self.player_orientation_update @ \
+                                             orientation_update.transpose()
+            self.player_position = self.player_position - \
+                                   self.player_orientation_update @ position_update[:, 3]
+            self.player_orientation = self.player_orientation_update @ np.array([0., 1., 0.])
+
+    @staticmethod
+    def __assign(cost, is_valid):
+        """
+        Returns the globally optimal one-to-one assignment between the rows
+            and columns of the cost matrix, restricted to valid pairs and
+            ordered from the cheapest pair to the most expensive one
+        :param cost: n x m numpy array
+        :param is_valid: n x m numpy array of booleans
+        :return: (k numpy array, k numpy array) tuple of row and column indices
+        """
+        cost = np.where(is_valid, cost, Map.gated_cost)
+        rows, cols = linear_sum_assignment(cost)
+        is_kept = is_valid[rows, cols]
+        rows, cols = rows[is_kept], cols[is_kept]
+        order = np.argsort(cost[rows, cols], kind='stable')
+
+        return rows[order], cols[order]
 
     def __find_common_entities(self, new_entities):
         """
         Returns a list of 2-tuples of EntityObservations, where the first entry
             of every tuple is an EntityObservation in the last frame that refers
             to the same entity as the second entry in the tuple that is an
-            EntityObservation in the given iterable
+            EntityObservation in the given iterable. Pairs are chosen by a
+            minimum-cost assignment over all candidate pairs that satisfy
+            are_same_entity, and are ordered from the closest match
         :param new_entities: iterable of EntityObservations
         :return: list of (EntityObservation, EntityObservation) tuples
         """
-        pairs = []
-        for prev_observed_entity in self.last_observation[0]:
-            for observed_entity in new_entities:
-                if Map.are_same_entity(prev_observed_entity, observed_entity):
-                    pairs.append((prev_observed_entity, observed_entity))
-                    break
-
-        return pairs
+        old_entities = list(self.last_observation[0])
+        new_entities = list(new_entities)
+        if not old_entities or not new_entities:
+            return []
+
+        old_types = np.array([entity.entity.value for entity in old_entities])
+        new_types = np.array([entity.entity.value for entity in new_entities])
+        old_positions = np.array([entity.position for entity in old_entities], dtype=float)
+        new_positions = np.array([entity.position for entity in new_entities], dtype=float)
+        old_orientations = Map.normalize_rows(np.array([entity.orientation
+                                                        for entity in old_entities], dtype=float))
+        new_orientations = Map.normalize_rows(np.array([entity.orientation
+                                                        for entity in new_entities], dtype=float))
+
+        distances = np.linalg.norm(old_positions[:, np.newaxis] - new_positions, axis=2)
+        cosines = old_orientations @ new_orientations.T
+        is_valid = (old_types[:, np.newaxis] == new_types) & \
+                   (distances <= Map.max_pos_offset) & \
+                   (cosines >= Map.min_or_cos_offset)
+        cost = distances / Map.max_pos_offset + (1 - cosines) / (1 - Map.min_or_cos_offset)
+
+        rows, cols = Map.__assign(cost, is_valid)
+        return [(old_entities[i], new_entities[j]) for i, j in zip(rows, cols)]
 
     def __find_common_references(self, new_references):
         """
         Returns a list of 2-tuples of ReferenceObservations, where the first
             entry of every tuple is a ReferenceObservation in the last frame
             that refers to the same reference as the second entry in the tuple
-            that is a ReferenceObservation in the given iterable
+            that is a ReferenceObservation in the given iterable. Pairs are
+            chosen by a minimum-distance assignment over all candidate pairs
+            that satisfy are_same_references, and are ordered from the
+            closest match
         :param new_references: iterable of ReferenceObservations
         :return: list of (ReferenceObservation, ReferenceObservation) tuples
         """
-        pairs = []
-        for prev_observed_reference in self.last_observation[2]:
-            for observed_reference in new_references:
-                if Map.are_same_references(prev_observed_reference, observed_reference):
-                    pairs.append((prev_observed_reference, observed_reference))
-                    break
+        old_references = list(self.last_observation[2])
+        new_references = list(new_references)
+        if not old_references or not new_references:
+            return []
+
+        old_positions = np.array([reference.position for reference in old_references],
+                                 dtype=float)
+        new_positions = np.array([reference.position for reference in new_references],
+                                 dtype=float)
 
-        return pairs
+        distances = np.linalg.norm(old_positions[:, np.newaxis] - new_positions, axis=2)
+        rows, cols = Map.__assign(distances, distances <= Map.max_pos_offset)
+        return [(old_references[i], new_references[j]) for i, j in zip(rows, cols)]
+
+    def __estimate_update(self, entities, references):
+        """
+        Returns the position update matrix, orientation update matrix, and
+            fit residual that take the last frame to the current one, as
+            given by get_ransac_update_matrices over every entity and
+            reference observed in both frames
+        :param entities: iterable of EntityObservation objects
+        :param references: iterable of ReferenceObservation objects
+        :return: (3x4 numpy array, 3x3 numpy array, float) tuple
+        """
+        pairs = [(old.position, new.position, old.orientation, new.orientation)
+                 for old, new in self.__find_common_entities(entities)] + \
+                [(old.position, new.position, np.full(3, np.nan), np.full(3, np.nan))
+                 for old, new in self.__find_common_references(references)]
+
+        if len(pairs) < 2:
+            raise ValueError("Not enough information given by parameters to update map")
+
+        old_positions, new_positions, old_orientations, new_orientations = \
+            (np.array(column, dtype=float).T for column in zip(*pairs))
+
+        return Map.get_ransac_update_matrices(old_positions, new_positions,
+                                              old_orientations, new_orientations, rng=self.rng)
 
     def add_observation(self, entities, surfaces, references, time):
         """
         Add the given EntityObservations, SurfaceObservations, and
             ReferenceObservations to the map. This method makes the
             assumption that successive calls will be close together
-            (implying bounded offset). The assumption that the player
-            never rotates around the y-axis is also made.
-        For mapping to work, we require that two consecutive frames have
-            in common either:
+            (implying bounded offset).
+        The pose change since the last frame is fitted to every entity and
+            reference observed in both frames, with RANSAC rejecting pairs
+            that disagree. For mapping to work, we require that two
+            consecutive frames have in common either:
                 1. at least two entities
                 2. at least one entity and at least one reference
                 3. at least three references
-            If none of these are satisfied, this method will throw
+            If none of these are satisfied, or the pairs do not determine a
+            pose, the frame is dropped and counted in frames_dropped
         :param entities: iterable of EntityObservation objects
         :param surfaces: iterable of SurfaceObservation objects
         :param references: iterable of ReferenceObservation objects
@@ -451,56 +812,121 @@ class Map(ViewObserver, Pathfinder):
         if not self.last_observation:
             self.__update_player(None, None)
             self.__update_entities(None, None, entities)
-            self.__update_surfaces(None, None, surfaces)
+            self.__update_surfaces(surfaces)
             self.__update_references(None, references)
             self.last_observation = [entities, surfaces, references]
             self.time = time
             return
 
-        e_common = self.__find_common_entities(entities)
-        r_common = self.__find_common_references(references)
-
-        if len(e_common) >= 2:
-            position_update, orientation_update = Map.get_single_positional_update_matrices(
-                (e_common[0][0].position, e_common[0][0].orientation, e_common[1][0].orientation),
-                (e_common[0][1].position, e_common[0][1].orientation, e_common[1][1].orientation)
-            )
-        elif len(e_common) >= 1 and len(r_common) >= 1:
-            position_update, orientation_update = Map.get_double_positional_update_matrices(
-                (e_common[0][0].position, r_common[0][0].position, e_common[0][0].orientation),
-                (e_common[0][1].position, r_common[0][1].position, e_common[0][1].orientation)
-            )
-        elif len(r_common) >= 3:
-            position_update, orientation_update = Map.get_triple_positional_update_matrices(
-                (r_common[0][0].position, r_common[1][0].position, r_common[2][0].position),
-                (r_common[0][1].position, r_common[1][1].position, r_common[2][1].position)
-            )
-        else:
-            raise ValueError("Not enough information given by parameters to update map")
+        try:
+            position_update, orientation_update, self.residual = \
+                self.__estimate_update(entities, references)
+        except ValueError:
+            # Skip the frame but keep the last observation, so that the
+            # next frame is matched against the last frame that was used
+            self.frames_dropped += 1
+            return
 
         self.__update_player(position_update, orientation_update)
+        self.pose_filter.predict(np.linalg.norm(position_update[:, 3]), self.residual)
+
+        first_columns = (len(self.entity_store), len(self.reference_store))
         self.__update_entities(position_update, orientation_update, entities)
-        self.__update_surfaces(position_update, orientation_update, surfaces)
         self.__update_references(position_update, references)
+        self.__correct_player(*first_columns)
+        self.__update_surfaces(surfaces)
 
         self.last_observation = [entities, surfaces, references]
         self.time = time
 
+    def __correct_player(self, first_entity, first_reference):
+        """
+        Correct the player pose with the stored entities and references
+            matched in this frame, and move the columns added in this frame,
+            whose absolute positions and orientations were derived from the
+            uncorrected player pose, along with it.
+        The rotation that registers the matched observations onto their
+            stored positions corrects the player rotation about the player
+            position, and the remaining offsets correct the player position
+        :param first_entity: int, index of the first entity added this frame
+        :param first_reference: int, index of the first reference added
+            this frame
+        :return: None
+        """
+        stored = np.hstack([pair[0] for pair in self.landmark_matches] + [np.zeros((3, 0))])
+        observed = np.hstack([pair[1] for pair in self.landmark_matches] + [np.zeros((3, 0))])
+        self.landmark_matches = []
+
+        pivot = self.player_position.reshape((3, 1))
+        rotation = np.identity(3)
+        if observed.shape[1] >= 3:
+            try:
+                measured = Map.get_least_squares_update_matrices(observed, stored)[1]
+            except ValueError:
+                measured = None
+            if measured is not None:
+                spread = np.sqrt(np.mean(np.sum(
+                    (observed - observed.mean(axis=1, keepdims=True)) ** 2, axis=0)))
+                rotation = PoseFilter.get_rotation(self.pose_filter.correct_orientation(
+                    PoseFilter.get_rotation_vector(measured), spread))
+                observed = rotation @ (observed - pivot) + pivot
+                self.player_orientation_update = rotation @ self.player_orientation_update
+                self.player_orientation = self.player_orientation_update @ np.array([0., 1., 0.])
+
+        corrected_position = self.pose_filter.correct(self.player_position, stored - observed)
+        correction = (corrected_position - self.player_position).reshape((3, 1))
+        self.player_position = corrected_position
+        if not np.any(correction) and np.array_equal(rotation, np.identity(3)):
+            return
+
+        if len(self.entity_store) > first_entity:
+            orientations = self.entity_store['orientation_absolute']
+            orientations[:, first_entity:] = rotation @ orientations[:, first_entity:]
+        for store, index, first in ((self.entity_store, self.entity_index, first_entity),
+                                    (self.reference_store, self.reference_index,
+                                     first_reference)):
+            positions = store['position_absolute']
+            for j in range(first, len(store)):
+                index.remove(j, positions[:, j])
+            positions[:, first:] = rotation @ (positions[:, first:] - pivot) + pivot + correction
+            index.extend(range(first, len(store)), positions[:, first:])
+
     def get_player_position(self, confidence_window=None):
         """
-        Returns the absolute position of the player and the 3D zero vector
+        Returns the absolute position of the player and its per-axis error
+            bounds for the given confidence window, as estimated by the pose
+            filter. The error is the zero vector if confidence_window is None
         :param confidence_window: 0 <= float <= 1 or None
         :return: (3D numpy array, 3D numpy array) tuple
         """
-        return self.player_position, np.zeros(3)
+        return self.player_position, self.pose_filter.get_position_error(confidence_window)
 
     def get_player_orientation(self, confidence_window=None):
         """
-        Returns the absolute orientation of the player and the 3D zero vector
+        Returns the absolute orientation of the player and its per-axis error
+            bounds for the given confidence window, as estimated by the pose
+            filter. The error is the zero vector if confidence_window is None
         :param confidence_window: 0 <= float <= 1 or None
         :return: (3D numpy array, 3D numpy array) tuple
         """
-        return self.player_orientation, np.zeros(3)
+        return self.player_orientation, self.pose_filter.get_orientation_error(confidence_window)
+
+    def is_pose_confident(self, max_position_error, max_orientation_error,
+                          confidence_window=0.95):
+        """
+        Returns True if the player position and orientation are known to
+            within the given errors for the given confidence window, and
+            False otherwise. A Choreographer can use this to skip
+            re-observing before acting
+        :param max_position_error: float
+        :param max_orientation_error: float
+        :param confidence_window: 0 <= float <= 1
+        :return: boolean
+        """
+        return bool(np.all(self.get_player_position(confidence_window)[1] <=
+                           max_position_error) and
+                    np.all(self.get_player_orientation(confidence_window)[1] <=
+                           max_orientation_error))
 
     # ------------------- END VIEWOBSERVER IMPLEMENTATION -------------------
 
@@ -512,12 +938,44 @@ class Map(ViewObserver, Pathfinder):
             false otherwise
         :return: boolean
         """
-        return utils.Entity.Exit in self.entities
+        return bool(np.any(self.entity_store['type'] == utils.Entity.Exit.value))
 
-    def run_pathfinder(self, *args, **kwargs):
+    def get_navigation_grid(self):
         """
-        TODO: implement this
-        :param args: arguments
-        :param kwargs: keyword arguments
-        :return: None
+        Returns a NavigationGrid built from every surface observed so far
+        :return: NavigationGrid
+        """
+        return NavigationGrid.from_surfaces(self.surface_positions_absolute,
+                                            self.surface_orientations_absolute,
+                                            self.surface_corner_starts,
+                                            self.surface_corner_counts)
+
+    def run_pathfinder(self, *args, **kwargs):
         """
+        Plan a route from the player to the goal over the surfaces observed
+            so far, and notify every observer of the resulting Idea. Walking
+            routes are searched incrementally: when the map has changed since
+            the last call, only the parts of the plan affected by the change
+            are repaired. If the goal cannot be walked to, a route that places
+            portals on the portalable surfaces is searched for instead
+        :param args: arguments, the first of which may be the goal position
+            (3D numpy array). It defaults to the position of the exit
+        :param kwargs: keyword arguments, accepting goal in the same way
+        :return: Idea, or None if there is no goal or no route to it
+        """
+        goal = kwargs.get('goal', args[0] if args else None)
+        if goal is None:
+            if not self.is_exit_found():
+                return None
+            goal = self.entity_positions_absolute[:, np.argmax(self.entity_store['type'][0] ==
+                                                               utils.Entity.Exit.value)]
+
+        idea = self.route_planner.plan(self.get_navigation_grid(), self.player_position, goal,
+                                       (self.surface_positions_absolute,
+                                        self.surface_orientations_absolute,
+                                        self.surface_corner_starts, self.surface_corner_counts,
+                                        self.surface_index.get_arrays()[2]))
+        if not idea:
+            return None
+        self.notify_observers(idea)
+        return idea
@@ -2,7 +2,10 @@
 Utility functions and classes for the Map class
 """
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from itertools import product
+
+import numpy as np
 
 
 Observation = namedtuple('Observation', ['entity_observations',
@@ -74,3 +77,692 @@ class EntityInstance:
         :return: boolean
         """
         return self.entity.has_effect() and self.effect is None
+
+
+class ColumnStore:
+    """
+    Growable store that keeps several named fields, each spanning a fixed
+        number of rows, side by side in one contiguous float64 block.
+        Every appended item occupies one column. When the block runs out
+        of columns its capacity is doubled, so appends are amortized O(1)
+    """
+
+    def __init__(self, fields, capacity=16):
+        """
+        Initialize an empty ColumnStore
+        :param fields: iterable of (str, int) tuples, where the first entry
+            is the name of a field and the second entry is the number of
+            rows it spans
+        :param capacity: int, number of columns to preallocate
+        """
+        self.rows = {}
+        n_rows = 0
+        for name, field_rows in fields:
+            self.rows[name] = slice(n_rows, n_rows + field_rows)
+            n_rows += field_rows
+
+        self.data = np.empty((n_rows, max(capacity, 1)))
+        self.size = 0
+
+        # Incremented by every call that adds or assigns columns, so that
+        # values derived from the store can tell when they are stale
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        self.data[self.rows[name], :self.size] = value
+        self.version += 1
+
+    def get(self, name):
+        """
+        Returns a view of the stored columns of the given field. Writing
+            to the view updates the store in place. The view is invalidated
+            by the next call to extend that grows the block
+        :param name: str
+        :return: r x size numpy array, where r is the number of rows of the field
+        """
+        return self.data[self.rows[name], :self.size]
+
+    def reserve(self, capacity):
+        """
+        Grow the block, by repeated doubling, until it holds at least
+            capacity columns
+        :param capacity: int
+        :return: None
+        """
+        new_capacity = self.data.shape[1]
+        if capacity <= new_capacity:
+            return
+
+        while new_capacity < capacity:
+            new_capacity *= 2
+
+        data = np.empty((self.data.shape[0], new_capacity))
+        data[:, :self.size] = self.data[:, :self.size]
+        self.data = data
+
+    def extend(self, **fields):
+        """
+        Append k columns to the store. Every field must be given, either
+            as an r x k numpy array or, if r is 1, as a k-length iterable
+        :param fields: numpy arrays keyed by field name
+        :return: range of the indices of the new columns
+        """
+        if set(fields) != set(self.rows):
+            raise ValueError(f"Expected fields {sorted(self.rows)}, got {sorted(fields)}")
+
+        columns = {}
+        for name, value in fields.items():
+            rows = self.rows[name]
+            columns[name] = np.asarray(value, dtype=float).reshape(rows.stop - rows.start, -1)
+        n_columns = {value.shape[1] for value in columns.values()}
+        if len(n_columns) != 1:
+            raise ValueError("All fields must have the same number of columns")
+        n_columns = n_columns.pop()
+
+        self.reserve(self.size + n_columns)
+        for name, value in columns.items():
+            self.data[self.rows[name], self.size:self.size + n_columns] = value
+        self.size += n_columns
+        self.version += 1
+
+        return range(self.size - n_columns, self.size)
+
+    def append(self, **fields):
+        """
+        Append a single column to the store
+        :param fields: numpy arrays or floats keyed by field name
+        :return: int, the index of the new column
+        """
+        return self.extend(**{name: np.reshape(value, (-1, 1))
+                              for name, value in fields.items()})[0]
+
+
+class SpatialHash:
+    """
+    Uniform voxel hash over 3D points, used to find all stored points
+        near a query point without comparing against every one of them
+    """
+
+    def __init__(self, cell_size):
+        """
+        Initialize an empty SpatialHash
+        :param cell_size: float, edge length of each voxel. Queries are
+            cheapest when this is close to the typical query radius
+        """
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+
+    def __len__(self):
+        return sum(len(cell) for cell in self.cells.values())
+
+    def __key(self, position):
+        return tuple(int(c) for c in np.floor(np.asarray(position) / self.cell_size))
+
+    def insert(self, index, position):
+        """
+        Store the given index at the given position
+        :param index: int
+        :param position: 3D numpy array
+        :return: None
+        """
+        self.cells[self.__key(position)].append(index)
+
+    def remove(self, index, position):
+        """
+        Remove the given index, which must have been stored at the given position
+        :param index: int
+        :param position: 3D numpy array
+        :return: None
+        """
+        key = self.__key(position)
+        self.cells[key].remove(index)
+        if not self.cells[key]:
+            del self.cells[key]
+
+    def extend(self, indices, positions):
+        """
+        Store every given index at the position in the corresponding column
+        :param indices: iterable of ints
+        :param positions: 3xn numpy array
+        :return: None
+        """
+        for index, position in zip(indices, positions.T):
+            self.insert(index, position)
+
+    def query(self, position, radius):
+        """
+        Returns the indices stored in every voxel that intersects the cube of
+            half-width radius around position. This is a superset of the
+            indices within radius of position; callers must check distances
+        :param position: 3D numpy array
+        :param radius: float
+        :return: list of ints
+        """
+        reach = int(np.ceil(radius / self.cell_size))
+        center = self.__key(position)
+        candidates = []
+        for offset in product(range(-reach, reach + 1), repeat=3):
+            key = (center[0] + offset[0], center[1] + offset[1], center[2] + offset[2])
+            if key in self.cells:
+                candidates.extend(self.cells[key])
+
+        return candidates
+
+    def clear(self):
+        """
+        Remove every stored index
+        :return: None
+        """
+        self.cells.clear()
+
+
+def convex_hull(points, tolerance=0.0):
+    """
+    Returns the convex hull of the given 2D points with Andrew's monotone
+        chain algorithm. Corners that are within tolerance of the line
+        through their neighbours are dropped, which simplifies the hull
+    :param points: 2xn numpy array
+    :param tolerance: float, in units of distance
+    :return: 2xk numpy array of hull corners in counterclockwise order
+    """
+    points = np.unique(np.round(np.asarray(points, dtype=float).T, 9), axis=0)
+    if len(points) < 3:
+        return points.T
+
+    def build(ordered):
+        chain = []
+        for point in ordered:
+            while len(chain) >= 2:
+                edge = chain[-1] - chain[-2]
+                length = np.hypot(*edge)
+                offset = point - chain[-2]
+                if edge[0] * offset[1] - edge[1] * offset[0] > tolerance * length:
+                    break
+                chain.pop()
+            chain.append(point)
+        return chain
+
+    lower = build(points)
+    upper = build(points[::-1])
+    return np.array(lower[:-1] + upper[:-1]).T
+
+
+def polygon_area(points):
+    """
+    Returns the area of a simple 2D polygon with the shoelace formula
+    :param points: 2xn numpy array of corners ordered along the perimeter
+    :return: float
+    """
+    if points.shape[1] < 3:
+        return 0.0
+    x, y = points
+    return abs(x[:-1] @ y[1:] - y[:-1] @ x[1:] + x[-1] * y[0] - y[-1] * x[0]) / 2
+
+
+def clip_convex(subject, clip):
+    """
+    Returns the intersection of two convex 2D polygons with the
+        Sutherland-Hodgman algorithm
+    :param subject: 2xn numpy array of corners in counterclockwise order
+    :param clip: 2xm numpy array of corners in counterclockwise order
+    :return: 2xk numpy array of corners, with k = 0 if they do not intersect
+    """
+    output = list(subject.T)
+    for start, end in zip(clip.T, np.roll(clip, -1, axis=1).T):
+        if not output:
+            break
+        edge = end - start
+        inputs, output = output, []
+        sides = [edge[0] * (point[1] - start[1]) - edge[1] * (point[0] - start[0])
+                 for point in inputs]
+        for k, point in enumerate(inputs):
+            previous, previous_side = inputs[k - 1], sides[k - 1]
+            if (sides[k] >= 0) != (previous_side >= 0):
+                weight = previous_side / (previous_side - sides[k])
+                output.append(previous + weight * (point - previous))
+            if sides[k] >= 0:
+                output.append(point)
+    return np.array(output).T.reshape((2, -1))
+
+
+class SurfaceIndex:
+    """
+    Index of convex surfaces keyed by the plane they lie in. A plane is
+        identified by a surface type, a unit normal and a signed offset
+        from the origin. Planes are bucketed by type and quantized normal
+        only, and a surface joins the plane of a neighbouring bucket that
+        its center is closest to, so that noise in the normal, which moves
+        the offset of distant surfaces, does not split a plane. Within a
+        plane, surfaces are indexed by a uniform grid over their 2D
+        bounding boxes, and a surface inserted into the plane is only
+        compared with the surfaces in the grid cells it covers. It is
+        merged with every one of them that it overlaps or touches and whose
+        union with it is convex,
+        replacing them by the convex hull of their union, so the number of
+        stored surfaces grows with the geometry of the chamber rather than
+        with the number of observations. Unions that are not convex, such as
+        L-shaped or U-shaped floors, are kept as several convex surfaces, so
+        that the hull never covers pits or gaps between them
+    """
+
+    def __init__(self, max_distance, min_cos, cell_size=None):
+        """
+        Initialize an empty SurfaceIndex
+        :param max_distance: float, greatest distance between two planes, or
+            between two surfaces of the same plane, for them to be merged
+        :param min_cos: -1 <= float <= 1, smallest cosine of the angle
+            between the normals of two planes for them to be merged
+        :param cell_size: float, edge length of the cells of the grid that
+            indexes the surfaces of every plane, or None for 16 * max_distance
+        """
+        self.max_distance = max_distance
+        self.min_cos = min_cos
+        self.normal_bucket = np.sqrt(2 * (1 - min_cos))
+        self.cell_size = 16 * max_distance if cell_size is None else cell_size
+
+        self.buckets = defaultdict(list)
+        self.planes = []
+        self.polygons = {}
+        self.next_polygon = 0
+
+        # Value given to every surface inserted from now on, kept as the
+        # greatest value over every merged surface
+        self.tag = 0
+
+        # Incremented by every change to the stored surfaces
+        self.version = 0
+        self.__arrays = (None, None)
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def __key(self, surface_type, normal):
+        return (int(surface_type),) + \
+            tuple(int(c) for c in np.floor(normal / self.normal_bucket))
+
+    def __find_plane(self, surface_type, normal, center):
+        """
+        Returns the index of the stored plane closest to the center of a
+            surface, or -1 if no stored plane is close enough to it
+        """
+        key = self.__key(surface_type, normal)
+        best, best_distance = -1, np.inf
+        for step in product((-1, 0, 1), repeat=3):
+            neighbor = (key[0],) + tuple(k + d for k, d in zip(key[1:], step))
+            for i in self.buckets.get(neighbor, ()):
+                plane = self.planes[i]
+                distance = abs(plane['normal'] @ center - plane['offset'])
+                if plane['normal'] @ normal >= self.min_cos and \
+                        distance <= self.max_distance and distance < best_distance:
+                    best, best_distance = i, distance
+
+        return best
+
+    def __cells(self, low, high):
+        """
+        Returns the keys of the grid cells that cover a 2D bounding box
+        :param low: 2D numpy array
+        :param high: 2D numpy array
+        :return: list of (int, int) tuples
+        """
+        first = np.floor(low / self.cell_size).astype(int)
+        last = np.floor(high / self.cell_size).astype(int)
+        return list(product(range(first[0], last[0] + 1), range(first[1], last[1] + 1)))
+
+    def __get_candidates(self, plane, points):
+        """
+        Returns the stored surfaces of a plane whose bounding boxes are
+            within max_distance of the bounding box of a 2D polygon
+        :param plane: dict, an element of self.planes
+        :param points: 2xn numpy array
+        :return: list of ints
+        """
+        low = points.min(axis=1) - self.max_distance
+        high = points.max(axis=1) + self.max_distance
+        candidates = set()
+        for cell in self.__cells(low, high):
+            candidates.update(plane['grid'].get(cell, ()))
+
+        return [i for i in sorted(candidates)
+                if np.all(plane['bounds'][i][0] <= high) and np.all(plane['bounds'][i][1] >= low)]
+
+    def __add_polygon(self, plane_index, points, tag, polygon=None):
+        """
+        Store a 2D polygon in a plane and its grid, under the given
+            identifier or, if it is None, under a new one
+        :return: int, the identifier of the stored surface
+        """
+        plane = self.planes[plane_index]
+        if polygon is None:
+            polygon = self.next_polygon
+            self.next_polygon += 1
+        self.polygons[polygon] = (plane_index, points, tag)
+        plane['polygons'].add(polygon)
+        plane['bounds'][polygon] = (points.min(axis=1), points.max(axis=1))
+        for cell in self.__cells(*plane['bounds'][polygon]):
+            plane['grid'][cell].add(polygon)
+        return polygon
+
+    def __remove_polygon(self, polygon):
+        """
+        Remove a stored surface from its plane and its grid
+        :return: None
+        """
+        plane = self.planes[self.polygons.pop(polygon)[0]]
+        plane['polygons'].remove(polygon)
+        for cell in self.__cells(*plane['bounds'].pop(polygon)):
+            plane['grid'][cell].discard(polygon)
+            if not plane['grid'][cell]:
+                del plane['grid'][cell]
+
+    @staticmethod
+    def __get_basis(normal):
+        """
+        Returns two unit vectors that span the plane with the given normal
+        :param normal: 3D numpy array
+        :return: 2x3 numpy array
+        """
+        helper = np.array([1., 0, 0]) if abs(normal[0]) < 0.9 else np.array([0., 1, 0])
+        first = np.cross(normal, helper)
+        first /= np.linalg.norm(first)
+        return np.array([first, np.cross(normal, first)])
+
+    def __are_separated(self, first, second):
+        """
+        Returns True if a separating axis keeps the given convex 2D polygons
+            more than max_distance apart, and False otherwise
+        :param first: 2xn numpy array
+        :param second: 2xm numpy array
+        :return: boolean
+        """
+        for polygon in (first, second):
+            edges = np.roll(polygon, -1, axis=1) - polygon
+            axes = np.array([edges[1], -edges[0]])
+            lengths = np.linalg.norm(axes, axis=0)
+            axes = axes[:, lengths > 0] / lengths[lengths > 0]
+            first_projections = axes.T @ first
+            second_projections = axes.T @ second
+            gaps = np.maximum(second_projections.min(axis=1) - first_projections.max(axis=1),
+                              first_projections.min(axis=1) - second_projections.max(axis=1))
+            if np.any(gaps > self.max_distance):
+                return True
+
+        return False
+
+    def __contains(self, outer, inner):
+        """
+        Returns True if every corner of a 2D polygon lies inside a convex
+            one, or within max_distance / 10 of it
+        :param outer: 2xn numpy array in counterclockwise order
+        :param inner: 2xm numpy array
+        :return: boolean
+        """
+        edges = np.roll(outer, -1, axis=1) - outer
+        lengths = np.linalg.norm(edges, axis=0)
+        offsets = inner[:, None, :] - outer[:, :, None]
+        sides = edges[0, :, None] * offsets[1] - edges[1, :, None] * offsets[0]
+        return bool(np.all(sides >= -self.max_distance / 10 * lengths[:, None]))
+
+    def __is_union_convex(self, first, second, hull):
+        """
+        Returns True if the convex hull of two convex 2D polygons covers no
+            more than their union does, up to a strip max_distance wide along
+            the smaller polygon, which absorbs noise and small gaps
+        :param first: 2xn numpy array in counterclockwise order
+        :param second: 2xm numpy array in counterclockwise order
+        :param hull: 2xk numpy array, the convex hull of both
+        :return: boolean
+        """
+        union_area = polygon_area(first) + polygon_area(second) - \
+            polygon_area(clip_convex(first, second))
+        diameter = min(np.linalg.norm(polygon[:, :, None] - polygon[:, None, :], axis=0).max()
+                       for polygon in (first, second))
+        return polygon_area(hull) - union_area <= self.max_distance * diameter
+
+    def __refine_plane(self, plane_index, normal, center):
+        """
+        Add a surface to the mean normal and center of a plane, and move the
+            plane, along with the surfaces stored in it, onto them once they
+            have moved noticeably, so that the plane does not keep the noise
+            of the first surface inserted into it
+        :param plane_index: int
+        :param normal: 3D numpy array, the unit normal of the surface
+        :param center: 3D numpy array, the center of the surface
+        :return: None
+        """
+        plane = self.planes[plane_index]
+        plane['normal_sum'] += normal
+        plane['center_sum'] += center
+        plane['count'] += 1
+        mean_normal = plane['normal_sum'] / np.linalg.norm(plane['normal_sum'])
+        mean_offset = mean_normal @ plane['center_sum'] / plane['count']
+        if mean_normal @ plane['normal'] > 1 - 1e-6 and \
+                abs(mean_offset - plane['offset']) < self.max_distance / 100:
+            return
+
+        polygons = [(i, self.get_corners(i), self.polygons[i][2])
+                    for i in sorted(plane['polygons'])]
+        plane['normal'], plane['offset'] = mean_normal, mean_offset
+        plane['basis'] = SurfaceIndex.__get_basis(mean_normal)
+        for i, corners, tag in polygons:
+            self.__remove_polygon(i)
+            self.__add_polygon(plane_index, plane['basis'] @ corners, tag, i)
+        if polygons:
+            self.version += 1
+
+    def insert(self, corners, orientation, surface_type):
+        """
+        Insert a convex surface, merging it with every stored surface of the
+            same type and plane that it overlaps or touches, as long as their
+            union stays convex. A surface that lies within a stored one, as
+            when a known surface is observed again, leaves the index as it is
+        :param corners: 3xn numpy array, ordered by following the perimeter
+        :param orientation: 3D numpy array, the normal the surface faces along
+        :param surface_type: int
+        :return: int, the identifier of the stored surface that now holds it
+        """
+        normal = np.asarray(orientation, dtype=float)
+        normal = normal / np.linalg.norm(normal)
+        center = corners.mean(axis=1)
+
+        plane_index = self.__find_plane(surface_type, normal, center)
+        if plane_index < 0:
+            plane_index = len(self.planes)
+            self.planes.append({'normal': normal, 'offset': normal @ center,
+                                'type': int(surface_type),
+                                'basis': SurfaceIndex.__get_basis(normal), 'polygons': set(),
+                                'bounds': {}, 'grid': defaultdict(set),
+                                'normal_sum': np.zeros(3), 'center_sum': np.zeros(3), 'count': 0,
+                                'key': self.__key(surface_type, normal)})
+            self.buckets[self.planes[plane_index]['key']].append(plane_index)
+        self.__refine_plane(plane_index, normal, center)
+        plane = self.planes[plane_index]
+
+        hull = convex_hull(plane['basis'] @ corners, self.max_distance / 10)
+        candidates = self.__get_candidates(plane, hull)
+        for i in candidates:
+            polygon_points, polygon_tag = self.polygons[i][1:]
+            if self.__contains(polygon_points, hull):
+                self.polygons[i] = (plane_index, polygon_points, max(self.tag, polygon_tag))
+                return i
+
+        tag = self.tag
+        merged = True
+        while merged:
+            merged = False
+            for i in candidates:
+                polygon_points, polygon_tag = self.polygons[i][1:]
+                if self.__are_separated(hull, polygon_points):
+                    continue
+                if self.__contains(polygon_points, hull):
+                    hull = polygon_points
+                elif not self.__contains(hull, polygon_points):
+                    union = convex_hull(np.hstack([hull, polygon_points]), self.max_distance / 10)
+                    if not self.__is_union_convex(hull, polygon_points, union):
+                        continue
+                    hull = union
+                tag = max(tag, polygon_tag)
+                self.__remove_polygon(i)
+                merged = True
+            if merged:
+                candidates = self.__get_candidates(plane, hull)
+
+        self.version += 1
+        return self.__add_polygon(plane_index, hull, tag)
+
+    def get_corners(self, polygon):
+        """
+        Returns the corners of the given stored surface
+        :param polygon: int, an identifier returned by insert
+        :return: 3xn numpy array
+        """
+        plane_index, points = self.polygons[polygon][:2]
+        plane = self.planes[plane_index]
+        return plane['basis'].T @ points + (plane['normal'] * plane['offset']).reshape((3, 1))
+
+    def transform(self, transforms):
+        """
+        Move the stored surfaces with the given tags in place, each by the
+            rotation and translation of its tag. Surfaces are not merged
+            again, and only the planes holding a moved surface are touched.
+            Such a plane is moved onto the mean of the moved normals and
+            centers of its surfaces, and its surfaces are projected onto it,
+            so the part of a move that differs between surfaces sharing a
+            plane is absorbed by the plane
+        :param transforms: dict mapping int tags to (3x3 numpy array,
+            3D numpy array) tuples of a rotation and a translation
+        :return: None
+        """
+        # pylint: disable=too-many-locals
+        moved = sorted({plane_index for plane_index, _, tag in self.polygons.values()
+                        if tag in transforms})
+        for plane_index in moved:
+            plane = self.planes[plane_index]
+            polygons, normals, centers = [], [], []
+            for i in sorted(plane['polygons']):
+                corners, tag = self.get_corners(i), self.polygons[i][2]
+                if tag in transforms:
+                    rotation, translation = transforms[tag]
+                    corners = rotation @ corners + translation.reshape((3, 1))
+                    normals.append(rotation @ plane['normal'])
+                else:
+                    normals.append(plane['normal'])
+                centers.append(corners.mean(axis=1))
+                polygons.append((i, corners, tag))
+
+            normal = np.sum(normals, axis=0)
+            normal /= np.linalg.norm(normal)
+            offset = np.mean(np.array(centers) @ normal)
+            key = self.__key(plane['type'], normal)
+            if key != plane['key']:
+                self.buckets[plane['key']].remove(plane_index)
+                self.buckets[key].append(plane_index)
+                plane['key'] = key
+
+            plane['normal_sum'] = normal * np.linalg.norm(plane['normal_sum'])
+            plane['center_sum'] += normal * (offset * plane['count'] - normal @ plane['center_sum'])
+            plane['normal'], plane['offset'] = normal, offset
+            plane['basis'] = SurfaceIndex.__get_basis(normal)
+            for i, corners, tag in polygons:
+                self.__remove_polygon(i)
+                self.__add_polygon(plane_index, plane['basis'] @ corners, tag, i)
+
+        if moved:
+            self.version += 1
+
+    def get_arrays(self):
+        """
+        Returns every stored surface packed into arrays, which are cached
+            until the stored surfaces change
+        :return: (3xn numpy array, 3xm numpy array, m numpy array,
+            m numpy array, m numpy array) tuple of corners, with the corners
+            of each surface in consecutive columns, unit orientations,
+            types, the index of the first corner of each surface, and the
+            number of corners of each surface
+        """
+        if self.__arrays[0] != self.version:
+            polygons = sorted(self.polygons)
+            corners = [self.get_corners(i) for i in polygons]
+            counts = np.array([c.shape[1] for c in corners], dtype=int)
+            self.__arrays = (self.version, (
+                np.hstack(corners) if corners else np.zeros((3, 0)),
+                np.array([self.planes[self.polygons[i][0]]['normal']
+                          for i in polygons]).T.reshape((3, -1)),
+                np.array([self.planes[self.polygons[i][0]]['type'] for i in polygons], dtype=int),
+                np.cumsum(np.concatenate([[0], counts[:-1]])).astype(int) if polygons else
+                np.zeros(0, dtype=int),
+                counts
+            ))
+
+        return self.__arrays[1]
+
+
+def linear_sum_assignment(cost):
+    """
+    Solve the rectangular linear assignment problem with the Hungarian
+        algorithm (shortest augmenting paths with dual potentials), in
+        O(n^2 m) for an n x m matrix with n <= m. Every row of the smaller
+        dimension is assigned to a distinct column so that the total cost
+        is minimal
+    :param cost: n x m numpy array of finite floats
+    :return: (k numpy array, k numpy array) tuple of row and column indices,
+        where k = min(n, m), sorted by row index
+    """
+    cost = np.asarray(cost, dtype=float)
+    if cost.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n_rows, n_cols = cost.shape
+
+    # Index 0 of the potentials and the column assignment is a sentinel
+    row_potential = np.zeros(n_rows + 1)
+    col_potential = np.zeros(n_cols + 1)
+    assigned_row = np.zeros(n_cols + 1, dtype=int)
+    previous_col = np.zeros(n_cols + 1, dtype=int)
+
+    for row in range(1, n_rows + 1):
+        assigned_row[0] = row
+        col = 0
+        min_slack = np.full(n_cols + 1, np.inf)
+        used = np.zeros(n_cols + 1, dtype=bool)
+
+        while assigned_row[col] != 0:
+            used[col] = True
+            current_row = assigned_row[col]
+            free = ~used
+            free[0] = False
+
+            slack = cost[current_row - 1] - row_potential[current_row] - col_potential[1:]
+            improved = free[1:] & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            previous_col[1:][improved] = col
+
+            free_slack = np.where(free, min_slack, np.inf)
+            next_col = int(np.argmin(free_slack))
+            delta = free_slack[next_col]
+
+            row_potential[assigned_row[used]] += delta
+            col_potential[used] -= delta
+            min_slack[free] -= delta
+            col = next_col
+
+        while col != 0:
+            assigned_row[col] = assigned_row[previous_col[col]]
+            col = previous_col[col]
+
+    cols = np.nonzero(assigned_row[1:])[0]
+    rows = assigned_row[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+
+    order = np.argsort(rows)
+    return rows[order], cols[order]
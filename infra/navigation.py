@@ -0,0 +1,440 @@
+"""
+Provide the NavigationGrid, DStarLite and RoutePlanner classes, used by the
+    Map to plan routes over the surfaces observed so far
+"""
+
+import heapq
+from itertools import count
+
+import numpy as np
+
+import geometry
+from constants import JUMP_HEIGHT, STEP_HEIGHT
+from portal_search import PortalSearch
+from utils import Action, Checkpoint
+
+
+class NavigationGrid:
+    """
+    2.5D grid over the horizontal plane, where every walkable cell holds
+        the height of the highest floor under its center. The z-axis is up.
+        Cells crossed by a wall that is too tall to jump over are blocked
+    """
+
+    # Edge length of a cell, in units of distance
+    cell_size = 16
+
+    # Minimum z-component of the unit orientation of a surface for it to
+    # be considered a floor
+    min_floor_cos = 0.7
+
+    # Additional cost of an edge that requires a jump, in units of distance
+    jump_cost = 32
+
+    # Maximum distance of a cell center from a floor for it to be
+    # considered over the floor, in units of distance
+    tolerance = 1.0
+
+    def __init__(self, cell_size=cell_size):
+        """
+        Initialize an empty NavigationGrid
+        :param cell_size: float
+        """
+        self.cell_size = cell_size
+        self.heights = {}
+        self.blocked = set()
+
+    def get_cell(self, position):
+        """
+        Returns the cell containing the given position
+        :param position: 3D numpy array
+        :return: (int, int) tuple
+        """
+        return int(np.floor(position[0] / self.cell_size)), \
+            int(np.floor(position[1] / self.cell_size))
+
+    def get_position(self, cell):
+        """
+        Returns the position on the floor at the center of the given cell
+        :param cell: (int, int) tuple
+        :return: 3D numpy array
+        """
+        return np.array([(cell[0] + 0.5) * self.cell_size,
+                         (cell[1] + 0.5) * self.cell_size,
+                         self.heights.get(cell, 0)])
+
+    def is_walkable(self, cell):
+        """
+        Returns True if the player can stand in the given cell, and False
+            otherwise
+        :param cell: (int, int) tuple
+        :return: boolean
+        """
+        return cell in self.heights and cell not in self.blocked
+
+    def __cells_in_box(self, low, high):
+        """
+        Returns the cells whose centers lie in the given horizontal bounding
+            box, and those centers
+        :param low: 2D numpy array
+        :param high: 2D numpy array
+        :return: (list of (int, int) tuples, 2xn numpy array) tuple
+        """
+        first = np.floor(low / self.cell_size - 0.5).astype(int) + 1
+        last = np.floor(high / self.cell_size - 0.5).astype(int)
+        if np.any(last < first):
+            return [], np.zeros((2, 0))
+
+        cells_x, cells_y = np.meshgrid(np.arange(first[0], last[0] + 1),
+                                       np.arange(first[1], last[1] + 1), indexing='ij')
+        cells = np.vstack([cells_x.ravel(), cells_y.ravel()])
+        return list(zip(cells[0].tolist(), cells[1].tolist())), (cells + 0.5) * self.cell_size
+
+    def add_floor(self, corners, orientation):
+        """
+        Raise every cell whose center lies over the given floor polygon to
+            the height of the polygon there
+        :param corners: 3xn numpy array, the convex polygon
+        :param orientation: 3D numpy array, with a positive z-component
+        :return: None
+        """
+        cells, centers = self.__cells_in_box(corners[:2].min(axis=1), corners[:2].max(axis=1))
+        if not cells:
+            return
+
+        normal = orientation / np.linalg.norm(orientation)
+        heights = corners[2, 0] - (normal[0] * (centers[0] - corners[0, 0]) +
+                                   normal[1] * (centers[1] - corners[1, 0])) / normal[2]
+
+        surfaces = geometry.pack_surfaces(corners, [0], [corners.shape[1]])
+        inside = geometry.points_on_surfaces(np.vstack([centers, heights]), surfaces,
+                                             NavigationGrid.tolerance)[:, 0]
+
+        for cell, height in zip(np.array(cells)[inside].tolist(), heights[inside]):
+            cell = tuple(cell)
+            self.heights[cell] = max(self.heights.get(cell, -np.inf), height)
+
+    def add_wall(self, corners):
+        """
+        Block every cell within half a cell of the horizontal footprint of
+            the given wall polygon, where the wall reaches higher than a
+            jump from the floor of the cell
+        :param corners: 3xn numpy array, the convex polygon
+        :return: None
+        """
+        footprint = corners[:2]
+        farthest = np.argmax(np.linalg.norm(footprint - footprint[:, :1], axis=0))
+        direction = footprint[:, farthest] - footprint[:, 0]
+        length = np.linalg.norm(direction)
+        if length == 0:
+            return
+        direction /= length
+
+        projections = direction @ (footprint - footprint[:, :1])
+        start = footprint[:, 0] + projections.min() * direction
+        end = footprint[:, 0] + projections.max() * direction
+
+        margin = self.cell_size / 2
+        cells, centers = self.__cells_in_box(np.minimum(start, end) - margin,
+                                             np.maximum(start, end) + margin)
+        if not cells:
+            return
+
+        along = np.clip(direction @ (centers - start[:, np.newaxis]), 0,
+                        np.linalg.norm(end - start))
+        distances = np.linalg.norm(centers - (start[:, np.newaxis] +
+                                              direction[:, np.newaxis] * along), axis=0)
+
+        bottom, top = corners[2].min(), corners[2].max()
+        for cell, distance in zip(cells, distances):
+            floor = self.heights.get(cell)
+            if distance <= margin and floor is not None and \
+                    bottom < floor + JUMP_HEIGHT and top > floor + JUMP_HEIGHT:
+                self.blocked.add(cell)
+
+    @staticmethod
+    def from_surfaces(corners, orientations, corner_starts, corner_counts,
+                      cell_size=cell_size):
+        """
+        Build a NavigationGrid from surfaces stored as in the Map. Floors are
+            rasterized before walls, so that walls can be compared against
+            the floor height of the cells they cross
+        :param corners: 3xn numpy array of absolute corner positions
+        :param orientations: 3xm numpy array of absolute surface orientations
+        :param corner_starts: m numpy array, index of the first corner of
+            every surface
+        :param corner_counts: m numpy array, number of corners of every surface
+        :param cell_size: float
+        :return: NavigationGrid
+        """
+        grid = NavigationGrid(cell_size)
+        normals = orientations / np.linalg.norm(orientations, axis=0)
+        is_floor = normals[2] >= NavigationGrid.min_floor_cos
+        is_wall = np.abs(normals[2]) < NavigationGrid.min_floor_cos
+
+        polygons = [corners[:, int(start):int(start + n_corners)]
+                    for start, n_corners in zip(corner_starts, corner_counts)]
+        for i in np.nonzero(is_floor)[0]:
+            grid.add_floor(polygons[i], normals[:, i])
+        for i in np.nonzero(is_wall)[0]:
+            grid.add_wall(polygons[i])
+
+        return grid
+
+    def neighbors(self, cell):
+        """
+        Returns the 8 cells around the given cell
+        :param cell: (int, int) tuple
+        :return: list of (int, int) tuples
+        """
+        return [(cell[0] + d_x, cell[1] + d_y)
+                for d_x in (-1, 0, 1) for d_y in (-1, 0, 1) if d_x or d_y]
+
+    def cost(self, from_cell, to_cell):
+        """
+        Returns the cost of moving between two neighbouring cells, which is
+            infinite if either cell is not walkable or the step up is higher
+            than a jump
+        :param from_cell: (int, int) tuple
+        :param to_cell: (int, int) tuple
+        :return: float
+        """
+        if not self.is_walkable(from_cell) or not self.is_walkable(to_cell):
+            return np.inf
+
+        rise = self.heights[to_cell] - self.heights[from_cell]
+        if rise > JUMP_HEIGHT:
+            return np.inf
+
+        distance = self.cell_size * np.hypot(to_cell[0] - from_cell[0], to_cell[1] - from_cell[1])
+        return distance + (NavigationGrid.jump_cost if rise > STEP_HEIGHT else 0)
+
+    def needs_jump(self, from_cell, to_cell):
+        """
+        Returns True if moving between the two cells requires a jump
+        :param from_cell: (int, int) tuple
+        :param to_cell: (int, int) tuple
+        :return: boolean
+        """
+        return self.heights[to_cell] - self.heights[from_cell] > STEP_HEIGHT
+
+    def get_changed_cells(self, other):
+        """
+        Returns every cell whose walkability or height differs between this
+            grid and the other
+        :param other: NavigationGrid
+        :return: set of (int, int) tuples
+        """
+        changed = {cell for cell in self.heights.keys() | other.heights.keys()
+                   if self.heights.get(cell) != other.heights.get(cell)}
+        return changed | (self.blocked ^ other.blocked)
+
+    def nearest_walkable(self, cell, max_distance=4):
+        """
+        Returns the walkable cell closest to the given cell within
+            max_distance cells, or None if there is none
+        :param cell: (int, int) tuple
+        :param max_distance: int
+        :return: (int, int) tuple or None
+        """
+        candidates = [(cell[0] + d_x, cell[1] + d_y)
+                      for d_x in range(-max_distance, max_distance + 1)
+                      for d_y in range(-max_distance, max_distance + 1)]
+        candidates = [candidate for candidate in candidates if self.is_walkable(candidate)]
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda c: (c[0] - cell[0]) ** 2 + (c[1] - cell[1]) ** 2)
+
+    def get_idea(self, path):
+        """
+        Returns the Idea that walks the given path of cells, with a
+            Checkpoint wherever the direction of travel changes and a jump
+            before every step that is too high to walk up
+        :param path: list of (int, int) tuples, with at least two cells
+        :return: Idea
+        """
+        idea = []
+        for i in range(1, len(path)):
+            is_last = i == len(path) - 1
+            needs_jump = not is_last and self.needs_jump(path[i], path[i + 1])
+            if not is_last and not needs_jump and \
+                    (path[i][0] - path[i - 1][0], path[i][1] - path[i - 1][1]) == \
+                    (path[i + 1][0] - path[i][0], path[i + 1][1] - path[i][1]):
+                continue
+
+            direction = self.get_position(path[i]) - self.get_position(path[i - 1])
+            direction[2] = 0
+            idea.append(Checkpoint(self.get_position(path[i]),
+                                   direction / np.linalg.norm(direction),
+                                   Action.Jump if needs_jump else None))
+
+        return idea
+
+
+class DStarLite:
+    """
+    Incremental shortest path search (D* Lite) from a moving start cell to
+        a fixed goal cell on a NavigationGrid. Costs are searched backwards
+        from the goal, so when the grid changes only the cells affected by
+        the change are repaired rather than replanning from scratch
+    """
+
+    def __init__(self, grid, start, goal):
+        """
+        Initialize a search on the given grid
+        :param grid: NavigationGrid
+        :param start: (int, int) tuple
+        :param goal: (int, int) tuple
+        """
+        self.grid = grid
+        self.start = start
+        self.last_start = start
+        self.goal = goal
+        self.key_modifier = 0
+
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.queue = []
+        self.queued_keys = {}
+        self.counter = count()
+        self.__push(goal)
+
+    def __heuristic(self, cell_1, cell_2):
+        return self.grid.cell_size * np.hypot(cell_1[0] - cell_2[0], cell_1[1] - cell_2[1])
+
+    def __key(self, cell):
+        value = min(self.g.get(cell, np.inf), self.rhs.get(cell, np.inf))
+        return value + self.__heuristic(self.start, cell) + self.key_modifier, value
+
+    def __push(self, cell):
+        key = self.__key(cell)
+        self.queued_keys[cell] = key
+        heapq.heappush(self.queue, (key, next(self.counter), cell))
+
+    def __drop_stale(self):
+        # Pop entries whose cell was re-queued with another key or removed
+        while self.queue and self.queued_keys.get(self.queue[0][2]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+
+    def __update_cell(self, cell):
+        if cell != self.goal:
+            self.rhs[cell] = min((self.grid.cost(cell, successor) + self.g.get(successor, np.inf)
+                                  for successor in self.grid.neighbors(cell)), default=np.inf)
+
+        self.queued_keys.pop(cell, None)
+        if self.g.get(cell, np.inf) != self.rhs.get(cell, np.inf):
+            self.__push(cell)
+
+    def __compute_shortest_path(self):
+        while True:
+            self.__drop_stale()
+            start_g = self.g.get(self.start, np.inf)
+            start_rhs = self.rhs.get(self.start, np.inf)
+            if not self.queue or (self.queue[0][0] >= self.__key(self.start) and
+                                  start_rhs == start_g):
+                return
+
+            old_key, _, cell = heapq.heappop(self.queue)
+            del self.queued_keys[cell]
+            new_key = self.__key(cell)
+            if old_key < new_key:
+                self.__push(cell)
+            elif self.g.get(cell, np.inf) > self.rhs.get(cell, np.inf):
+                self.g[cell] = self.rhs[cell]
+                for predecessor in self.grid.neighbors(cell):
+                    self.__update_cell(predecessor)
+            else:
+                self.g[cell] = np.inf
+                self.__update_cell(cell)
+                for predecessor in self.grid.neighbors(cell):
+                    self.__update_cell(predecessor)
+
+    def update(self, grid, changed_cells, start):
+        """
+        Replace the grid, repair the costs around the changed cells, and
+            move the start of the search
+        :param grid: NavigationGrid
+        :param changed_cells: iterable of (int, int) tuples
+        :param start: (int, int) tuple
+        :return: None
+        """
+        self.grid = grid
+        self.start = start
+        self.key_modifier += self.__heuristic(self.last_start, start)
+        self.last_start = start
+
+        affected = set()
+        for cell in changed_cells:
+            affected.add(cell)
+            affected.update(self.grid.neighbors(cell))
+        for cell in affected:
+            self.__update_cell(cell)
+
+    def plan(self, max_steps=10000):
+        """
+        Returns the cheapest sequence of cells from the start to the goal,
+            or None if the goal cannot be reached
+        :param max_steps: int, maximum path length
+        :return: list of (int, int) tuples or None
+        """
+        self.__compute_shortest_path()
+        if self.g.get(self.start, np.inf) == np.inf:
+            return None
+
+        path = [self.start]
+        while path[-1] != self.goal and len(path) < max_steps:
+            cell = path[-1]
+            path.append(min(self.grid.neighbors(cell),
+                            key=lambda n, c=cell: self.grid.cost(c, n) + self.g.get(n, np.inf)))
+
+        return path if path[-1] == self.goal else None
+
+
+class RoutePlanner:
+    """
+    Plans routes for the Map over successive NavigationGrids. Walking
+        routes are searched with a DStarLite that is repaired, rather than
+        restarted, while the goal stays the same. When the goal cannot be
+        walked to, a route that places portals is searched for instead
+    """
+
+    def __init__(self):
+        """
+        Initialize a RoutePlanner with no search in progress
+        """
+        self.grid = None
+        self.planner = None
+        self.portal_search = PortalSearch()
+
+    def plan(self, grid, start, goal, surfaces):
+        """
+        Returns a route from start to goal on the given grid
+        :param grid: NavigationGrid
+        :param start: 3D numpy array, the player position
+        :param goal: 3D numpy array
+        :param surfaces: (corners, orientations, corner_starts, corner_counts,
+            types) tuple of the surfaces grid was built from, as taken by
+            PortalSearch.update_table
+        :return: Idea, or None if there is no route to the goal
+        """
+        start = grid.nearest_walkable(grid.get_cell(start))
+        goal = grid.nearest_walkable(grid.get_cell(goal))
+        if start is None or goal is None:
+            return None
+
+        if self.planner is None or self.planner.goal != goal:
+            self.planner = DStarLite(grid, start, goal)
+        else:
+            self.planner.update(grid, grid.get_changed_cells(self.grid), start)
+        self.grid = grid
+
+        path = self.planner.plan()
+        if path is not None:
+            return grid.get_idea(path)
+
+        self.portal_search.update_table(grid, *surfaces)
+        steps = self.portal_search.search(grid, start, goal)
+        if steps is None:
+            return None
+        return self.portal_search.get_idea(grid, start, steps)
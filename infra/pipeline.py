@@ -0,0 +1,263 @@
+"""
+Provide the Pipeline class, which overlaps the stages of perception, such
+    as capturing a frame, detecting objects in it and adding the resulting
+    observation to a Map, by running every stage on its own thread
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class StageQueue:
+    """
+    Bounded queue between two stages of a Pipeline. When it is full, put
+        either drops the oldest item, so that the next stage always works
+        on the freshest frames, or blocks, applying back-pressure to the
+        previous stage
+    """
+
+    def __init__(self, size, drop_stale):
+        """
+        Initialize an empty, open StageQueue
+        :param size: int, maximum number of items held
+        :param drop_stale: bool, whether a full queue drops its oldest item
+            instead of blocking
+        """
+        self.size = size
+        self.drop_stale = drop_stale
+        self.items = deque()
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        """
+        Add an item to the queue
+        :param item: any object
+        :return: False if the queue was closed, otherwise True
+        """
+        with self.condition:
+            if not self.drop_stale:
+                self.condition.wait_for(lambda: self.closed or len(self.items) < self.size)
+            if self.closed:
+                return False
+            if len(self.items) >= self.size:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """
+        Remove the oldest item from the queue, waiting until there is one
+        :return: the item, or None once the queue is closed and empty
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.items)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self, discard=False):
+        """
+        Close the queue, so that put fails and get returns None once the
+            remaining items are consumed
+        :param discard: bool, whether to drop the remaining items
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.condition.notify_all()
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages concurrently, each on its own
+        thread, connected by bounded StageQueues. Every stage works on a
+        different frame at the same time, so throughput is set by the
+        slowest stage rather than by the sum of all of them. For example:
+            Pipeline(get_screenshot, [('detect', detect), ('map', add_to_map)])
+        Frames older than max_age when a stage takes them are dropped, and
+        so are frames pushed out of a full queue when drop_stale is set
+    """
+
+    # Number of most recent frames kept for the latency statistics
+    history = 1000
+
+    def __init__(self, source, stages, queue_size=1, drop_stale=True, max_age=None):
+        """
+        Initialize a Pipeline. Nothing runs until start is called
+        :param source: function with no arguments that returns the next
+            frame, or None when there are no more frames
+        :param stages: list of (name, function) tuples, where every function
+            takes the output of the previous stage, or the frame for the
+            first stage, and returns its own output
+        :param queue_size: int, number of items each queue between two
+            stages can hold
+        :param drop_stale: bool, whether a full queue drops its oldest item
+            instead of making the previous stage wait
+        :param max_age: float, largest time in seconds since capture at which
+            a stage still starts on a frame, or None for no limit
+        """
+        self.source = source
+        self.stages = list(stages)
+        self.max_age = max_age
+        self.queues = [StageQueue(queue_size, drop_stale) for _ in self.stages]
+        self.latest = None
+        self.error = None
+
+        self.lock = threading.Lock()
+        self.service_times = {name: deque(maxlen=Pipeline.history) for name, _ in self.stages}
+        self.expired = {name: 0 for name, _ in self.stages}
+        self.latencies = deque(maxlen=Pipeline.history)
+        self.completion_times = deque(maxlen=Pipeline.history)
+        self.n_captured = 0
+        self.n_completed = 0
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Spawn the source thread and one daemon thread per stage
+        :return: None
+        """
+        if self.threads:
+            return
+        self.threads = [threading.Thread(target=self.__run_source, daemon=True)]
+        self.threads += [threading.Thread(target=self.__run_stage, args=(i,), daemon=True)
+                         for i in range(len(self.stages))]
+        for thread in self.threads:
+            thread.start()
+
+    def join(self, timeout=None):
+        """
+        Wait until every frame of the source has passed through every stage
+        :param timeout: float, seconds to wait, or None to wait indefinitely
+        :return: True if the pipeline finished, otherwise False
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.perf_counter()))
+            if thread.is_alive():
+                return False
+        self.threads = []
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def stop(self):
+        """
+        Stop every thread, discarding frames still in the queues, and wait
+            for the frames being processed to finish
+        :return: None
+        """
+        for queue in self.queues:
+            queue.close(discard=True)
+        self.join()
+
+    def __fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        for queue in self.queues:
+            queue.close(discard=True)
+
+    def __run_source(self):
+        try:
+            while True:
+                frame = self.source()
+                if frame is None or not self.queues[0].put((time.perf_counter(), frame)):
+                    break
+                with self.lock:
+                    self.n_captured += 1
+        except Exception as error:  # pylint: disable=broad-except
+            self.__fail(error)
+        self.queues[0].close()
+
+    def __run_stage(self, index):
+        name, function = self.stages[index]
+        is_last = index == len(self.stages) - 1
+        try:
+            while True:
+                item = self.queues[index].get()
+                if item is None:
+                    break
+                captured, value = item
+                if self.max_age is not None and \
+                        time.perf_counter() - captured > self.max_age:
+                    with self.lock:
+                        self.expired[name] += 1
+                    continue
+
+                start = time.perf_counter()
+                value = function(value)
+                end = time.perf_counter()
+                with self.lock:
+                    self.service_times[name].append(end - start)
+                    if is_last:
+                        self.latest = value
+                        self.latencies.append(end - captured)
+                        self.completion_times.append(end)
+                        self.n_completed += 1
+                if not is_last and not self.queues[index + 1].put((captured, value)):
+                    break
+        except Exception as error:  # pylint: disable=broad-except
+            self.__fail(error)
+        if not is_last:
+            self.queues[index + 1].close()
+
+    @staticmethod
+    def summarize(samples):
+        """
+        Returns summary statistics of a sequence of durations
+        :param samples: iterable of floats, in seconds
+        :return: dict with keys count, mean, p50, p95 and max, in seconds,
+            which are all 0 if there are no samples
+        """
+        samples = np.array(samples, dtype=float)
+        if not len(samples):
+            return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {'count': len(samples), 'mean': float(samples.mean()),
+                'p50': float(np.percentile(samples, 50)),
+                'p95': float(np.percentile(samples, 95)), 'max': float(samples.max())}
+
+    def get_stats(self):
+        """
+        Returns latency statistics over the most recent frames
+        :return: dict with an entry per stage name, holding the summary of the
+            time spent in the stage (see summarize) with the additional keys
+            dropped, the number of its input frames pushed out of a full
+            queue, and expired, the number that were older than max_age.
+            The entry 'total' summarizes the time from capture to the end of
+            the last stage, with the additional keys captured, completed and
+            throughput, in frames per second
+        """
+        with self.lock:
+            stats = {}
+            for (name, _), queue in zip(self.stages, self.queues):
+                stats[name] = Pipeline.summarize(self.service_times[name])
+                stats[name]['dropped'] = queue.dropped
+                stats[name]['expired'] = self.expired[name]
+
+            stats['total'] = Pipeline.summarize(self.latencies)
+            stats['total']['captured'] = self.n_captured
+            stats['total']['completed'] = self.n_completed
+            elapsed = self.completion_times[-1] - self.completion_times[0] \
+                if len(self.completion_times) > 1 else 0
+            stats['total']['throughput'] = \
+                (len(self.completion_times) - 1) / elapsed if elapsed > 0 else 0.0
+            return stats
@@ -0,0 +1,213 @@
+"""
+Provide the PortalSearch class, used by the Map to plan routes that
+    require placing portals
+"""
+
+import heapq
+from itertools import count
+
+import numpy as np
+
+import geometry
+from constants import EYE_HEIGHT
+from utils import Action, Checkpoint, Surface
+
+
+class PortalSearch:
+    """
+    Best-first search over states made of a navigation grid cell and the
+        portalable surfaces currently holding each portal. Which surfaces
+        can be shot from which cells, and where each portal is entered and
+        left, is precomputed into a table that is cached until the observed
+        surfaces change, since it dominates the cost of a search
+    """
+
+    # Cost of shooting a portal, in units of distance
+    portal_cost = 64
+
+    # Cost of walking through a portal, in units of distance
+    teleport_cost = 16
+
+    # Maximum height of the center of a portal above the floor in front
+    # of it for the player to walk into it
+    max_entry_height = 72
+
+    # Maximum number of states expanded in one search
+    max_expansions = 200000
+
+    def __init__(self):
+        """
+        Initialize a PortalSearch with an empty table
+        """
+        self.table_key = None
+        self.centers = np.zeros((3, 0))
+        self.normals = np.zeros((3, 0))
+        self.entry_cells = []
+        self.exit_cells = []
+        self.visible_from = []
+
+    def __len__(self):
+        return len(self.visible_from)
+
+    def update_table(self, grid, corners, orientations, corner_starts, corner_counts, types):
+        """
+        Recompute the visibility and reachability table if the surfaces
+            differ from those it was computed from
+        :param grid: NavigationGrid built from the same surfaces
+        :param corners: 3xn numpy array of absolute corner positions
+        :param orientations: 3xm numpy array of absolute surface orientations
+        :param corner_starts: m numpy array
+        :param corner_counts: m numpy array
+        :param types: m numpy array of Surface values
+        :return: boolean, True if the table was recomputed
+        """
+        # pylint: disable=too-many-arguments,too-many-locals
+        key = hash((corners.tobytes(), orientations.tobytes(), np.asarray(types).tobytes()))
+        if key == self.table_key:
+            return False
+        self.table_key = key
+
+        surfaces = geometry.pack_surfaces(corners, corner_starts, corner_counts)
+        normals = orientations / np.linalg.norm(orientations, axis=0)
+        portalable = np.nonzero(np.asarray(types) == Surface.P.value)[0]
+
+        cells = [cell for cell in grid.heights if grid.is_walkable(cell)]
+        eyes = np.array([grid.get_position(cell) for cell in cells]).T.reshape((3, -1)) + \
+            np.array([[0], [0], [EYE_HEIGHT]])
+
+        self.centers = np.array([corners[:, int(corner_starts[i]):
+                                         int(corner_starts[i] + corner_counts[i])].mean(axis=1)
+                                 for i in portalable]).T.reshape((3, -1))
+        self.normals = normals[:, portalable]
+        self.entry_cells = []
+        self.exit_cells = []
+        self.visible_from = []
+        for k, i in enumerate(portalable):
+            center, normal = self.centers[:, k], self.normals[:, k]
+
+            facing = normal @ (eyes - center.reshape((3, 1))) > 0
+            hits = geometry.intersect_rays(eyes[:, facing], center.reshape((3, 1)) -
+                                           eyes[:, facing], surfaces)
+            hits[:, i] = np.inf
+            visible = facing.copy()
+            visible[facing] = ~np.any((hits > 1e-6) & (hits < 1 - 1e-6), axis=1)
+            self.visible_from.append({cell for cell, seen in zip(cells, visible) if seen})
+
+            front = grid.nearest_walkable(grid.get_cell(center + normal * grid.cell_size), 1)
+            if front is not None and \
+                    0 <= center[2] - grid.heights[front] <= PortalSearch.max_entry_height:
+                self.entry_cells.append(front)
+            else:
+                self.entry_cells.append(None)
+            self.exit_cells.append(front)
+
+        return True
+
+    def search(self, grid, start, goal):
+        """
+        Returns the cheapest found sequence of steps from the start cell to
+            the goal cell, or None if the goal was not reached. Every step
+            is a tuple whose first entry is 'walk' followed by the cell
+            walked to, 'portal' followed by the Action, the index of the
+            portalable surface and the cell shot from, or 'teleport'
+            followed by the portal entered and the cell left from
+        :param grid: NavigationGrid
+        :param start: (int, int) tuple
+        :param goal: (int, int) tuple
+        :return: list of tuples or None
+        """
+        def heuristic(cell):
+            return grid.cell_size * np.hypot(cell[0] - goal[0], cell[1] - goal[1])
+
+        start_state = (start, -1, -1)
+        costs = {start_state: 0}
+        parents = {start_state: None}
+        counter = count()
+        queue = [(heuristic(start), next(counter), start_state)]
+
+        for _ in range(PortalSearch.max_expansions):
+            if not queue:
+                return None
+            _, _, state = heapq.heappop(queue)
+            if state[0] == goal:
+                return self.__get_steps(state, parents)
+
+            for next_state, cost, step in self.__successors(grid, state):
+                new_cost = costs[state] + cost
+                if new_cost < costs.get(next_state, np.inf):
+                    costs[next_state] = new_cost
+                    parents[next_state] = (state, step)
+                    heapq.heappush(queue, (new_cost + heuristic(next_state[0]),
+                                           next(counter), next_state))
+
+        return None
+
+    def __successors(self, grid, state):
+        """
+        Yields (state, cost, step) tuples for every state reachable from
+            the given one in a single step
+        """
+        cell, portal_1, portal_2 = state
+        for neighbor in grid.neighbors(cell):
+            cost = grid.cost(cell, neighbor)
+            if cost < np.inf:
+                yield (neighbor, portal_1, portal_2), cost, ('walk', neighbor)
+
+        for k, visible_from in enumerate(self.visible_from):
+            if cell not in visible_from:
+                continue
+            if k not in (portal_1, portal_2):
+                yield (cell, k, portal_2), PortalSearch.portal_cost, \
+                    ('portal', Action.Portal1, k, cell)
+                yield (cell, portal_1, k), PortalSearch.portal_cost, \
+                    ('portal', Action.Portal2, k, cell)
+
+        if portal_1 >= 0 and portal_2 >= 0:
+            for entered, left in ((portal_1, portal_2), (portal_2, portal_1)):
+                if self.entry_cells[entered] == cell and self.exit_cells[left] is not None:
+                    yield (self.exit_cells[left], portal_1, portal_2), PortalSearch.teleport_cost, \
+                        ('teleport', entered, self.exit_cells[left])
+
+    @staticmethod
+    def __get_steps(state, parents):
+        steps = []
+        while parents[state] is not None:
+            state, step = parents[state]
+            steps.append(step)
+
+        return steps[::-1]
+
+    def get_idea(self, grid, start, steps):
+        """
+        Returns the Idea that carries out the given steps from the start cell
+        :param grid: NavigationGrid
+        :param start: (int, int) tuple
+        :param steps: list of tuples, as returned by search
+        :return: Idea
+        """
+        idea = []
+        walk = [start]
+        for step in steps:
+            if step[0] == 'walk':
+                walk.append(step[1])
+                continue
+
+            if len(walk) > 1:
+                idea.extend(grid.get_idea(walk))
+
+            if step[0] == 'portal':
+                _, action, k, cell = step
+                eye = grid.get_position(cell) + np.array([0, 0, EYE_HEIGHT])
+                direction = self.centers[:, k] - eye
+                idea.append(Checkpoint(grid.get_position(cell),
+                                       direction / np.linalg.norm(direction), action))
+                walk = [cell]
+            else:
+                _, entered, exit_cell = step
+                idea.append(Checkpoint(self.centers[:, entered], -self.normals[:, entered], None))
+                walk = [exit_cell]
+
+        if len(walk) > 1:
+            idea.extend(grid.get_idea(walk))
+
+        return idea
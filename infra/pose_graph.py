@@ -0,0 +1,558 @@
+"""
+Provide the PoseGraph and KeyframeMap classes, which correct the drift
+    that builds up when every frame is only registered against the last one
+"""
+
+import threading
+
+import numpy as np
+
+from mapping_utils import ColumnStore, SpatialHash
+from mapping import Map
+
+
+class PoseGraph:
+    """
+    Sparse graph whose nodes are keyframe poses and whose edges are measured
+        offsets and yaw differences between two keyframes. A keyframe pose
+        is a position and a yaw, the rotation about the vertical axis that
+        maps the frame the keyframe was recorded in onto the corrected
+        absolute frame. Roll and pitch are taken from odometry and are not
+        corrected. The yaws are solved first, and with them held fixed,
+        finding the positions that best agree with every edge is a linear
+        least-squares problem. Both are solved by conjugate gradients
+        warm-started from the last solution, in a background thread
+    """
+
+    # Maximum number of conjugate gradient iterations per optimization
+    max_iterations = 200
+
+    # Stop iterating once the squared norm of the residual falls below this
+    tolerance = 1e-8
+
+    def __init__(self):
+        """
+        Initialize an empty PoseGraph. The first keyframe added is held
+            fixed and defines the absolute frame
+        """
+        self.keyframes = ColumnStore((('position', 3), ('yaw', 1)))
+        self.edges = ColumnStore((('from', 1), ('to', 1), ('offset', 3), ('to_offset', 3),
+                                  ('yaw', 1), ('weight', 1), ('yaw_weight', 1)))
+        self.version = 0
+
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.requested = False
+        self.running = False
+        self.optimizer_thread = None
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    @staticmethod
+    def get_rotation(yaw):
+        """
+        Returns the rotation about the vertical axis by the given angle
+        :param yaw: float, in radians
+        :return: 3x3 numpy array
+        """
+        cos, sin = np.cos(yaw), np.sin(yaw)
+        return np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+
+    @staticmethod
+    def rotate(yaws, vectors):
+        """
+        Rotate every row of vectors about the vertical axis by its yaw
+        :param yaws: m numpy array, in radians
+        :param vectors: m x 3 numpy array
+        :return: m x 3 numpy array
+        """
+        cos, sin = np.cos(yaws), np.sin(yaws)
+        return np.stack([cos * vectors[:, 0] - sin * vectors[:, 1],
+                         sin * vectors[:, 0] + cos * vectors[:, 1],
+                         vectors[:, 2]], axis=1)
+
+    def add_keyframe(self, position, applied_pose=None):
+        """
+        Add a keyframe at the given position, as estimated by odometry, and
+            return its index. The keyframe is recorded in the frame the last
+            keyframe was in when it was applied at applied_pose, so its
+            initial estimate carries over any part of the last keyframe's
+            pose beyond applied_pose
+        :param position: 3D numpy array
+        :param applied_pose: (3D numpy array, float) tuple or None, the
+            position and yaw of the last keyframe that are already included
+            in position
+        :return: int, the index of the new keyframe
+        """
+        with self.lock:
+            estimate, yaw = position, 0.
+            if self.keyframes and applied_pose is not None:
+                last = len(self.keyframes) - 1
+                yaw = self.keyframes['yaw'][0, last] - applied_pose[1]
+                estimate = self.keyframes['position'][:, last] + PoseGraph.rotate(
+                    np.array([yaw]), (position - applied_pose[0]).reshape((1, 3)))[0]
+
+            return self.keyframes.append(position=estimate, yaw=yaw)
+
+    def add_edge(self, from_keyframe, to_keyframe, offset, weight=1, to_offset=None, yaw=0.,
+                 yaw_weight=None):
+        """
+        Add a measurement that a point at offset from the from_keyframe is
+            at to_offset from the to_keyframe, with both offsets in the
+            frames the keyframes were recorded in, and that the yaw of the
+            to_keyframe minus the yaw of the from_keyframe equals yaw
+        :param from_keyframe: int
+        :param to_keyframe: int
+        :param offset: 3D numpy array
+        :param weight: float, inverse variance of the offset measurement
+        :param to_offset: 3D numpy array, or None for the zero vector
+        :param yaw: float, in radians
+        :param yaw_weight: float, inverse variance of the yaw measurement,
+            or None to use weight. Zero leaves the yaws unconstrained
+        :return: None
+        """
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        with self.lock:
+            self.edges.append(**{'from': from_keyframe, 'to': to_keyframe, 'offset': offset,
+                                 'to_offset': np.zeros(3) if to_offset is None else to_offset,
+                                 'yaw': yaw, 'weight': weight,
+                                 'yaw_weight': weight if yaw_weight is None else yaw_weight})
+
+    def get_positions(self):
+        """
+        Returns a copy of the optimized keyframe positions
+        :return: 3xn numpy array
+        """
+        with self.lock:
+            return self.keyframes['position'].copy()
+
+    def get_poses(self):
+        """
+        Returns a copy of the optimized keyframe positions and yaws
+        :return: (3xn numpy array, n numpy array) tuple
+        """
+        with self.lock:
+            return self.keyframes['position'].copy(), self.keyframes['yaw'][0].copy()
+
+    @staticmethod
+    def solve(positions, edges_from, edges_to, offsets, weights,
+              max_iterations=max_iterations, tolerance=tolerance):
+        """
+        Returns the positions minimizing the weighted sum of squared edge
+            errors, with the first position held fixed. The normal equations
+            are a weighted graph Laplacian, which is applied edge by edge
+            rather than formed, so the cost of an iteration is linear in
+            the number of edges
+        :param positions: n x d numpy array, the initial estimate
+        :param edges_from: m numpy array of ints
+        :param edges_to: m numpy array of ints
+        :param offsets: m x d numpy array
+        :param weights: m numpy array
+        :param max_iterations: int
+        :param tolerance: float
+        :return: n x d numpy array
+        """
+        weights = weights.reshape((-1, 1))
+
+        def laplacian(values):
+            flows = weights * (values[edges_to] - values[edges_from])
+            result = np.zeros_like(values)
+            np.add.at(result, edges_to, flows)
+            np.subtract.at(result, edges_from, flows)
+            result[0] = 0
+            return result
+
+        rhs = np.zeros_like(positions)
+        np.add.at(rhs, edges_to, weights * offsets)
+        np.subtract.at(rhs, edges_from, weights * offsets)
+        rhs[0] = 0
+
+        solution = positions.copy()
+        residual = rhs - laplacian(solution)
+        direction = residual.copy()
+        residual_norms = np.sum(residual ** 2, axis=0)
+
+        for _ in range(max_iterations):
+            if np.all(residual_norms < tolerance):
+                break
+
+            product = laplacian(direction)
+            curvature = np.sum(direction * product, axis=0)
+            step = np.divide(residual_norms, curvature,
+                             out=np.zeros_like(curvature), where=curvature > 0)
+            solution += step * direction
+            residual -= step * product
+
+            new_residual_norms = np.sum(residual ** 2, axis=0)
+            direction = residual + np.divide(new_residual_norms, residual_norms,
+                                             out=np.zeros_like(residual_norms),
+                                             where=residual_norms > 0) * direction
+            residual_norms = new_residual_norms
+
+        return solution
+
+    def optimize(self):
+        """
+        Run one optimization over a snapshot of the graph and store the
+            result. Keyframes added while the optimization was running are
+            moved by the change found for the pose of the last optimized
+            keyframe
+        :return: None
+        """
+        # pylint: disable=too-many-locals
+        with self.lock:
+            n_keyframes = len(self.keyframes)
+            if n_keyframes < 2 or not self.edges:
+                return
+            positions = self.keyframes['position'].T.copy()
+            yaws = self.keyframes['yaw'].T.copy()
+            edges_from = self.edges['from'][0].astype(int)
+            edges_to = self.edges['to'][0].astype(int)
+            offsets = self.edges['offset'].T.copy()
+            to_offsets = self.edges['to_offset'].T.copy()
+            edge_yaws = self.edges['yaw'].T.copy()
+            weights = self.edges['weight'][0].copy()
+            yaw_weights = self.edges['yaw_weight'][0].copy()
+
+        yaws = PoseGraph.solve(yaws, edges_from, edges_to, edge_yaws, yaw_weights)[:, 0]
+        offsets = PoseGraph.rotate(yaws[edges_from], offsets) - \
+            PoseGraph.rotate(yaws[edges_to], to_offsets)
+        solution = PoseGraph.solve(positions, edges_from, edges_to, offsets, weights)
+
+        with self.lock:
+            stored_positions = self.keyframes['position']
+            stored_yaws = self.keyframes['yaw']
+            last = n_keyframes - 1
+            turn = yaws[last] - stored_yaws[0, last]
+            stored_positions[:, n_keyframes:] = PoseGraph.get_rotation(turn) @ (
+                stored_positions[:, n_keyframes:] - stored_positions[:, [last]]) + \
+                solution[last].reshape((3, 1))
+            stored_yaws[0, n_keyframes:] += turn
+            stored_positions[:, :n_keyframes] = solution.T
+            stored_yaws[0, :n_keyframes] = yaws
+            self.version += 1
+
+    def __run_optimizer(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            if self.requested:
+                self.requested = False
+                self.optimize()
+            if not self.running:
+                return
+
+    def start(self):
+        """
+        Spawn a daemon thread that runs optimize whenever
+            request_optimization is called
+        :return: None
+        """
+        if self.optimizer_thread is not None:
+            return
+
+        self.running = True
+        self.optimizer_thread = threading.Thread(target=self.__run_optimizer, daemon=True)
+        self.optimizer_thread.start()
+
+    def stop(self):
+        """
+        Stop the optimizer thread, waiting for a running or requested
+            optimization to finish
+        :return: None
+        """
+        if self.optimizer_thread is None:
+            return
+
+        self.running = False
+        self.pending.set()
+        self.optimizer_thread.join()
+        self.optimizer_thread = None
+
+    def request_optimization(self):
+        """
+        Ask the optimizer thread to run, returning immediately. If the
+            thread has not been started, optimize in the calling thread
+        :return: None
+        """
+        if self.optimizer_thread is None:
+            self.optimize()
+        else:
+            self.requested = True
+            self.pending.set()
+
+
+class KeyframeMap(Map):
+    """
+    Map that records sparse keyframes in a PoseGraph and, whenever the graph
+        has been optimized, moves the player and the stored observations of
+        every keyframe whose pose has changed noticeably, in place. Consecutive
+        keyframes are linked by odometry, and a loop closure edge is added
+        whenever a reference recorded by an earlier, non-adjacent keyframe is
+        seen again, that is, a reference with the same id is observed near
+        its recorded position. Requiring the same id keeps repetitive
+        chambers, where different references sit at similar positions, from
+        closing false loops
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Minimum distance travelled since the last keyframe for a frame to
+    # become a keyframe
+    keyframe_distance = 50
+
+    # Maximum distance between the absolute positions of two observations
+    # of a reference, with the same id, for them to close a loop. This is larger than
+    # max_pos_offset since it has to absorb the drift being corrected
+    loop_closure_radius = 60
+
+    # Weight of a loop closure edge whose references are all close to both
+    # keyframes, relative to an odometry edge. Orientation errors move the
+    # offset of a reference in proportion to its distance, so every
+    # reference counts less the farther it is, and the weight does not grow
+    # with the number of references since their errors are correlated
+    loop_closure_weight = 1
+
+    # Weight of the yaw measured by an odometry edge, relative to that of a
+    # loop closure edge whose references spread horizontally by
+    # max_pos_diff. Odometry follows the orientation estimate of the map,
+    # which changes far less between keyframes than a few references measure
+    odometry_yaw_weight = 100
+
+    # Smallest change in the position of a keyframe, and in its yaw in
+    # radians, for the observations recorded from it to be moved. Smaller
+    # changes accumulate until they reach these, so that a graph that has
+    # settled leaves the map as it is
+    min_correction = 0.5
+    min_yaw_correction = 1e-3
+
+    def __init__(self, anchored=True, background=True):
+        """
+        Initialize an empty KeyframeMap object
+        :param anchored: boolean, see Map
+        :param background: boolean, True to optimize the pose graph in a
+            background thread and False to optimize in add_observation
+        """
+        super().__init__(anchored=anchored)
+
+        self.pose_graph = PoseGraph()
+        if background:
+            self.pose_graph.start()
+        self.applied_version = 0
+
+        # Pose of every keyframe that the stored observations currently agree with
+        self.applied_poses = ColumnStore((('position', 3), ('yaw', 1)))
+
+        # Keyframe that was the latest when each stored column was added
+        self.entity_keyframes = []
+        self.reference_keyframes = []
+
+        self.landmarks = ColumnStore((('offset', 3), ('position_absolute', 3), ('keyframe', 1),
+                                      ('id', 1)))
+        self.landmark_index = SpatialHash(KeyframeMap.loop_closure_radius)
+
+    def close(self):
+        """
+        Stop the background optimizer, if any
+        :return: None
+        """
+        self.pose_graph.stop()
+
+    @staticmethod
+    def __transform_columns(store, keyframes, index, transforms):
+        """
+        Move the columns of a store recorded from each of the given
+            keyframes by the transform of their keyframe, along with their
+            entries in a spatial hash
+        :param store: ColumnStore with a position_absolute field and,
+            optionally, an orientation_absolute field
+        :param keyframes: non-decreasing numpy array, the keyframe that each
+            column was recorded from
+        :param index: SpatialHash over the absolute positions of the columns
+        :param transforms: dict mapping int keyframes to (3x3 numpy array,
+            3D numpy array) tuples of a rotation and a translation
+        :return: None
+        """
+        positions = store['position_absolute']
+        orientations = store['orientation_absolute'] if 'orientation_absolute' in store.rows \
+            else None
+        moved = np.array(sorted(transforms))
+        for keyframe, start, end in zip(moved, np.searchsorted(keyframes, moved, side='left'),
+                                        np.searchsorted(keyframes, moved, side='right')):
+            if start == end:
+                continue
+            rotation, translation = transforms[keyframe]
+            for j in range(start, end):
+                index.remove(j, positions[:, j])
+            positions[:, start:end] = rotation @ positions[:, start:end] + \
+                translation.reshape((3, 1))
+            index.extend(range(start, end), positions[:, start:end])
+            if orientations is not None:
+                orientations[:, start:end] = rotation @ orientations[:, start:end]
+
+    def __apply_corrections(self):
+        """
+        Move the player and the stored observations of every keyframe whose
+            optimized pose differs noticeably from its applied pose, if the
+            pose graph has been optimized since the last call. Observations
+            of other keyframes are left untouched
+        :return: None
+        """
+        if self.pose_graph.version == self.applied_version:
+            return
+        self.applied_version = self.pose_graph.version
+
+        positions, yaws = self.pose_graph.get_poses()
+        applied_positions, applied_yaws = self.applied_poses['position'], self.applied_poses['yaw']
+        turns = yaws - applied_yaws[0]
+        moved = np.flatnonzero(
+            (np.linalg.norm(positions - applied_positions, axis=0) >= KeyframeMap.min_correction) |
+            (np.abs(turns) >= KeyframeMap.min_yaw_correction))
+        if not moved.size:
+            return
+
+        transforms = {}
+        for keyframe in moved.tolist():
+            rotation = PoseGraph.get_rotation(turns[keyframe])
+            transforms[keyframe] = (rotation, positions[:, keyframe] -
+                                    rotation @ applied_positions[:, keyframe])
+        applied_positions[:, moved] = positions[:, moved]
+        applied_yaws[0, moved] = yaws[moved]
+
+        stores = ((self.entity_store, np.asarray(self.entity_keyframes), self.entity_index),
+                  (self.reference_store, np.asarray(self.reference_keyframes),
+                   self.reference_index),
+                  (self.landmarks, self.landmarks['keyframe'][0], self.landmark_index))
+        for store, keyframes, index in stores:
+            if store:
+                KeyframeMap.__transform_columns(store, keyframes, index, transforms)
+        if len(self.surface_index):
+            self.surface_index.transform(transforms)
+
+        if len(self.applied_poses) - 1 in transforms:
+            rotation, translation = transforms[len(self.applied_poses) - 1]
+            self.player_position = rotation @ self.player_position + translation
+            self.player_orientation_update = rotation @ self.player_orientation_update
+            self.player_orientation = rotation @ self.player_orientation
+
+    def __add_keyframe(self, references):
+        """
+        Add the current player pose as a keyframe, linked to the last
+            keyframe by odometry and to earlier keyframes that recorded
+            references with the same ids at nearby positions
+        :param references: iterable of ReferenceObservation objects
+        :return: None
+        """
+        applied_pose = None
+        if self.applied_poses:
+            applied_pose = (self.applied_poses['position'][:, -1],
+                            self.applied_poses['yaw'][0, -1])
+        keyframe = self.pose_graph.add_keyframe(self.player_position, applied_pose)
+        if applied_pose is not None:
+            # The player position is measured in the frame the last keyframe
+            # was applied in, which is turned by its applied yaw from the
+            # frame it was recorded in
+            offset = PoseGraph.rotate(np.array([-applied_pose[1]]),
+                                      (self.player_position - applied_pose[0]).reshape((1, 3)))
+            self.pose_graph.add_edge(keyframe - 1, keyframe, offset[0], yaw=-applied_pose[1],
+                                     yaw_weight=KeyframeMap.odometry_yaw_weight)
+        self.applied_poses.append(position=self.player_position, yaw=0.)
+
+        references = list(references)
+        if not references:
+            return
+
+        offsets = self.player_orientation_update @ \
+            np.array([reference.position for reference in references], dtype=float).T
+        positions = offsets + self.player_position.reshape((3, 1))
+        ids = np.array([reference.id for reference in references], dtype=float)
+
+        closures = {}
+        for i in range(positions.shape[1]):
+            for j in self.landmark_index.query(positions[:, i], KeyframeMap.loop_closure_radius):
+                other = int(self.landmarks['keyframe'][0, j])
+                if keyframe - other > 1 and self.landmarks['id'][0, j] == ids[i] and \
+                        np.linalg.norm(self.landmarks['position_absolute'][:, j] -
+                                       positions[:, i]) <= \
+                        KeyframeMap.loop_closure_radius:
+                    closures.setdefault(other, []).append((self.landmarks['offset'][:, j],
+                                                           offsets[:, i]))
+
+        for other, pairs in closures.items():
+            self.pose_graph.add_edge(other, keyframe, *KeyframeMap.__get_loop_closure(pairs))
+
+        indices = self.landmarks.extend(offset=offsets, position_absolute=positions,
+                                        keyframe=np.full(positions.shape[1], keyframe), id=ids)
+        self.landmark_index.extend(indices, positions)
+
+        if closures:
+            self.pose_graph.request_optimization()
+
+    @staticmethod
+    def __get_loop_closure(pairs):
+        """
+        Returns the measurement of a loop closure edge from the offsets of
+            the matched references from both keyframes, weighting every
+            reference by its distance from them. The yaw that turns the new
+            offsets onto the stored ones is only measured when the
+            references spread horizontally by at least max_pos_diff, and it
+            is weighted by the square of their spread
+        :param pairs: list of (3D numpy array, 3D numpy array) tuples of the
+            offsets of a reference in the frames of the earlier keyframe and
+            of the new keyframe
+        :return: (3D numpy array, float, 3D numpy array, float, float) tuple
+            of offset, weight, to_offset, yaw and yaw_weight, as taken by
+            PoseGraph.add_edge
+        """
+        stored = np.array([pair[0] for pair in pairs])
+        observed = np.array([pair[1] for pair in pairs])
+        weights = 1 / (1 + (np.sum(stored ** 2, axis=1) + np.sum(observed ** 2, axis=1)) /
+                       (2 * KeyframeMap.keyframe_distance ** 2))
+        offset = weights @ stored / weights.sum()
+        to_offset = weights @ observed / weights.sum()
+        weight = KeyframeMap.loop_closure_weight * weights.mean()
+
+        stored_xy = stored[:, :2] - offset[:2]
+        observed_xy = observed[:, :2] - to_offset[:2]
+        spread = weights @ np.sum(observed_xy ** 2, axis=1) / weights.sum()
+        yaw, yaw_weight = 0., 0.
+        if len(pairs) >= 2 and spread >= Map.max_pos_diff ** 2:
+            yaw = np.arctan2(weights @ (observed_xy[:, 0] * stored_xy[:, 1] -
+                                        observed_xy[:, 1] * stored_xy[:, 0]),
+                             weights @ np.sum(observed_xy * stored_xy, axis=1))
+            yaw_weight = weight * spread / Map.max_pos_diff ** 2
+
+        return offset, weight, to_offset, yaw, yaw_weight
+
+    def add_observation(self, entities, surfaces, references, time):
+        """
+        Add the given observations as in Map.add_observation, then make the
+            frame a keyframe if the player has moved far enough since the
+            last one. Pose graph optimization never blocks this method when
+            running in the background; its results are applied at the
+            start of the next call
+        :param entities: iterable of EntityObservation objects
+        :param surfaces: iterable of SurfaceObservation objects
+        :param references: iterable of ReferenceObservation objects
+        :param time: float representing the time of the observation
+        :return: None
+        """
+        self.__apply_corrections()
+
+        latest_keyframe = max(len(self.pose_graph) - 1, 0)
+        self.surface_index.tag = latest_keyframe
+
+        frames_dropped = self.frames_dropped
+        super().add_observation(entities, surfaces, references, time)
+        if self.frames_dropped != frames_dropped:
+            return
+
+        for store, keyframes in ((self.entity_store, self.entity_keyframes),
+                                 (self.reference_store, self.reference_keyframes)):
+            keyframes.extend([latest_keyframe] * (len(store) - len(keyframes)))
+
+        if not self.applied_poses or \
+                np.linalg.norm(self.player_position - self.applied_poses['position'][:, -1]) >= \
+                KeyframeMap.keyframe_distance:
+            self.__add_keyframe(references)
@@ -0,0 +1,301 @@
+"""
+Provide the Recorder, Recording and Player classes, which save streams of
+    observations to a compact binary file and play them back offline into
+    any ViewObserver, such as a Map
+"""
+
+import json
+import time
+
+import numpy as np
+
+from utils import Entity, Surface, EntityObservation, SurfaceObservation, \
+    ReferenceObservation
+from mapping_utils import Observation, TimedObservation
+from abstract_view_observer import ViewObserver
+
+
+# Every recording starts with these bytes, followed by the length of the
+# header as a little-endian uint64 and the header itself, a JSON object
+# giving the dtype, shape and byte offset of every column
+MAGIC = b'APREPLAY'
+
+# Byte boundary at which every column starts, so that memory-mapped
+# columns are aligned for vectorized access
+ALIGNMENT = 64
+
+# Name, dtype and number of values per row of every column. Rows of the
+# *_start columns give the first row of each frame (or surface) in the
+# columns that follow, plus a final row holding their total length
+COLUMNS = (('time', '<f8', 1),
+           ('entity_start', '<i8', 1),
+           ('entity_type', '<i1', 1),
+           ('entity_position', '<f4', 3),
+           ('entity_orientation', '<f4', 3),
+           ('surface_start', '<i8', 1),
+           ('surface_type', '<i1', 1),
+           ('surface_orientation', '<f4', 3),
+           ('corner_start', '<i8', 1),
+           ('corners', '<f4', 3),
+           ('reference_start', '<i8', 1),
+           ('reference_id', '<i8', 1),
+           ('reference_position', '<f4', 3))
+
+
+class Recorder(ViewObserver):
+    """
+    ViewObserver that records every observation it receives, optionally
+        passing it on to another ViewObserver, and writes the recording
+        to a file when closed. Positions, orientations and corners are
+        stored as float32 and times as float64
+    """
+
+    def __init__(self, path, observer=None):
+        """
+        Initialize an empty Recorder
+        :param path: str, path of the file written by close
+        :param observer: ViewObserver that also receives every observation,
+            or None
+        """
+        self.path = path
+        self.observer = observer
+        self.frames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add_observation(self, entities, surfaces, references, timestamp):
+        """
+        Record the observations of a single frame, see
+            ViewObserver.add_observation
+        :param entities: iterable of EntityObservation objects
+        :param surfaces: iterable of SurfaceObservation objects
+        :param references: iterable of ReferenceObservation objects
+        :param timestamp: float representing the time of the observation
+        :return: None
+        """
+        entities, surfaces, references = list(entities), list(surfaces), list(references)
+        self.frames.append(TimedObservation(Observation(entities, surfaces, references),
+                                            timestamp))
+        if self.observer is not None:
+            self.observer.add_observation(entities, surfaces, references, timestamp)
+
+    def get_player_position(self, confidence_window=None):
+        """
+        Returns the player position of the wrapped observer, see
+            ViewObserver.get_player_position
+        :param confidence_window: 0 <= float <= 1 or None
+        :return: (3D numpy array, 3D numpy array) tuple
+        """
+        if self.observer is None:
+            raise ValueError("Recorder has no observer to get the player position from")
+        return self.observer.get_player_position(confidence_window)
+
+    def get_player_orientation(self, confidence_window=None):
+        """
+        Returns the player orientation of the wrapped observer, see
+            ViewObserver.get_player_orientation
+        :param confidence_window: 0 <= float <= 1 or None
+        :return: (3D numpy array, 3D numpy array) tuple
+        """
+        if self.observer is None:
+            raise ValueError("Recorder has no observer to get the player orientation from")
+        return self.observer.get_player_orientation(confidence_window)
+
+    @staticmethod
+    def get_starts(counts):
+        """
+        Returns the first row of every group of rows, followed by the total
+            number of rows
+        :param counts: iterable of ints, the number of rows in each group
+        :return: 1D int64 numpy array, one longer than counts
+        """
+        return np.concatenate(([0], np.cumsum(np.fromiter(counts, dtype=np.int64))))
+
+    @staticmethod
+    def stack_rows(vectors):
+        """
+        Returns vectors stacked as the rows of an nx3 array
+        :param vectors: list of 3D numpy arrays
+        :return: nx3 numpy array
+        """
+        return np.array(vectors, dtype=float).reshape((-1, 3))
+
+    def get_columns(self):
+        """
+        Returns the columns of the recording
+        :return: dict mapping every name in COLUMNS to a numpy array
+        """
+        entities = [entity for frame in self.frames for entity in frame.observation[0]]
+        surfaces = [surface for frame in self.frames for surface in frame.observation[1]]
+        references = [reference for frame in self.frames for reference in frame.observation[2]]
+        corners = [np.asarray(surface.corners, dtype=float).T for surface in surfaces]
+
+        return {
+            'time': np.array([frame.time for frame in self.frames], dtype=float),
+            'entity_start': Recorder.get_starts(len(frame.observation[0])
+                                                for frame in self.frames),
+            'entity_type': np.array([entity.entity.value for entity in entities]),
+            'entity_position': Recorder.stack_rows([entity.position for entity in entities]),
+            'entity_orientation': Recorder.stack_rows([entity.orientation
+                                                       for entity in entities]),
+            'surface_start': Recorder.get_starts(len(frame.observation[1])
+                                                 for frame in self.frames),
+            'surface_type': np.array([surface.surface.value for surface in surfaces]),
+            'surface_orientation': Recorder.stack_rows([surface.orientation
+                                                        for surface in surfaces]),
+            'corner_start': Recorder.get_starts(len(corner) for corner in corners),
+            'corners': np.concatenate(corners) if corners else np.zeros((0, 3)),
+            'reference_start': Recorder.get_starts(len(frame.observation[2])
+                                                   for frame in self.frames),
+            'reference_id': np.array([reference.id for reference in references]),
+            'reference_position': Recorder.stack_rows([reference.position
+                                                       for reference in references])
+        }
+
+    def close(self):
+        """
+        Write every recorded frame to the file at self.path
+        :return: None
+        """
+        columns = self.get_columns()
+        header = {}
+        offset = 0
+        for name, dtype, width in COLUMNS:
+            shape = (len(columns[name]), width) if width > 1 else (len(columns[name]),)
+            columns[name] = np.ascontiguousarray(columns[name], dtype=dtype).reshape(shape)
+            header[name] = [dtype, shape, offset]
+            offset += -(-columns[name].nbytes // ALIGNMENT) * ALIGNMENT
+
+        encoded = json.dumps(header).encode()
+        data_start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+        with open(self.path, 'wb') as file:
+            file.write(MAGIC)
+            file.write(np.uint64(len(encoded)).astype('<u8').tobytes())
+            file.write(encoded)
+            for name, _, _ in COLUMNS:
+                file.seek(data_start + header[name][2])
+                file.write(columns[name].tobytes())
+            file.truncate(data_start + offset)
+
+
+class Recording:
+    """
+    Read-only recording written by a Recorder. Every column is
+        memory-mapped, so opening a recording is O(1) and any frame can be
+        read without reading the frames before it
+    """
+
+    def __init__(self, path):
+        """
+        Open a recording
+        :param path: str, path of a file written by Recorder.close
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a recording")
+            header_length = int(np.frombuffer(file.read(8), dtype='<u8')[0])
+            header = json.loads(file.read(header_length))
+        data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        self.columns = {}
+        for name, (dtype, shape, offset) in header.items():
+            if np.prod(shape) == 0:
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(path, dtype=dtype, mode='r',
+                                               offset=data_start + offset, shape=tuple(shape))
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, index):
+        return self.get_frame(index)
+
+    def __iter__(self):
+        return (self.get_frame(index) for index in range(len(self)))
+
+    def get_frame(self, index):
+        """
+        Returns the observations of a single frame
+        :param index: int, negative values count from the end
+        :return: TimedObservation
+        """
+        if not -len(self) <= index < len(self):
+            raise IndexError("frame index out of range")
+        index %= len(self)
+        columns = self.columns
+
+        start, stop = columns['entity_start'][index:index + 2]
+        entities = [EntityObservation(Entity(int(entity)), position.astype(float),
+                                      orientation.astype(float))
+                    for entity, position, orientation in
+                    zip(columns['entity_type'][start:stop],
+                        columns['entity_position'][start:stop],
+                        columns['entity_orientation'][start:stop])]
+
+        start, stop = columns['surface_start'][index:index + 2]
+        corner_starts = columns['corner_start'][start:stop + 1]
+        surfaces = [SurfaceObservation(Surface(int(surface)),
+                                       columns['corners'][first:last].T.astype(float),
+                                       orientation.astype(float))
+                    for surface, orientation, first, last in
+                    zip(columns['surface_type'][start:stop],
+                        columns['surface_orientation'][start:stop],
+                        corner_starts[:-1], corner_starts[1:])]
+
+        start, stop = columns['reference_start'][index:index + 2]
+        references = [ReferenceObservation(position.astype(float), int(reference_id))
+                      for reference_id, position in
+                      zip(columns['reference_id'][start:stop],
+                          columns['reference_position'][start:stop])]
+
+        return TimedObservation(Observation(entities, surfaces, references),
+                                float(columns['time'][index]))
+
+
+class Player:
+    """
+    Feeds the frames of a Recording to a ViewObserver, either as fast as
+        the observer accepts them or paced by the recorded times
+    """
+
+    def __init__(self, recording, speed=None):
+        """
+        Initialize a Player
+        :param recording: Recording, or str path of a recording
+        :param speed: float, playback rate relative to real time, or None to
+            play every frame as soon as the previous one has been observed
+        """
+        self.recording = Recording(recording) if isinstance(recording, str) else recording
+        self.speed = speed
+
+    def play(self, observer, start=0, stop=None):
+        """
+        Play frames into an observer. Playback is deterministic: the same
+            frames are always delivered in the same order with the same
+            times, whatever the speed
+        :param observer: ViewObserver
+        :param start: int, index of the first frame to play
+        :param stop: int, index after the last frame to play, or None to play
+            to the end
+        :return: float, wall time spent in seconds
+        """
+        stop = len(self.recording) if stop is None else min(stop, len(self.recording))
+        times = self.recording.columns['time']
+        begin = time.perf_counter()
+        for index in range(start, stop):
+            if self.speed is not None:
+                delay = (times[index] - times[start]) / self.speed - \
+                    (time.perf_counter() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+            (entities, surfaces, references), frame_time = self.recording.get_frame(index)
+            observer.add_observation(entities, surfaces, references, frame_time)
+        return time.perf_counter() - begin
@@ -0,0 +1,311 @@
+"""
+Provide the ChamberSimulator class, which generates random box-shaped
+    chambers and streams noisy observations of them, along with the true
+    player pose, and the stress function, which measures how a ViewObserver
+    such as a Map scales with the length of the stream
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from utils import Entity, Surface, EntityObservation, SurfaceObservation, \
+    ReferenceObservation
+from mapping_utils import Observation
+from pipeline import Pipeline
+from constants import EYE_HEIGHT
+
+
+SimulatedFrame = namedtuple('SimulatedFrame', ['observation', 'time', 'position', 'orientation'])
+SimulatedFrame.__doc__ = """
+                         Data class that represents a simulated frame
+                         :param observation: Observation, noisy and relative to the player
+                         :param time: float
+                         :param position: 3D numpy array, the true absolute player position
+                         :param orientation: 3D numpy array, the true absolute player
+                             orientation, in the convention of Map.get_player_orientation
+                         """
+
+
+class ChamberSimulator:
+    """
+    Simulates a player walking around a random box-shaped chamber. The
+        walls, floor and ceiling are split into square panels, each of
+        which is portalable with probability portalable_fraction. Entities
+        stand on the floor and reference points are spread over every face.
+        The absolute frame is the one used by Map: the player starts at the
+        origin, facing the y axis, with the z axis pointing up
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Side length of the panels that make up the walls, floor and ceiling,
+    # in units of distance
+    panel_size = 200
+
+    # Fraction of the panels that are portalable
+    portalable_fraction = 0.5
+
+    # Largest distance, in units of distance, and angle from the view
+    # direction, in radians, at which something is observed
+    view_distance = 500
+    view_angle = np.pi / 3
+
+    # Distance the player walks every frame, in units of distance, and the
+    # largest change in yaw every frame, in radians. Together they keep the
+    # per-frame motion of visible landmarks below Map.max_pos_offset
+    step_size = 4
+    max_turn = 0.02
+
+    # Smallest distance between the player and a wall, in units of distance
+    wall_margin = 60
+
+    # Standard deviation of the noise added to observed positions, in units
+    # of distance, and to observed orientation vectors
+    position_noise = 0.5
+    orientation_noise = 0.005
+
+    # Time between frames, in seconds
+    frame_interval = 1 / 30
+
+    def __init__(self, size=(1000, 1000, 300), n_entities=8, n_references=500, seed=0):
+        """
+        Initialize a ChamberSimulator with a random chamber
+        :param size: (float, float, float) tuple, the extent of the chamber
+            along each axis
+        :param n_entities: int, number of entities besides the entrance and
+            the exit
+        :param n_references: int, number of reference points
+        :param seed: int, seed of the random generator that builds the
+            chamber and drives the player and the noise
+        """
+        self.rng = np.random.default_rng(seed)
+
+        # Place the chamber so that the origin is at eye height, away from
+        # the walls
+        size = np.array(size, dtype=float)
+        low = -self.rng.uniform(ChamberSimulator.wall_margin,
+                                size - ChamberSimulator.wall_margin)
+        low[2] = -EYE_HEIGHT
+        self.low, self.high = low, low + size
+
+        self.surfaces, self.surface_corners, self.surface_orientations = self.__build_panels()
+
+        self.entities = [Entity.Entrance, Entity.Exit] + \
+            list(self.rng.choice(list(Entity)[2:], n_entities))
+        floor = self.rng.uniform(self.low + ChamberSimulator.wall_margin,
+                                 self.high - ChamberSimulator.wall_margin,
+                                 (len(self.entities), 3))
+        floor[:, 2] = self.low[2]
+        self.entity_positions = floor.T
+        yaws = self.rng.uniform(-np.pi, np.pi, len(self.entities))
+        self.entity_orientations = np.array([np.cos(yaws), np.sin(yaws),
+                                             np.zeros(len(self.entities))])
+
+        self.reference_positions = self.__sample_faces(n_references)
+
+        self.position = np.zeros(3)
+        self.yaw = 0.0
+        self.turn_rate = 0.0
+        self.frames_generated = 0
+
+    def __build_panels(self):
+        """
+        Returns the types, corners and inward normals of every panel
+        :return: (list of Surfaces, list of 3x4 numpy arrays, 3xn numpy array)
+            tuple
+        """
+        surfaces, corners, orientations = [], [], []
+        n_panels = np.maximum(np.ceil((self.high - self.low) / ChamberSimulator.panel_size), 1)
+        edges = [np.linspace(self.low[axis], self.high[axis], int(n_panels[axis]) + 1)
+                 for axis in range(3)]
+        for axis in range(3):
+            u_axis, v_axis = [other for other in range(3) if other != axis]
+            u_edges, v_edges = edges[u_axis], edges[v_axis]
+            for side, sign in ((self.low[axis], 1), (self.high[axis], -1)):
+                normal = np.zeros(3)
+                normal[axis] = sign
+                for u_low, u_high in zip(u_edges[:-1], u_edges[1:]):
+                    for v_low, v_high in zip(v_edges[:-1], v_edges[1:]):
+                        panel = np.empty((3, 4))
+                        panel[axis] = side
+                        panel[u_axis] = [u_low, u_high, u_high, u_low]
+                        panel[v_axis] = [v_low, v_low, v_high, v_high]
+                        portalable = self.rng.random() < ChamberSimulator.portalable_fraction
+                        surfaces.append(Surface.P if portalable else Surface.NP)
+                        corners.append(panel)
+                        orientations.append(normal)
+        return surfaces, corners, np.array(orientations).T
+
+    def __sample_faces(self, n_points):
+        """
+        Returns points spread uniformly over the walls, floor and ceiling
+        :param n_points: int
+        :return: 3xn numpy array
+        """
+        points = self.rng.uniform(self.low, self.high, (n_points, 3))
+        size = self.high - self.low
+        areas = np.array([size[1] * size[2], size[0] * size[2], size[0] * size[1]])
+        axes = self.rng.choice(3, n_points, p=areas / areas.sum())
+        sides = self.rng.random(n_points) < 0.5
+        points[np.arange(n_points), axes] = np.where(sides, self.low[axes], self.high[axes])
+        return points.T
+
+    @property
+    def n_landmarks(self):
+        """
+        Returns the number of entities, panels and reference points
+        :return: int
+        """
+        return len(self.entities) + len(self.surfaces) + self.reference_positions.shape[1]
+
+    def get_rotation(self):
+        """
+        Returns the rotation taking player-relative vectors to absolute ones
+        :return: 3x3 numpy array
+        """
+        return np.array([[np.cos(self.yaw), -np.sin(self.yaw), 0],
+                         [np.sin(self.yaw), np.cos(self.yaw), 0],
+                         [0, 0, 1]])
+
+    def __move(self):
+        """
+        Walk one step forward, turning away from walls that are close
+        :return: None
+        """
+        self.turn_rate = np.clip(self.turn_rate + self.rng.normal(0, ChamberSimulator.max_turn / 4),
+                                 -ChamberSimulator.max_turn, ChamberSimulator.max_turn)
+        forward = np.array([-np.sin(self.yaw), np.cos(self.yaw), 0])
+        ahead = self.position + 2 * ChamberSimulator.wall_margin * forward
+        if np.any(ahead[:2] < self.low[:2] + ChamberSimulator.wall_margin) or \
+                np.any(ahead[:2] > self.high[:2] - ChamberSimulator.wall_margin):
+            # Turn toward the center of the chamber
+            center = (self.low + self.high) / 2 - self.position
+            self.turn_rate = ChamberSimulator.max_turn * \
+                np.sign(np.cross(forward, center)[2] or 1)
+        self.yaw += self.turn_rate
+
+        forward = np.array([-np.sin(self.yaw), np.cos(self.yaw), 0])
+        step = self.position + ChamberSimulator.step_size * forward
+        self.position = np.clip(step, self.low + ChamberSimulator.wall_margin,
+                                self.high - ChamberSimulator.wall_margin)
+        self.position[2] = 0
+
+    def __get_visible(self, positions, rotation):
+        """
+        Returns which points are in view, and their player-relative positions
+        :param positions: 3xn numpy array of absolute positions
+        :param rotation: 3x3 numpy array, see get_rotation
+        :return: (1D boolean numpy array, 3xn numpy array) tuple
+        """
+        relative = rotation.T @ (positions - self.position.reshape((3, 1)))
+        distances = np.linalg.norm(relative, axis=0)
+        visible = (distances <= ChamberSimulator.view_distance) & \
+            (relative[1] >= np.cos(ChamberSimulator.view_angle) * distances)
+        return visible, relative
+
+    def __noisy(self, values, noise):
+        """
+        Returns values with Gaussian noise of the given standard deviation
+        :param values: numpy array
+        :param noise: float
+        :return: numpy array
+        """
+        return values + self.rng.normal(0, noise, values.shape)
+
+    def observe(self):
+        """
+        Returns noisy, player-relative observations of everything in view
+            from the current pose
+        :return: Observation
+        """
+        rotation = self.get_rotation()
+
+        visible, relative = self.__get_visible(self.entity_positions, rotation)
+        orientations = self.__noisy(rotation.T @ self.entity_orientations,
+                                    ChamberSimulator.orientation_noise)
+        relative = self.__noisy(relative, ChamberSimulator.position_noise)
+        entities = [EntityObservation(self.entities[i], relative[:, i], orientations[:, i])
+                    for i in np.nonzero(visible)[0]]
+
+        centers = np.array([corners.mean(axis=1) for corners in self.surface_corners]).T
+        visible, _ = self.__get_visible(centers, rotation)
+        surfaces = []
+        for i in np.nonzero(visible)[0]:
+            corners = rotation.T @ (self.surface_corners[i] - self.position.reshape((3, 1)))
+            surfaces.append(SurfaceObservation(
+                self.surfaces[i], self.__noisy(corners, ChamberSimulator.position_noise),
+                self.__noisy(rotation.T @ self.surface_orientations[:, i],
+                             ChamberSimulator.orientation_noise)))
+
+        visible, relative = self.__get_visible(self.reference_positions, rotation)
+        indices = np.nonzero(visible)[0]
+        relative = self.__noisy(relative[:, indices], ChamberSimulator.position_noise)
+        references = [ReferenceObservation(relative[:, j], int(i)) for j, i in enumerate(indices)]
+
+        return Observation(entities, surfaces, references)
+
+    def step(self):
+        """
+        Observe the chamber from the current pose, then move the player
+        :return: SimulatedFrame
+        """
+        frame = SimulatedFrame(self.observe(),
+                               self.frames_generated * ChamberSimulator.frame_interval,
+                               self.position.copy(), self.get_rotation() @ np.array([0, 1, 0]))
+        self.__move()
+        self.frames_generated += 1
+        return frame
+
+    def run(self, n_frames):
+        """
+        Generate the next n_frames frames
+        :param n_frames: int
+        :return: generator of SimulatedFrames
+        """
+        for _ in range(n_frames):
+            yield self.step()
+
+
+def stress(observer, simulator, n_frames, report_every=None):
+    """
+    Feed simulated frames to an observer and measure the cost and accuracy
+        of every frame. Only the time spent in add_observation is counted
+    :param observer: ViewObserver
+    :param simulator: ChamberSimulator
+    :param n_frames: int
+    :param report_every: int, number of frames between progress lines
+        printed to stdout, or None to print nothing
+    :return: dict with the summary of the frame times (see
+        Pipeline.summarize), the summary of the frame times of the last
+        tenth of the frames under 'late', the largest distance between the
+        estimated and true player positions under 'max_position_error', and
+        frames_per_second
+    """
+    frame_times = []
+    max_error = 0.0
+    for index, frame in enumerate(simulator.run(n_frames)):
+        start = time.perf_counter()
+        observer.add_observation(*frame.observation, frame.time)
+        frame_times.append(time.perf_counter() - start)
+
+        max_error = max(max_error, float(np.linalg.norm(
+            observer.get_player_position()[0] - frame.position)))
+        if report_every and (index + 1) % report_every == 0:
+            print(f"{index + 1} frames, {np.mean(frame_times[-report_every:]) * 1000:.2f} ms "
+                  f"per frame, position error {max_error:.1f}")
+
+    stats = Pipeline.summarize(frame_times)
+    stats['late'] = Pipeline.summarize(frame_times[-max(1, n_frames // 10):])
+    stats['max_position_error'] = max_error
+    stats['frames_per_second'] = n_frames / max(sum(frame_times), 1e-9)
+    return stats
+
+
+if __name__ == '__main__':
+    from mapping import Map
+
+    CHAMBER = ChamberSimulator(size=(3000, 3000, 400), n_entities=40, n_references=5000)
+    print(f"{CHAMBER.n_landmarks} landmarks")
+    print(stress(Map(anchored=True), CHAMBER, 10000, report_every=1000))
@@ -0,0 +1,179 @@
+"""
+Provide the PoseFilter class, which estimates the uncertainty of the
+    player pose tracked by a Map
+"""
+
+from statistics import NormalDist
+
+import numpy as np
+
+
+class PoseFilter:
+    """
+    Kalman filter over the absolute player position, with a separate
+        covariance for the player orientation vector. Every registered frame
+        is a prediction step driven by the pose update fitted to it. The
+        stored landmarks seen again in a frame are registered against their
+        stored positions, which measures both the player position and the
+        player rotation, and both are used as correction steps.
+        The landmarks of one registration share the error of the frame they
+        were matched in, so a registration counts as a single measurement
+        however many landmarks it holds
+    """
+
+    # Standard deviation of the error in the translation of a single
+    # frame update, in units of distance
+    position_noise = 1.0
+
+    # Standard deviation of the error in the rotation of a single frame
+    # update, in radians
+    orientation_noise = 0.005
+
+    # Standard deviation of the error in the position of a landmark
+    # observation, in units of distance. The rotation measured by a
+    # registration has a standard deviation of this over the spread of its
+    # landmarks, in radians
+    measurement_noise = 5.0
+
+    def __init__(self):
+        """
+        Initialize a PoseFilter with no uncertainty, since the first frame
+            defines the absolute frame
+        """
+        self.position_covariance = np.zeros((3, 3))
+        self.orientation_covariance = np.zeros((3, 3))
+
+    def predict(self, distance, residual):
+        """
+        Grow the covariances by the noise of a frame update
+        :param distance: float, magnitude of the translation of the update
+        :param residual: float, root mean square error of the update fit
+        :return: None
+        """
+        rotation_variance = PoseFilter.orientation_noise ** 2 * \
+            (1 + (residual / PoseFilter.measurement_noise) ** 2)
+        self.position_covariance += (PoseFilter.position_noise ** 2 + residual ** 2 +
+                                     rotation_variance * distance ** 2) * np.identity(3)
+        self.orientation_covariance += rotation_variance * np.identity(3)
+
+    def correct(self, position, offsets):
+        """
+        Returns the player position corrected by landmark measurements, and
+            shrinks the position covariance accordingly
+        :param position: 3D numpy array, the predicted player position
+        :param offsets: 3xn numpy array, where every column is the stored
+            absolute position of a landmark minus the absolute position at
+            which it was just observed, i.e. a measured player position
+            minus the predicted one
+        :return: 3D numpy array
+        """
+        if offsets.shape[1] == 0:
+            return position
+
+        gain = PoseFilter.get_gain(self.position_covariance, PoseFilter.measurement_noise ** 2)
+        self.position_covariance = (np.identity(3) - gain) @ self.position_covariance
+
+        return position + gain @ offsets.mean(axis=1)
+
+    def correct_orientation(self, angles, spread):
+        """
+        Returns the correction to apply to the player rotation, given the
+            rotation that registers the landmarks seen again onto their
+            stored positions, and shrinks the orientation covariance
+            accordingly
+        :param angles: 3D numpy array, the measured rotation as a rotation
+            vector (see get_rotation_vector)
+        :param spread: float, root mean square distance of the registered
+            landmarks from their centroid
+        :return: 3D numpy array, a rotation vector
+        """
+        if spread <= 0:
+            return np.zeros(3)
+
+        gain = PoseFilter.get_gain(self.orientation_covariance,
+                                   (PoseFilter.measurement_noise / spread) ** 2)
+        self.orientation_covariance = (np.identity(3) - gain) @ self.orientation_covariance
+
+        return gain @ angles
+
+    @staticmethod
+    def get_gain(covariance, measurement_variance):
+        """
+        Returns the Kalman gain for a direct measurement of the state with
+            the given isotropic variance
+        :param covariance: 3x3 numpy array
+        :param measurement_variance: float
+        :return: 3x3 numpy array
+        """
+        return covariance @ np.linalg.inv(covariance + measurement_variance * np.identity(3))
+
+    @staticmethod
+    def get_rotation_vector(rotation):
+        """
+        Returns the axis of a rotation scaled by its angle in radians
+        :param rotation: 3x3 numpy array
+        :return: 3D numpy array
+        """
+        axis = np.array([rotation[2, 1] - rotation[1, 2],
+                         rotation[0, 2] - rotation[2, 0],
+                         rotation[1, 0] - rotation[0, 1]])
+        angle = np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1, 1))
+        if angle < 1e-6:
+            return axis / 2
+        return angle / (2 * np.sin(angle)) * axis
+
+    @staticmethod
+    def get_rotation(angles):
+        """
+        Returns the rotation matrix of a rotation vector, by Rodrigues' formula
+        :param angles: 3D numpy array
+        :return: 3x3 numpy array
+        """
+        angle = np.linalg.norm(angles)
+        cross = np.array([[0, -angles[2], angles[1]],
+                          [angles[2], 0, -angles[0]],
+                          [-angles[1], angles[0], 0]])
+        if angle < 1e-12:
+            return np.identity(3) + cross
+        return np.identity(3) + np.sin(angle) / angle * cross + \
+            (1 - np.cos(angle)) / angle ** 2 * cross @ cross
+
+    @staticmethod
+    def get_error(covariance, confidence_window):
+        """
+        Returns per-axis error bounds such that the probability that every
+            component lies within its bound is at least confidence_window.
+            Each axis is given probability confidence_window ** (1 / 3),
+            which covers the joint probability for independent axes
+        :param covariance: 3x3 numpy array
+        :param confidence_window: 0 <= float <= 1 or None
+        :return: 3D numpy array, zero if confidence_window is None
+        """
+        if confidence_window is None:
+            return np.zeros(3)
+        if not 0 <= confidence_window <= 1:
+            raise ValueError("confidence_window must be between 0 and 1")
+        if confidence_window == 1:
+            return np.full(3, np.inf)
+
+        axis_window = confidence_window ** (1 / 3)
+        scale = NormalDist().inv_cdf((1 + axis_window) / 2)
+
+        return scale * np.sqrt(np.diag(covariance))
+
+    def get_position_error(self, confidence_window):
+        """
+        Returns the error bounds of the player position, see get_error
+        :param confidence_window: 0 <= float <= 1 or None
+        :return: 3D numpy array
+        """
+        return PoseFilter.get_error(self.position_covariance, confidence_window)
+
+    def get_orientation_error(self, confidence_window):
+        """
+        Returns the error bounds of the player orientation vector, see
+            get_error
+        :param confidence_window: 0 <= float <= 1 or None
+        :return: 3D numpy array
+        """
+        return PoseFilter.get_error(self.orientation_covariance, confidence_window)
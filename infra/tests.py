@@ -2,11 +2,27 @@
 File containing tests for the backend classes
 """
 
+# pylint: disable=too-many-lines
+
+import os
+import tempfile
+import threading
+import time
 import unittest
 import numpy as np
 
-from utils import Action
+from utils import Action, Entity, Surface, EntityObservation, SurfaceObservation, \
+    ReferenceObservation
+from mapping_utils import ColumnStore, SpatialHash, SurfaceIndex, convex_hull, \
+    polygon_area, clip_convex, linear_sum_assignment
+import geometry
 from mapping import Map
+from pose_graph import PoseGraph, KeyframeMap
+from state_estimation import PoseFilter
+from navigation import NavigationGrid, DStarLite
+from pipeline import Pipeline
+from replay import Recorder, Recording, Player
+from simulator import ChamberSimulator, stress
 
 
 class TestUtils(unittest.TestCase):
@@ -25,6 +41,256 @@ class TestUtils(unittest.TestCase):
         self.assertTrue(Action.Interact.is_one_shot())
 
 
+class TestColumnStore(unittest.TestCase):
+    """
+    Test the ColumnStore class
+    """
+
+    def test_append_and_grow(self):
+        """
+        Test that appending past the capacity keeps all columns intact
+        """
+        store = ColumnStore((('position', 3), ('type', 1)), capacity=2)
+        for i in range(5):
+            self.assertEqual(store.append(position=np.array([i, i + 1, i + 2]), type=i), i)
+
+        self.assertEqual(len(store), 5)
+        self.assertGreaterEqual(store.data.shape[1], 5)
+        self.assertTrue(np.array_equal(store['position'][:, 4], np.array([4, 5, 6])))
+        self.assertTrue(np.array_equal(store['type'][0], np.arange(5)))
+
+    def test_extend_and_view(self):
+        """
+        Test the method extend and in-place writes through views
+        """
+        store = ColumnStore((('position', 3), ('type', 1)))
+        indices = store.extend(position=np.ones((3, 4)), type=[0, 1, 2, 3])
+        self.assertEqual(list(indices), [0, 1, 2, 3])
+
+        store['position'][:] *= 2
+        self.assertTrue(np.array_equal(store['position'], 2 * np.ones((3, 4))))
+        self.assertRaises(ValueError, store.extend, position=np.ones((3, 1)))
+
+
+class TestSpatialHash(unittest.TestCase):
+    """
+    Test the SpatialHash class
+    """
+
+    def test_query(self):
+        """
+        Test that queries return every index within the radius
+        """
+        index = SpatialHash(10)
+        positions = np.array([[0, 9, 25, -5, 100],
+                              [0, 0, 0, -5, 100],
+                              [0, 0, 0, 0, 100]])
+        index.extend(range(5), positions)
+
+        self.assertEqual(len(index), 5)
+        self.assertEqual(sorted(index.query(np.array([1, 1, 1]), 10)), [0, 1, 3])
+        self.assertEqual(index.query(np.array([-50, -50, -50]), 10), [])
+        self.assertIn(2, index.query(np.array([18, 0, 0]), 10))
+
+
+class TestSurfaceIndex(unittest.TestCase):
+    """
+    Test the SurfaceIndex class and the convex_hull function
+    """
+
+    @staticmethod
+    def square(x_min, x_max, z=0.0):
+        """
+        Returns the corners of a horizontal square spanning the given x range
+        """
+        return np.array([[x_min, x_max, x_max, x_min],
+                         [0, 0, 10, 10],
+                         [z, z, z, z]], dtype=float)
+
+    def test_convex_hull(self):
+        """
+        Test that interior and collinear points are dropped
+        """
+        hull = convex_hull(np.array([[0, 2, 2, 0, 1, 1], [0, 0, 2, 2, 1, 0]]))
+        self.assertEqual(hull.shape, (2, 4))
+        self.assertTrue(np.allclose(np.sort(hull[0]), [0, 0, 2, 2]))
+
+    def test_merging(self):
+        """
+        Test that coplanar overlapping surfaces of a type merge into one
+        """
+        index = SurfaceIndex(1, 0.99)
+        up = np.array([0, 0, 1])
+        index.insert(TestSurfaceIndex.square(0, 10), up, 0)
+        index.insert(TestSurfaceIndex.square(5, 20, 0.5), up, 0)
+        index.insert(TestSurfaceIndex.square(2, 3), up, 0)
+        self.assertEqual(len(index), 1)
+
+        index.insert(TestSurfaceIndex.square(40, 50), up, 0)
+        index.insert(TestSurfaceIndex.square(0, 10), up, 1)
+        index.insert(TestSurfaceIndex.square(0, 10, 5), up, 0)
+        self.assertEqual(len(index), 4)
+
+        corners, orientations, types, starts, counts = index.get_arrays()
+        self.assertEqual(corners.shape[1], counts.sum())
+        self.assertTrue(np.array_equal(starts, np.cumsum(counts) - counts))
+        self.assertTrue(np.allclose(orientations, up.reshape((3, 1))))
+        self.assertEqual(sorted(types.tolist()), [0, 0, 0, 1])
+
+        first = corners[:, starts[0]:starts[0] + counts[0]]
+        self.assertTrue(np.allclose([first[0].min(), first[0].max()], [0, 20]))
+
+        index.transform({0: (np.identity(3), np.array([0., 0., 2.]))})
+        self.assertEqual(len(index), 4)
+        self.assertTrue(np.allclose(index.get_arrays()[0][2].min(), 2))
+
+    def test_transform(self):
+        """
+        Test that transform moves only the surfaces with the given tags, in
+            place and without merging them again
+        """
+        index = SurfaceIndex(1, 0.99)
+        up = np.array([0, 0, 1])
+        index.insert(TestSurfaceIndex.square(0, 10), up, 0)
+        index.tag = 1
+        index.insert(TestSurfaceIndex.square(0, 10, 50), up, 0)
+        first, second = sorted(index.polygons)
+        corners = index.get_corners(first)
+        version = index.version
+
+        rotation = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]], dtype=float)
+        moved = rotation @ index.get_corners(second) + np.array([[100], [0], [-40]])
+        index.transform({1: (rotation, np.array([100., 0., -40.]))})
+        self.assertGreater(index.version, version)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(np.allclose(index.get_corners(first), corners))
+        self.assertTrue(np.allclose(index.get_corners(second), moved))
+
+    def test_bridging(self):
+        """
+        Test that a surface bridging two stored surfaces merges all three
+        """
+        index = SurfaceIndex(1, 0.99)
+        up = np.array([0, 0, 1])
+        for x_min, x_max in ((0, 100), (300, 400), (90, 310)):
+            index.insert(TestSurfaceIndex.square(x_min, x_max), up, 0)
+        self.assertEqual(len(index), 1)
+        corners = index.get_arrays()[0]
+        self.assertTrue(np.allclose([corners[0].min(), corners[0].max()], [0, 400]))
+
+    def test_non_convex_union(self):
+        """
+        Test that surfaces whose union is L-shaped are not merged into a
+            hull that covers the corner between them
+        """
+        index = SurfaceIndex(1, 0.99)
+        up = np.array([0, 0, 1])
+        index.insert(TestSurfaceIndex.square(0, 100), up, 0)
+        index.insert(np.array([[0, 10, 10, 0],
+                               [0, 0, 100, 100],
+                               [0, 0, 0, 0]], dtype=float), up, 0)
+        self.assertEqual(len(index), 2)
+        self.assertAlmostEqual(polygon_area(clip_convex(np.array([[0., 1, 0], [0, 0, 1]]),
+                                                        np.array([[0., 1, 1, 0],
+                                                                  [0, 0, 1, 1]]))), 0.5)
+
+    def test_plane_count(self):
+        """
+        Test that the noisy panels of a box make up one plane and one surface
+            per face, and that observing a stored surface again leaves the
+            index unchanged
+        """
+        rng = np.random.default_rng(0)
+        index = SurfaceIndex(10, 0.99)
+        low, high = np.array([-500., -400, -50]), np.array([500., 400, 250])
+        panels = []
+        for axis in range(3):
+            u_axis, v_axis = [other for other in range(3) if other != axis]
+            for side, sign in ((low[axis], 1), (high[axis], -1)):
+                normal = np.zeros(3)
+                normal[axis] = sign
+                for u_low in np.arange(low[u_axis], high[u_axis], 100):
+                    for v_low in np.arange(low[v_axis], high[v_axis], 100):
+                        panel = np.empty((3, 4))
+                        panel[axis] = side
+                        panel[u_axis] = [u_low, u_low + 100, u_low + 100, u_low]
+                        panel[v_axis] = [v_low, v_low, v_low + 100, v_low + 100]
+                        panels.append((panel, normal))
+
+        for i in rng.permutation(len(panels)):
+            corners, normal = panels[i]
+            index.insert(corners + rng.normal(0, 0.5, corners.shape),
+                         normal + rng.normal(0, 0.01, 3), 0)
+        self.assertEqual(len(index.planes), 6)
+
+        version, n_surfaces = index.version, len(index)
+        corners, normal = panels[0]
+        index.insert(corners[:, [0, 1, 2]], normal, 0)
+        self.assertEqual(index.version, version)
+        self.assertEqual(len(index), n_surfaces)
+
+
+class TestLinearSumAssignment(unittest.TestCase):
+    """
+    Test the function linear_sum_assignment
+    """
+
+    def test_square(self):
+        """
+        Test an assignment that a greedy choice would get wrong
+        """
+        rows, cols = linear_sum_assignment(np.array([[14, 5],
+                                                     [1, 20]]))
+        self.assertEqual(list(rows), [0, 1])
+        self.assertEqual(list(cols), [1, 0])
+
+    def test_rectangular(self):
+        """
+        Test assignments with more rows or more columns
+        """
+        cost = np.array([[4, 1, 3],
+                         [2, 0, 5]])
+        rows, cols = linear_sum_assignment(cost)
+        self.assertEqual(cost[rows, cols].sum(), 3)
+        rows, cols = linear_sum_assignment(cost.T)
+        self.assertEqual(list(rows), [0, 1])
+        self.assertEqual(list(cols), [1, 0])
+        self.assertEqual(linear_sum_assignment(np.zeros((0, 3)))[0].size, 0)
+
+
+class TestGeometry(unittest.TestCase):
+    """
+    Test the batched geometry kernels
+    """
+
+    surfaces = geometry.pack_surfaces(np.array([[0, 5, 2, 3, 0, -1, 0, 4],
+                                                [0, 0, 3, 3, 2, 0, -3, -1],
+                                                [0, 0, 0, 0, 0, 0, 0, 10]], dtype=float),
+                                      [0, 3], [3, 5])
+
+    def test_points_on_surfaces(self):
+        """
+        Test many points against padded surfaces of different sizes
+        """
+        points = np.array([[1, 1, 0], [1, 1, 1e-9], [1, 1, 1], [4.5, 0.5, 0]], dtype=float).T
+        on_surfaces = geometry.points_on_surfaces(points, TestGeometry.surfaces)
+
+        self.assertEqual(on_surfaces.shape, (4, 2))
+        self.assertTrue(np.array_equal(on_surfaces[:, 0], [True, True, False, True]))
+        self.assertTrue(np.array_equal(on_surfaces[:, 1], [False, False, False, False]))
+
+    def test_cast_rays(self):
+        """
+        Test that every ray reports the first surface it hits
+        """
+        origins = np.array([[1, 1, 5], [1, 1, -5], [10, 10, 5]], dtype=float).T
+        directions = np.array([[0, 0, -2], [0, 0, 1], [0, 0, -1]], dtype=float).T
+        surfaces, distances = geometry.cast_rays(origins, directions, TestGeometry.surfaces)
+
+        self.assertTrue(np.array_equal(surfaces, [0, 0, -1]))
+        self.assertTrue(np.allclose(distances, [2.5, 5, np.inf]))
+
+
 class TestMap(unittest.TestCase):
     """
     Test the Map class
@@ -80,6 +346,696 @@ class TestMap(unittest.TestCase):
                                                  np.array([[-1, 1, 4, 4],
                                                            [3, -1, 0, 5],
                                                            [0, 0, 0, 0]])))
+        self.assertTrue(Map.is_point_on_surface(np.array([1, 1, 1e-4]),
+                                                np.array([[0, 5, 2],
+                                                          [0, 0, 3],
+                                                          [0, 0, 0]])))
+
+    def test_least_squares_update(self):
+        """
+        Test the method get_least_squares_update_matrices
+        """
+        angle = 0.3
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0],
+                             [np.sin(angle), np.cos(angle), 0],
+                             [0, 0, 1]])
+        translation = np.array([[5], [-20], [3]])
+        old_positions = np.array([[0, 100, 40, -60],
+                                  [50, 80, 200, 120],
+                                  [0, 10, 60, -30]])
+        new_positions = rotation @ old_positions + translation
+
+        position_update, orientation_update, residual = \
+            Map.get_least_squares_update_matrices(old_positions, new_positions)
+        self.assertTrue(np.allclose(orientation_update, rotation))
+        self.assertTrue(np.allclose(position_update, np.append(rotation, translation, axis=1)))
+        self.assertAlmostEqual(residual, 0)
+
+        self.assertRaises(ValueError, Map.get_least_squares_update_matrices,
+                          old_positions[:, :2], new_positions[:, :2])
+
+    def test_ransac_update(self):
+        """
+        Test that get_ransac_update_matrices ignores an outlying pair
+        """
+        angle = -0.2
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0],
+                             [np.sin(angle), np.cos(angle), 0],
+                             [0, 0, 1]])
+        old_positions = np.array([[0, 100, 40, -60, 10, 80],
+                                  [50, 80, 200, 120, 300, 150],
+                                  [0, 10, 60, -30, 5, 0]])
+        new_positions = rotation @ old_positions + np.array([[10], [0], [0]])
+        new_positions[:, 5] += np.array([0, 60, 0])
+        no_orientations = np.full(old_positions.shape, np.nan)
+
+        _, orientation_update, residual = Map.get_ransac_update_matrices(
+            old_positions, new_positions, no_orientations, no_orientations,
+            rng=np.random.default_rng(0)
+        )
+        self.assertTrue(np.allclose(orientation_update, rotation))
+        self.assertAlmostEqual(residual, 0)
+
+    def test_add_observation_drops_frame(self):
+        """
+        Test that a frame without enough common observations is dropped
+        """
+        _map = Map()
+        _map.add_observation([], [], [ReferenceObservation(np.array([0, 50, 0]), 0)], 0)
+        _map.add_observation([], [], [ReferenceObservation(np.array([0, 55, 0]), 0)], 1)
+
+        self.assertEqual(_map.frames_observed, 2)
+        self.assertEqual(_map.frames_dropped, 1)
+        self.assertEqual(_map.time, 0)
+
+    def test_anchored_mapping(self):
+        """
+        Test that anchored and re-transformed maps agree with the true
+            player pose and the true player-relative positions
+        """
+        world_positions = np.array([[0, 100, -80, 40, 150],
+                                    [200, 250, 180, 300, 120],
+                                    [0, 10, 20, 0, 30]], dtype=float)
+        world_orientations = np.array([[1, 0, 1, 0, -1],
+                                       [0, 1, 1, -1, 0],
+                                       [1, 1, 0, 1, 1]], dtype=float)
+        types = [Entity.Entrance, Entity.Box, Entity.Button, Entity.Exit, Entity.Launcher]
+
+        wall_orientation = np.array([0, -1, 0])
+
+        maps = [Map(), Map(anchored=True)]
+        for frame in range(6):
+            yaw = 0.05 * frame
+            rotation = np.array([[np.cos(yaw), -np.sin(yaw), 0],
+                                 [np.sin(yaw), np.cos(yaw), 0],
+                                 [0, 0, 1]])
+            position = np.array([3. * frame, 8. * frame, 0])
+            relative_positions = rotation.T @ (world_positions - position.reshape((3, 1)))
+            relative_orientations = rotation.T @ world_orientations
+            entities = [EntityObservation(types[i], relative_positions[:, i],
+                                          relative_orientations[:, i]) for i in range(5)]
+            wall = np.array([[-100, 0, 0, -100],
+                             [400, 400, 400, 400],
+                             [0, 0, 100, 100]], dtype=float)
+            wall[0] += 10 * frame
+            surfaces = [SurfaceObservation(Surface.NP,
+                                           rotation.T @ (wall - position.reshape((3, 1))),
+                                           rotation.T @ wall_orientation)]
+            for _map in maps:
+                _map.add_observation(entities, surfaces, [], frame)
+
+        for _map in maps:
+            self.assertTrue(np.allclose(_map.get_player_position()[0], position))
+            self.assertTrue(np.allclose(_map.get_player_orientation()[0],
+                                        rotation @ np.array([0, 1, 0])))
+            self.assertEqual(len(_map.entity_store), 5)
+            self.assertTrue(np.allclose(_map.entity_positions, relative_positions))
+            self.assertTrue(np.allclose(_map.entity_orientations, relative_orientations))
+            self.assertTrue(np.allclose(_map.entity_positions_absolute, world_positions))
+
+            self.assertEqual(_map.surfaces, [Surface.NP])
+            corners = _map.surface_positions_absolute
+            self.assertTrue(np.allclose([corners[0].min(), corners[0].max()], [-100, 50]))
+            self.assertTrue(np.allclose(corners[1], 400))
+            self.assertTrue(np.allclose(_map.surface_positions,
+                                        rotation.T @ (corners - position.reshape((3, 1)))))
+
+    def test_add_observation_appends_entities(self):
+        """
+        Test that entities first seen in later frames are stored
+        """
+        first_frame = [EntityObservation(Entity.Entrance, np.array([0., 50., 0.]),
+                                         np.array([1., 0., 1.])),
+                       EntityObservation(Entity.Box, np.array([30., 80., 0.]),
+                                         np.array([0., 1., 1.]))]
+        second_frame = first_frame + [EntityObservation(Entity.Exit, np.array([-200., 100., 0.]),
+                                                        np.array([0., -1., 0.]))]
+
+        _map = Map()
+        _map.add_observation(first_frame, [], [], 0)
+        _map.add_observation(second_frame, [], [], 1)
+
+        self.assertEqual(_map.entities, [Entity.Entrance, Entity.Box, Entity.Exit])
+        self.assertEqual(_map.entity_positions.shape, (3, 3))
+        self.assertTrue(np.allclose(_map.entity_positions_absolute[:, 2],
+                                    np.array([-200, 100, 0])))
+        self.assertTrue(_map.is_exit_found())
+
+        _map.add_observation(second_frame, [], [], 2)
+        self.assertEqual(len(_map.entity_store), 3)
+
+
+class TestPoseGraph(unittest.TestCase):
+    """
+    Test the PoseGraph and KeyframeMap classes
+    """
+
+    def test_solve(self):
+        """
+        Test that a loop closure spreads odometry error around the loop
+        """
+        positions = np.array([[0, 0, 0], [110, 0, 0], [110, 110, 0], [0, 110, 0]], dtype=float)
+        edges_from = np.array([0, 1, 2, 3])
+        edges_to = np.array([1, 2, 3, 0])
+        offsets = np.array([[110, 0, 0], [0, 110, 0], [-110, 0, 0], [10, -110, 0]], dtype=float)
+
+        solution = PoseGraph.solve(positions, edges_from, edges_to, offsets, np.ones(4))
+        self.assertTrue(np.allclose(solution[0], 0))
+        self.assertTrue(np.allclose(solution[1:], np.array([[107.5, 0, 0],
+                                                            [105, 110, 0],
+                                                            [-7.5, 110, 0]])))
+
+    def test_background_optimization(self):
+        """
+        Test that the optimizer thread updates keyframe positions
+        """
+        graph = PoseGraph()
+        graph.start()
+        for position in ([0, 0, 0], [100, 0, 0], [100, 100, 0]):
+            graph.add_keyframe(np.array(position, dtype=float))
+        graph.add_edge(0, 1, np.array([90., 0, 0]))
+        graph.add_edge(1, 2, np.array([0., 100, 0]))
+
+        graph.request_optimization()
+        graph.stop()
+        self.assertEqual(graph.version, 1)
+        self.assertTrue(np.allclose(graph.get_positions()[:, 2], np.array([90, 100, 0])))
+        self.assertTrue(np.allclose(graph.get_poses()[1], 0))
+
+    def test_yaw_correction(self):
+        """
+        Test that solving for keyframe yaws corrects a loop whose odometry
+            turns slowly, which positions alone cannot
+        """
+        corners = np.array([[0, 0, 0], [400, 0, 0], [400, 400, 0], [0, 400, 0]], dtype=float)
+        truth = np.array([corners[i] + (corners[(i + 1) % 4] - corners[i]) * step / 8
+                          for i in range(4) for step in range(8)] + [corners[0]])
+        yaws = 0.01 * np.arange(len(truth))
+        world = np.array([[-40, -30, 0], [30, -40, 10], [20, 50, 0], [-50, 20, 20]], dtype=float)
+
+        errors = []
+        for yaw_weight in (0, None):
+            graph = PoseGraph()
+            recorded = np.zeros(3)
+            graph.add_keyframe(recorded)
+            for k in range(len(truth) - 1):
+                offset = PoseGraph.rotate(-yaws[[k]], (truth[k + 1] - truth[k]).reshape((1, 3)))
+                recorded = recorded + offset[0]
+                graph.add_keyframe(recorded)
+                graph.add_edge(k, k + 1, offset[0])
+
+            observed = PoseGraph.rotate(np.full(len(world), -yaws[-1]), world - truth[-1])
+            graph.add_edge(0, len(truth) - 1, np.mean(world - truth[0], axis=0),
+                           weight=len(world), to_offset=observed.mean(axis=0), yaw=yaws[-1],
+                           yaw_weight=yaw_weight)
+            graph.optimize()
+            errors.append(np.linalg.norm(graph.get_positions().T - truth, axis=1).max())
+
+        self.assertGreater(errors[0], 50)
+        self.assertLess(errors[1], 1)
+
+    def test_keyframe_map(self):
+        """
+        Test that a KeyframeMap adds keyframes as the player moves
+        """
+        world = np.array([[0, 80, -80, 40, 150, -120],
+                          [200, 250, 180, 300, 120, 260],
+                          [0, 10, 20, 0, 30, 50]], dtype=float)
+
+        _map = KeyframeMap(background=False)
+        for frame in range(10):
+            position = np.array([0, 20. * frame, 0])
+            references = [ReferenceObservation(world[:, i] - position, i) for i in range(6)]
+            _map.add_observation([], [], references, frame)
+
+        self.assertEqual(len(_map.pose_graph), 4)
+        self.assertEqual(len(_map.reference_store), 6)
+        self.assertTrue(np.allclose(_map.get_player_position()[0], np.array([0, 180, 0])))
+        self.assertTrue(np.allclose(_map.pose_graph.get_positions()[1],
+                                    np.array([0, 60, 120, 180])))
+
+        # Walking back to the start closes loops with the first keyframes
+        for frame in range(10, 19):
+            position = np.array([0, 20. * (18 - frame), 0])
+            references = [ReferenceObservation(world[:, i] - position, i) for i in range(6)]
+            _map.add_observation([], [], references, frame)
+        _map.close()
+
+        self.assertGreater(len(_map.pose_graph.edges), len(_map.pose_graph) - 1)
+        self.assertTrue(np.allclose(_map.get_player_position()[0], np.zeros(3)))
+        self.assertTrue(np.allclose(_map.reference_positions_absolute, world))
+
+    def test_keyframe_map_corrections(self):
+        """
+        Test that an optimized pose moves only what was observed from its
+            keyframe
+        """
+        world = np.array([[0, 80, -80, 40, 150, -120, 0],
+                          [200, 250, 180, 300, 120, 260, 330],
+                          [0, 10, 20, 0, 30, 50, 0]], dtype=float)
+
+        _map = KeyframeMap(background=False)
+        for frame in range(10):
+            position = np.array([0, 20. * frame, 0])
+            references = [ReferenceObservation(world[:, i] - position, i)
+                          for i in range(6 if frame < 7 else 7)]
+            _map.add_observation([], [], references, frame)
+        self.assertEqual(_map.reference_keyframes, [0] * 6 + [2])
+
+        before = _map.reference_positions_absolute.copy()
+        player_position = _map.get_player_position()[0]
+        with _map.pose_graph.lock:
+            _map.pose_graph.keyframes['position'][:, 2] += np.array([3, 0, 5])
+            _map.pose_graph.keyframes['yaw'][0, 2] = 0.1
+            _map.pose_graph.version += 1
+        new_position = _map.pose_graph.get_positions()[:, 2]
+
+        # An empty frame is dropped, but the corrections are applied first
+        _map.add_observation([], [], [], 10)
+        expected = PoseGraph.get_rotation(0.1) @ (before[:, 6] - np.array([0, 120, 0])) + \
+            new_position
+        self.assertTrue(np.allclose(_map.reference_positions_absolute[:, 6], expected))
+        self.assertTrue(np.allclose(_map.reference_positions_absolute[:, :6], before[:, :6]))
+        self.assertTrue(np.allclose(_map.applied_poses['position'][:, 2], new_position))
+        self.assertTrue(np.allclose(_map.get_player_position()[0], player_position))
+        self.assertEqual(_map.reference_index.query(expected, 0), [6])
+        _map.close()
+
+    def test_keyframe_map_ignores_other_references(self):
+        """
+        Test that references with different ids at the positions of earlier
+            references do not close loops
+        """
+        world = np.array([[0, 80, -80, 40, 150, -120],
+                          [200, 250, 180, 300, 120, 260],
+                          [0, 10, 20, 0, 30, 50]], dtype=float)
+
+        _map = KeyframeMap(background=False)
+        for frame in range(10):
+            position = np.array([0, 20. * frame, 0])
+            references = [ReferenceObservation(world[:, i] - position, i) for i in range(6)]
+            _map.add_observation([], [], references, frame)
+        n_keyframes, n_edges = len(_map.pose_graph), len(_map.pose_graph.edges)
+
+        # Walking back past new references, each seen only once, adds only
+        # odometry edges
+        for frame in range(10, 19):
+            position = np.array([0, 20. * (18 - frame), 0])
+            references = [ReferenceObservation(world[:, i] - position, 100 * frame + i)
+                          for i in range(6)]
+            _map.add_observation([], [], references, frame)
+        _map.close()
+
+        self.assertGreater(len(_map.pose_graph), n_keyframes)
+        self.assertEqual(len(_map.pose_graph.edges) - n_edges, len(_map.pose_graph) - n_keyframes)
+
+
+class TestPoseFilter(unittest.TestCase):
+    """
+    Test the PoseFilter class
+    """
+
+    def test_error_bounds(self):
+        """
+        Test that error bounds grow with prediction and shrink with correction
+        """
+        pose_filter = PoseFilter()
+        self.assertTrue(np.array_equal(pose_filter.get_position_error(0.9), np.zeros(3)))
+
+        pose_filter.predict(10, 0)
+        pose_filter.predict(10, 0)
+        predicted_error = pose_filter.get_position_error(0.9)
+        self.assertTrue(np.all(predicted_error > 0))
+        self.assertTrue(np.all(pose_filter.get_position_error(0.99) > predicted_error))
+        self.assertTrue(np.array_equal(pose_filter.get_position_error(None), np.zeros(3)))
+        self.assertRaises(ValueError, pose_filter.get_position_error, 1.5)
+
+        position = pose_filter.correct(np.zeros(3), np.array([[1, 1], [0, 0], [-2, -2]]))
+        self.assertTrue(np.all(pose_filter.get_position_error(0.9) < predicted_error))
+        self.assertGreater(position[0], 0)
+        self.assertLess(position[2], 0)
+
+    def test_orientation_correction(self):
+        """
+        Test that registrations shrink the orientation error bounds, and do
+            so less for landmarks that are close together
+        """
+        angles = np.array([0.1, -0.2, 0.3])
+        rotation = PoseFilter.get_rotation(angles)
+        self.assertTrue(np.allclose(rotation @ rotation.T, np.identity(3)))
+        self.assertTrue(np.allclose(PoseFilter.get_rotation_vector(rotation), angles))
+
+        errors = []
+        for spread in (10, 100):
+            pose_filter = PoseFilter()
+            for _ in range(100):
+                pose_filter.predict(10, 0)
+            predicted_error = pose_filter.get_orientation_error(0.9)
+            correction = pose_filter.correct_orientation(np.array([0, 0, 0.01]), spread)
+            errors.append(pose_filter.get_orientation_error(0.9))
+            self.assertTrue(np.all(errors[-1] < predicted_error))
+            self.assertGreater(correction[2], 0)
+        self.assertTrue(np.all(errors[1] < errors[0]))
+
+    def test_bounded_uncertainty(self):
+        """
+        Test that the pose error bounds of a Map stop growing on a long run
+            past the same landmarks
+        """
+        _map = Map(anchored=True)
+        bounds = []
+        for index, frame in enumerate(ChamberSimulator(seed=2).run(200)):
+            _map.add_observation(*frame.observation, frame.time)
+            if index in (50, 199):
+                bounds.append(_map.get_player_orientation(0.95)[1])
+        self.assertTrue(np.all(bounds[1] <= 1.1 * bounds[0]))
+        self.assertTrue(_map.is_pose_confident(20, 0.05))
+        self.assertLess(np.linalg.norm(_map.get_player_orientation()[0] - frame.orientation),
+                        0.05)
+
+    def test_gaussian_bounds(self):
+        """
+        Test the bounds against known quantiles of the normal distribution
+        """
+        covariance = np.diag([4., 1, 9])
+        error = PoseFilter.get_error(covariance, 0.95 ** 3)
+        self.assertTrue(np.allclose(error, 1.959964 * np.array([2, 1, 3])))
+
+
+class TestNavigation(unittest.TestCase):
+    """
+    Test the NavigationGrid and DStarLite classes, and path planning in Map
+    """
+
+    floor = np.array([[-100, 300, 300, -100],
+                      [-100, -100, 100, 100],
+                      [0, 0, 0, 0]], dtype=float)
+    wall = np.array([[100, 100, 100, 100],
+                     [-100, 60, 60, -100],
+                     [0, 0, 100, 100]], dtype=float)
+    platform = np.array([[180, 300, 300, 180],
+                         [-100, -100, 100, 100],
+                         [19, 19, 19, 19]], dtype=float)
+
+    def test_grid(self):
+        """
+        Test floor heights, wall blocking and step costs
+        """
+        grid = NavigationGrid(20)
+        grid.add_floor(TestNavigation.floor, np.array([0, 0, 1]))
+        grid.add_floor(TestNavigation.platform, np.array([0, 0, 1]))
+        grid.add_wall(TestNavigation.wall)
+
+        self.assertTrue(grid.is_walkable(grid.get_cell(np.array([0, 0, 0]))))
+        self.assertFalse(grid.is_walkable(grid.get_cell(np.array([100, 0, 0]))))
+        self.assertTrue(grid.is_walkable(grid.get_cell(np.array([100, 80, 0]))))
+        self.assertFalse(grid.is_walkable(grid.get_cell(np.array([400, 0, 0]))))
+        self.assertEqual(grid.get_position(grid.get_cell(np.array([250, 0, 0])))[2], 19)
+
+        self.assertEqual(grid.cost((8, 0), (9, 0)), 20 + NavigationGrid.jump_cost)
+        self.assertEqual(grid.cost((9, 0), (8, 0)), 20)
+        self.assertTrue(grid.needs_jump((8, 0), (9, 0)))
+        self.assertFalse(grid.needs_jump((9, 0), (8, 0)))
+
+    def test_incremental_replanning(self):
+        """
+        Test that repairing a plan after the grid changes matches a new plan
+        """
+        grid = NavigationGrid(20)
+        grid.add_floor(TestNavigation.floor, np.array([0, 0, 1]))
+        planner = DStarLite(grid, (-4, 0), (12, 0))
+        path = planner.plan()
+        self.assertEqual(len(path), 17)
+
+        new_grid = NavigationGrid(20)
+        new_grid.add_floor(TestNavigation.floor, np.array([0, 0, 1]))
+        new_grid.add_wall(TestNavigation.wall)
+        planner.update(new_grid, new_grid.get_changed_cells(grid), (-3, 0))
+        path = planner.plan()
+
+        self.assertEqual(path[0], (-3, 0))
+        self.assertEqual(path[-1], (12, 0))
+        self.assertTrue(all(new_grid.is_walkable(cell) for cell in path))
+        self.assertEqual(len(path), len(DStarLite(new_grid, (-3, 0), (12, 0)).plan()))
+
+    def test_run_pathfinder(self):
+        """
+        Test that the Map plans a route to the exit and notifies observers
+        """
+        class Observer:
+            # pylint: disable=missing-class-docstring,too-few-public-methods
+            def __init__(self):
+                self.ideas = []
+
+            def notify_idea(self, idea):
+                # pylint: disable=missing-function-docstring
+                self.ideas.append(idea)
+
+        _map = Map()
+        observer = Observer()
+        _map.add_observer(observer)
+        self.assertIsNone(_map.run_pathfinder())
+
+        surfaces = [SurfaceObservation(Surface.NP, TestNavigation.floor, np.array([0, 0, 1])),
+                    SurfaceObservation(Surface.P, TestNavigation.platform, np.array([0, 0, 1])),
+                    SurfaceObservation(Surface.P, TestNavigation.wall, np.array([-1, 0, 0]))]
+        exit_door = EntityObservation(Entity.Exit, np.array([250., 0, 30]), np.array([-1., 0, 0]))
+        _map.add_observation([exit_door], surfaces, [], 0)
+
+        idea = _map.run_pathfinder()
+        self.assertEqual(observer.ideas, [idea])
+        self.assertTrue(np.allclose(idea[-1].position[:2], np.array([248, 8])))
+        self.assertTrue(any(checkpoint.position[1] > 60 for checkpoint in idea))
+        self.assertEqual([checkpoint.action for checkpoint in idea].count(Action.Jump), 1)
+
+    def test_portal_search(self):
+        """
+        Test that a ledge that cannot be walked to is reached through portals
+        """
+        floor = np.array([[-100, 100, 100, -100],
+                          [-100, -100, 100, 100],
+                          [0, 0, 0, 0]], dtype=float)
+        ledge = np.array([[300, 400, 400, 300],
+                          [-100, -100, 100, 100],
+                          [200, 200, 200, 200]], dtype=float)
+        near_wall = np.array([[-100, -100, -100, -100],
+                              [-50, 50, 50, -50],
+                              [0, 0, 100, 100]], dtype=float)
+        far_wall = np.array([[400, 400, 400, 400],
+                             [-50, 50, 50, -50],
+                             [200, 200, 300, 300]], dtype=float)
+
+        _map = Map()
+        surfaces = [SurfaceObservation(Surface.NP, floor, np.array([0, 0, 1])),
+                    SurfaceObservation(Surface.NP, ledge, np.array([0, 0, 1])),
+                    SurfaceObservation(Surface.P, near_wall, np.array([1, 0, 0])),
+                    SurfaceObservation(Surface.P, far_wall, np.array([-1, 0, 0]))]
+        _map.add_observation([], surfaces, [], 0)
+
+        idea = _map.run_pathfinder(np.array([350, 0, 200]))
+        actions = [checkpoint.action for checkpoint in idea]
+        self.assertIn(Action.Portal1, actions)
+        self.assertIn(Action.Portal2, actions)
+        self.assertEqual(idea[-1].position[2], 200)
+        self.assertEqual(len(_map.route_planner.portal_search), 2)
+
+        grid = _map.get_navigation_grid()
+        self.assertFalse(_map.route_planner.portal_search.update_table(
+            grid, _map.surface_positions_absolute, _map.surface_orientations_absolute,
+            _map.surface_corner_starts, _map.surface_corner_counts,
+            _map.surface_index.get_arrays()[2]))
+
+
+class TestPipeline(unittest.TestCase):
+    """
+    Test the Pipeline class
+    """
+
+    @staticmethod
+    def counter(n_frames):
+        """
+        Returns a source that yields the integers 0 to n_frames - 1
+        """
+        frames = iter(range(n_frames))
+        return lambda: next(frames, None)
+
+    @staticmethod
+    def sleeper(duration):
+        """
+        Returns a stage that sleeps for duration, then passes its input on
+        """
+        def stage(value):
+            time.sleep(duration)
+            return value
+        return stage
+
+    def test_overlapped_stages(self):
+        """
+        Test that with back-pressure every frame passes through every stage
+            in order, and that the stages run concurrently
+        """
+        classifying, detecting = threading.Event(), threading.Event()
+        overlapped = []
+
+        def detect(value):
+            if value == 1:
+                # Classify cannot finish frame 0 until detect starts frame 1
+                detecting.set()
+                overlapped.append(classifying.wait(5))
+            return TestPipeline.sleeper(0.02)(value)
+
+        def classify(value):
+            if value == 0:
+                classifying.set()
+                overlapped.append(detecting.wait(5))
+            return TestPipeline.sleeper(0.02)(value)
+
+        results = []
+        stages = [('detect', detect), ('classify', classify), ('map', results.append)]
+        pipeline = Pipeline(TestPipeline.counter(20), stages, drop_stale=False)
+        pipeline.start()
+        self.assertTrue(pipeline.join(10))
+        self.assertEqual(overlapped, [True, True])
+        self.assertEqual(results, list(range(20)))
+
+        stats = pipeline.get_stats()
+        self.assertEqual(stats['total']['completed'], 20)
+        self.assertEqual(stats['detect']['count'], 20)
+        self.assertEqual(stats['detect']['dropped'], 0)
+        self.assertGreaterEqual(stats['detect']['p50'], 0.02)
+        self.assertGreaterEqual(stats['total']['p50'], 0.04)
+
+    def test_drop_stale(self):
+        """
+        Test that a slow stage skips frames instead of falling behind, and
+            that stage errors are raised by join
+        """
+        started, exhausted = threading.Event(), threading.Event()
+        frames = iter(range(100))
+
+        def source():
+            frame = next(frames, None)
+            if frame == 1:
+                started.wait(5)
+            elif frame is None:
+                exhausted.set()
+            return frame
+
+        def detect(value):
+            # Hold the first frame until the source has pushed every other one
+            if value == 0:
+                started.set()
+                exhausted.wait(5)
+            return value
+
+        pipeline = Pipeline(source, [('detect', detect)])
+        pipeline.start()
+        pipeline.join()
+        stats = pipeline.get_stats()
+        self.assertEqual(stats['detect']['dropped'], 98)
+        self.assertEqual(stats['total']['completed'], 2)
+        self.assertEqual(pipeline.latest, 99)
+
+        pipeline = Pipeline(TestPipeline.counter(10), [('fail', lambda value: 1 / 0)])
+        pipeline.start()
+        self.assertRaises(ZeroDivisionError, pipeline.join)
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Test the Recorder, Recording and Player classes
+    """
+
+    @staticmethod
+    def frames():
+        """
+        Returns a list of (entities, surfaces, references, time) tuples of a
+            player walking past two entities, a wall and a reference point
+        """
+        frames = []
+        for frame in range(5):
+            offset = np.array([0, -10. * frame, 0])
+            entities = [EntityObservation(Entity.Entrance, np.array([0., 50, 0]) + offset,
+                                          np.array([1., 0, 0])),
+                        EntityObservation(Entity.Button, np.array([40., 80, 0]) + offset,
+                                          np.array([0., 0, 1]))]
+            surfaces = [SurfaceObservation(Surface.P, np.array([[-50., 50, 50, -50],
+                                                                [200, 200, 200, 200],
+                                                                [0, 0, 100, 100]]) +
+                                           offset.reshape((3, 1)), np.array([0., -1, 0]))]
+            references = [ReferenceObservation(np.array([-30., 60, 10]) + offset, 7)] \
+                if frame % 2 else []
+            frames.append((entities, surfaces, references, 0.02 * frame))
+        return frames
+
+    def test_round_trip(self):
+        """
+        Test that recorded frames are read back in any order and that
+            playback into a Map is deterministic
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'recording.bin')
+        frames = TestReplay.frames()
+        with Recorder(path, Map()) as recorder:
+            for frame in frames:
+                recorder.add_observation(*frame)
+            self.assertTrue(np.allclose(recorder.get_player_position()[0], [0, 40, 0]))
+
+        recording = Recording(path)
+        self.assertEqual(len(recording), 5)
+        for index in (3, 0, -1):
+            (entities, surfaces, references), frame_time = recording[index]
+            expected = frames[index]
+            self.assertEqual(frame_time, expected[3])
+            self.assertEqual([entity.entity for entity in entities],
+                             [Entity.Entrance, Entity.Button])
+            self.assertTrue(np.allclose(entities[1].position, expected[0][1].position))
+            self.assertEqual(surfaces[0].surface, Surface.P)
+            self.assertTrue(np.allclose(surfaces[0].corners, expected[1][0].corners))
+            self.assertEqual([reference.id for reference in references],
+                             [reference.id for reference in expected[2]])
+
+        positions = []
+        for speed in (None, 1):
+            _map = Map()
+            elapsed = Player(path, speed).play(_map)
+            positions.append(_map.get_player_position()[0])
+            self.assertEqual(_map.frames_observed, 5)
+        self.assertGreaterEqual(elapsed, 0.08)
+        self.assertTrue(np.array_equal(*positions))
+        self.assertTrue(np.allclose(positions[0], [0, 40, 0]))
+
+        Recorder(path).close()
+        self.assertEqual(len(Recording(path)), 0)
+
+
+class TestSimulator(unittest.TestCase):
+    """
+    Test the ChamberSimulator class and the stress function
+    """
+
+    def test_simulator(self):
+        """
+        Test that simulated frames are reproducible and consistent with the
+            true pose, and that a Map tracks the player through them
+        """
+        frames = [list(ChamberSimulator(seed=3).run(20)) for _ in range(2)]
+        self.assertTrue(np.array_equal(frames[0][-1].position, frames[1][-1].position))
+        self.assertTrue(np.allclose(frames[0][0].position, 0))
+        self.assertTrue(np.allclose(frames[0][0].orientation, [0, 1, 0]))
+        self.assertGreater(len(frames[0][0].observation.reference_observations), 3)
+
+        simulator = ChamberSimulator(seed=3)
+        frame = simulator.step()
+        for reference in frame.observation.reference_observations:
+            error = reference.position + frame.position - \
+                simulator.reference_positions[:, reference.id]
+            self.assertLess(np.abs(error).max(), 10 * ChamberSimulator.position_noise)
+
+        _map = Map(anchored=True)
+        stats = stress(_map, ChamberSimulator(seed=3), 100)
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual(_map.frames_dropped, 0)
+        self.assertLess(stats['max_position_error'], 5)
 
 
 if __name__ == '__main__':
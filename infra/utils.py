@@ -90,7 +90,8 @@ Checkpoint.__doc__ = """
                      :param orientation: 3D numpy array
                      :param action: Action where is_one_shot returns True 
                          (to be executed after player reaches the desired
-                         position and orientation)
+                         position and orientation), or None if the
+                         Checkpoint is only a waypoint
                      """
 
 Idea = List[Checkpoint]